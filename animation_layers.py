@@ -10,516 +10,4462 @@ bl_info = {
     "category": "Animation",
 }
 
+import csv
+import fnmatch
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+from itertools import islice
+
 import bpy
-from bpy.props import StringProperty, BoolProperty, FloatProperty, CollectionProperty, IntProperty, EnumProperty
+import numpy as np
+from bpy.app.handlers import persistent
+from bpy.props import StringProperty, BoolProperty, FloatProperty, CollectionProperty, IntProperty, EnumProperty, PointerProperty
 from bpy.types import PropertyGroup, UIList, Operator, Panel
+from bpy_extras.io_utils import ExportHelper, ImportHelper
+
+# Profiling. Everything below is a single flag check while profiling is off.
+PROFILER = {
+    "enabled": False,
+    "origin": 0.0,
+    "events": deque(maxlen=200000),  # Chrome trace events, oldest dropped first
+    "stats": {},  # name: [calls, total seconds, max seconds]
+    "counters": {},
+}
+
+def profile_count(name, amount=1):
+    if PROFILER["enabled"]:
+        counters = PROFILER["counters"]
+        counters[name] = counters.get(name, 0) + amount
+
+def profile_event(name, category, **args):
+    if PROFILER["enabled"]:
+        PROFILER["events"].append({"name": name, "cat": category, "ph": "i", "s": "t", "pid": 1, "tid": 1,
+                                   "ts": (time.perf_counter() - PROFILER["origin"]) * 1e6, "args": args})
+
+@contextmanager
+def profile_span(name, category):
+    if not PROFILER["enabled"]:
+        yield
+        return
+    counters = PROFILER["counters"]
+    before = dict(counters)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        stats = PROFILER["stats"].setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+        PROFILER["events"].append({
+            "name": name, "cat": category, "ph": "X", "pid": 1, "tid": 1,
+            "ts": (start - PROFILER["origin"]) * 1e6, "dur": duration * 1e6,
+            "args": {key: value - before.get(key, 0) for key, value in counters.items()
+                     if value != before.get(key, 0)},
+        })
+
+def profiled(category):
+    # Time every call of the decorated function. Operators are named by their bl_idname.
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER["enabled"]:
+                return function(*args, **kwargs)
+            name = args[0].bl_idname if category == 'operator' else function.__qualname__
+            with profile_span(name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def reset_profile():
+    PROFILER["origin"] = time.perf_counter()
+    PROFILER["events"].clear()
+    PROFILER["stats"].clear()
+    PROFILER["counters"].clear()
+
+def set_profiling(enabled):
+    if enabled and not PROFILER["enabled"]:
+        reset_profile()
+    PROFILER["enabled"] = enabled
+
+@persistent
+def count_depsgraph_updates(scene, depsgraph):
+    if PROFILER["enabled"]:
+        profile_count("depsgraph_updates")
+        profile_event("depsgraph update", 'depsgraph', ids=len(depsgraph.updates))
+
+def chrome_trace():
+    events = list(PROFILER["events"])
+    # Counter tracks so the totals can be graphed alongside the spans
+    if events:
+        end = max(event["ts"] + event.get("dur", 0.0) for event in events)
+        events.append({"name": "counters", "ph": "C", "pid": 1, "tid": 1, "ts": end,
+                       "args": dict(PROFILER["counters"])})
+    return {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "otherData": {"blender": bpy.app.version_string, "file": bpy.data.filepath,
+                      "addon_version": ".".join(map(str, bl_info["version"]))},
+    }
+
+# Keyframe enum values as returned by foreach_get on keyframe_points
+KEY_CONSTANT = 0
+KEY_LINEAR = 1
+KEY_BEZIER = 2
+HANDLE_FREE = 0
+HANDLE_AUTO_CLAMPED = 4
+
+def read_keyframes(fcurve):
+    points = fcurve.keyframe_points
+    count = len(points)
+    co = np.empty(count * 2, dtype=np.float32)
+    handle_left = np.empty(count * 2, dtype=np.float32)
+    handle_right = np.empty(count * 2, dtype=np.float32)
+    interpolation = np.empty(count, dtype=np.int32)
+    points.foreach_get('co', co)
+    points.foreach_get('handle_left', handle_left)
+    points.foreach_get('handle_right', handle_right)
+    points.foreach_get('interpolation', interpolation)
+    profile_count("fcurves_read")
+    profile_count("keyframes_read", count)
+    return co.reshape(-1, 2), handle_left.reshape(-1, 2), handle_right.reshape(-1, 2), interpolation
+
+def read_handle_types(fcurve):
+    points = fcurve.keyframe_points
+    left = np.empty(len(points), dtype=np.int32)
+    right = np.empty(len(points), dtype=np.int32)
+    points.foreach_get('handle_left_type', left)
+    points.foreach_get('handle_right_type', right)
+    return left, right
+
+def write_keyframes(fcurve, co, interpolation=None, handle_left=None, handle_right=None, handle_types=None):
+    points = fcurve.keyframe_points
+    count = len(co)
+    existing = len(points)
+    if existing > count:
+        if hasattr(points, 'clear'):
+            points.clear()
+            points.add(count)
+        else:
+            for _ in range(existing - count):
+                points.remove(points[-1], fast=True)
+    elif existing < count:
+        points.add(count - existing)
+
+    points.foreach_set('co', np.ascontiguousarray(co, dtype=np.float32).ravel())
+    if interpolation is None:
+        interpolation = np.full(count, KEY_BEZIER, dtype=np.int32)
+    points.foreach_set('interpolation', np.ascontiguousarray(interpolation, dtype=np.int32))
+
+    if handle_types is None:
+        # Explicit handles must not be recalculated by fcurve.update()
+        handle_type = HANDLE_FREE if handle_left is not None else HANDLE_AUTO_CLAMPED
+        handle_types = (np.full(count, handle_type, dtype=np.int32),) * 2
+    points.foreach_set('handle_left_type', np.ascontiguousarray(handle_types[0], dtype=np.int32))
+    points.foreach_set('handle_right_type', np.ascontiguousarray(handle_types[1], dtype=np.int32))
+    if handle_left is not None and handle_right is not None:
+        points.foreach_set('handle_left', np.ascontiguousarray(handle_left, dtype=np.float32).ravel())
+        points.foreach_set('handle_right', np.ascontiguousarray(handle_right, dtype=np.float32).ravel())
+    fcurve.update()
+    profile_count("fcurves_written")
+    profile_count("keyframes_written", count)
+
+def _bezier(p0, p1, p2, p3, t):
+    s = 1.0 - t
+    return s * s * s * p0 + 3.0 * s * s * t * p1 + 3.0 * s * t * t * p2 + t * t * t * p3
+
+def _evaluate_bezier_segments(x0, y0, x1, y1, right, left, frames):
+    # Clamp handles so the segment stays a function of time, like Blender does
+    h1 = right - np.column_stack((x0, y0))
+    h2 = left - np.column_stack((x1, y1))
+    length = x1 - x0
+    handle_length = np.abs(h1[:, 0]) + np.abs(h2[:, 0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fac = np.where(handle_length > length, length / handle_length, 1.0)
+    h1 = h1 * fac[:, None]
+    h2 = h2 * fac[:, None]
+    px1, py1 = x0 + h1[:, 0], y0 + h1[:, 1]
+    px2, py2 = x1 + h2[:, 0], y1 + h2[:, 1]
+
+    # x(t) is monotonic on a corrected segment, so bisection always converges
+    lo = np.zeros(len(frames))
+    hi = np.ones(len(frames))
+    for _ in range(32):
+        t = (lo + hi) * 0.5
+        below = _bezier(x0, px1, px2, x1, t) < frames
+        lo = np.where(below, t, lo)
+        hi = np.where(below, hi, t)
+    return _bezier(y0, py1, py2, y1, (lo + hi) * 0.5)
+
+def evaluate_keyframes(co, handle_left, handle_right, interpolation, frames, extrapolation='CONSTANT'):
+    frames = np.asarray(frames, dtype=np.float64)
+    count = len(co)
+    if count == 0:
+        return np.zeros(len(frames))
+    x = co[:, 0].astype(np.float64)
+    y = co[:, 1].astype(np.float64)
+    if count == 1:
+        return np.full(len(frames), y[0])
+
+    seg = np.clip(np.searchsorted(x, frames, side='right') - 1, 0, count - 2)
+    x0, x1 = x[seg], x[seg + 1]
+    y0, y1 = y[seg], y[seg + 1]
+    width = x1 - x0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = np.clip(np.where(width > 0, (frames - x0) / width, 0.0), 0.0, 1.0)
+    values = y0 + (y1 - y0) * u
+
+    mode = interpolation[seg]
+    values = np.where(mode == KEY_CONSTANT, y0, values)
+    bezier = np.nonzero(mode == KEY_BEZIER)[0]
+    if len(bezier):
+        values[bezier] = _evaluate_bezier_segments(
+            x0[bezier], y0[bezier], x1[bezier], y1[bezier],
+            handle_right[seg[bezier]].astype(np.float64),
+            handle_left[seg[bezier] + 1].astype(np.float64),
+            frames[bezier])
+
+    before = frames < x[0]
+    after = frames >= x[-1]
+    values[before] = y[0]
+    values[after] = y[-1]
+    if extrapolation == 'LINEAR':
+        if interpolation[0] == KEY_BEZIER:
+            dx, dy = x[0] - handle_left[0, 0], y[0] - handle_left[0, 1]
+        else:
+            dx, dy = x[1] - x[0], y[1] - y[0]
+        if interpolation[0] != KEY_CONSTANT and dx != 0:
+            values[before] = y[0] + (frames[before] - x[0]) * dy / dx
+        if interpolation[-1] == KEY_BEZIER:
+            dx, dy = handle_right[-1, 0] - x[-1], handle_right[-1, 1] - y[-1]
+        else:
+            dx, dy = x[-1] - x[-2], y[-1] - y[-2]
+        if interpolation[-1] != KEY_CONSTANT and dx != 0:
+            values[after] = y[-1] + (frames[after] - x[-1]) * dy / dx
+    return values
+
+def evaluate_fcurve(fcurve, frames):
+    frames = np.asarray(frames, dtype=np.float64)
+    co, handle_left, handle_right, interpolation = read_keyframes(fcurve)
+    # Modifiers and easing modes are rare enough to leave to Blender itself
+    if any(not mod.mute for mod in fcurve.modifiers) or np.any(interpolation > KEY_BEZIER):
+        return np.array([fcurve.evaluate(frame) for frame in frames])
+    return evaluate_keyframes(co, handle_left, handle_right, interpolation, frames, fcurve.extrapolation)
+
+def channel_property(data_path):
+    return data_path.rsplit('.', 1)[-1]
+
+def channel_mix_mode(data_path):
+    prop = channel_property(data_path)
+    if prop == 'rotation_quaternion':
+        return 'QUATERNION'
+    if prop in {'scale', 'delta_scale'}:
+        return 'MULTIPLY'
+    return 'ADD'
+
+def channel_size(data_path):
+    prop = channel_property(data_path)
+    if prop in {'rotation_quaternion', 'rotation_axis_angle'}:
+        return 4
+    if prop in {'location', 'rotation_euler', 'scale', 'delta_location', 'delta_rotation_euler', 'delta_scale'}:
+        return 3
+    return 1
+
+def channel_defaults(data_path, size):
+    prop = channel_property(data_path)
+    defaults = np.zeros(size)
+    if prop in {'scale', 'delta_scale'}:
+        defaults[:] = 1.0
+    elif prop == 'rotation_quaternion':
+        defaults[0] = 1.0
+    elif prop == 'rotation_axis_angle' and size > 2:
+        defaults[2] = 1.0
+    return defaults
+
+def channel_group_name(data_path):
+    if data_path.startswith('pose.bones["'):
+        return data_path[len('pose.bones["'):].split('"]', 1)[0]
+    return "Object Transforms"
+
+def quaternion_multiply(a, b):
+    aw, ax, ay, az = a[:, 0], a[:, 1], a[:, 2], a[:, 3]
+    bw, bx, by, bz = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+    return np.column_stack((
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    ))
+
+def quaternion_inverse(q):
+    norm = np.einsum('ij,ij->i', q, q)
+    return q * np.array([1.0, -1.0, -1.0, -1.0]) / np.where(norm > 0.0, norm, 1.0)[:, None]
+
+def quaternion_power(q, exponent):
+    # Same as Blender's pow_qt_fl_normalized: no shortest-path flip
+    norm = np.linalg.norm(q, axis=1)
+    q = q / np.where(norm > 0, norm, 1.0)[:, None]
+    angle = exponent * np.arccos(np.clip(q[:, 0], -1.0, 1.0))
+    vec = q[:, 1:]
+    vec_norm = np.linalg.norm(vec, axis=1)
+    scale = np.where(vec_norm > 1e-12, np.sin(angle) / np.where(vec_norm > 1e-12, vec_norm, 1.0), 0.0)
+    return np.column_stack((np.cos(angle), vec * scale[:, None]))
+
+def blend_values(lower, value, influence, blend_type, mix_mode, defaults):
+    # lower/value are (frames, size) arrays, influence is (frames,)
+    inf = influence[:, None]
+    if blend_type == 'COMBINE':
+        if mix_mode == 'QUATERNION':
+            return quaternion_multiply(lower, quaternion_power(value, influence))
+        if mix_mode == 'MULTIPLY':
+            base = np.where(defaults == 0.0, 1.0, defaults)
+            ratio = value / base
+            return lower * np.sign(ratio) * np.abs(ratio) ** inf
+        return lower + (value - defaults) * inf
+    if blend_type == 'ADD':
+        return lower + value * inf
+    if blend_type == 'SUBTRACT':
+        return lower - value * inf
+    if blend_type == 'MULTIPLY':
+        return lower * (1.0 - inf) + lower * value * inf
+    return lower * (1.0 - inf) + value * inf
+
+def strip_action_frames(strip, frames, next_start=None):
+    # Map scene frames to action time and mask the frames the strip contributes to
+    start, end = strip.frame_start, strip.frame_end
+    active = np.ones(len(frames), dtype=bool)
+    if strip.extrapolation == 'NOTHING':
+        active &= (frames >= start) & (frames <= end)
+    elif strip.extrapolation == 'HOLD_FORWARD':
+        active &= frames >= start
+    if next_start is not None:
+        active &= (frames <= end) | (frames < next_start)
+
+    # Same as nlastrip_get_frame_actionclip, including its fallbacks for zero scale and length
+    scale = abs(strip.scale) or 1.0
+    length = strip.action_frame_end - strip.action_frame_start or 1.0
+    local = np.clip(frames, start, end)
+    offset = np.fmod(local - start, length * scale) / scale
+    if strip.repeat == math.floor(strip.repeat):
+        # The end of a whole number of repeats holds the last frame instead of snapping back
+        offset = np.where(local == end, length, offset)
+    if strip.use_reverse:
+        return strip.action_frame_end - offset, active
+    return strip.action_frame_start + offset, active
+
+def strip_influence(strip, frames):
+    if strip.use_animated_influence:
+        fcurve = strip.fcurves.find('influence')
+        if fcurve:
+            return np.clip(evaluate_fcurve(fcurve, frames), 0.0, 1.0)
+        return np.full(len(frames), strip.influence)
+    # Without animated influence the NLA ramps the strip in and out over its blend
+    # frames (also the auto blend ones), holding the value at the strip bounds
+    start, end = strip.frame_start, strip.frame_end
+    local = np.clip(frames, start, end)
+    influence = np.ones(len(frames))
+    blend_in, blend_out = abs(strip.blend_in), abs(strip.blend_out)
+    if blend_out > 0.0:
+        ramp = local >= end - blend_out
+        influence[ramp] = np.abs(end - local[ramp]) / blend_out
+    if blend_in > 0.0:
+        ramp = local <= start + blend_in
+        influence[ramp] = np.abs(local[ramp] - start) / blend_in
+    return influence
+
+def layer_tracks(obj, layers):
+    # Tracks of the given layers, bottom to top in NLA evaluation order
+    names = {layer.nla_track_name for layer in layers}
+    return [track for track in obj.animation_data.nla_tracks if track.name in names]
+
+def track_strips(track):
+    return sorted((strip for strip in track.strips if not strip.mute and strip.action),
+                  key=lambda strip: strip.frame_start)
+
+def fcurve_key_range(fcurve):
+    # Keyed frame range, or None when the curve keeps changing outside its keys
+    points = fcurve.keyframe_points
+    if not len(points):
+        return None
+    if fcurve.extrapolation == 'LINEAR' or any(not mod.mute for mod in fcurve.modifiers):
+        return None
+    return points[0].co.x, points[-1].co.x
+
+def strip_scene_range(strip, key_range):
+    start, end = strip.frame_start, strip.frame_end
+    if key_range is not None and strip.repeat == 1.0:
+        scale = abs(strip.scale) or 1.0
+        if strip.use_reverse:
+            first = start + (strip.action_frame_end - key_range[1]) * scale
+            last = start + (strip.action_frame_end - key_range[0]) * scale
+        else:
+            first = start + (key_range[0] - strip.action_frame_start) * scale
+            last = start + (key_range[1] - strip.action_frame_start) * scale
+        first, last = max(first, start), min(last, end)
+        if first > last:
+            first = last = start
+    else:
+        first, last = start, end
+
+    # The result jumps back to the lower layers where the strip stops contributing
+    if strip.extrapolation == 'NOTHING':
+        first, last = min(first, start - 1), max(last, end + 1)
+    elif strip.extrapolation == 'HOLD_FORWARD':
+        first = min(first, start - 1)
+    return first, last
+
+@profiled('function')
+def build_channel_index(obj, layers, frame_start, frame_end):
+    # Map every data path keyed in the given layers to the scene frame span where
+    # the merged result can change. Outside that span the result is held constant.
+    index = {}
+    for track in layer_tracks(obj, layers):
+        for strip in track_strips(track):
+            influence_span = None
+            if strip.use_animated_influence:
+                fcurve = strip.fcurves.find('influence')
+                if fcurve and len(fcurve.keyframe_points):
+                    key_range = fcurve_key_range(fcurve)
+                    influence_span = key_range if key_range else (strip.frame_start, strip.frame_end)
+
+            for fcurve in strip.action.fcurves:
+                if fcurve.mute or not len(fcurve.keyframe_points):
+                    continue
+                first, last = strip_scene_range(strip, fcurve_key_range(fcurve))
+                if influence_span:
+                    first, last = min(first, influence_span[0]), max(last, influence_span[1])
+                span = index.get(fcurve.data_path)
+                if span:
+                    first, last = min(first, span[0]), max(last, span[1])
+                index[fcurve.data_path] = (first, last)
+
+    clipped = {}
+    for data_path, (first, last) in index.items():
+        first = max(int(np.floor(first)), frame_start)
+        last = min(int(np.ceil(last)), frame_end)
+        if first <= last:
+            clipped[data_path] = (first, last)
+    return clipped
+
+def index_frame_range(index):
+    if not index:
+        return None
+    return min(span[0] for span in index.values()), max(span[1] for span in index.values())
+
+def index_bone_names(index):
+    return {channel_group_name(data_path) for data_path in index if data_path.startswith('pose.bones["')}
+
+@profiled('function')
+def evaluate_layer_stack(obj, layers, frames, data_paths=None):
+    # Combine the F-curves of the given layers like the NLA does, starting from
+    # the property defaults. Returns {data_path: (values, keyed_indices, group_name)}
+    frames = np.asarray(frames, dtype=np.float64)
+    channels = {}
+    for track in layer_tracks(obj, layers):
+        strips = track_strips(track)
+        for i, strip in enumerate(strips):
+            next_start = strips[i + 1].frame_start if i + 1 < len(strips) else None
+            action_frames, active = strip_action_frames(strip, frames, next_start)
+            if not active.any():
+                continue
+            action_frames = action_frames[active]
+            influence = strip_influence(strip, frames[active])
+
+            curves = {}
+            for fcurve in strip.action.fcurves:
+                if fcurve.mute or (data_paths is not None and fcurve.data_path not in data_paths):
+                    continue
+                curves.setdefault(fcurve.data_path, []).append(fcurve)
+
+            for data_path, fcurves in curves.items():
+                size = max(channel_size(data_path), max(fc.array_index for fc in fcurves) + 1)
+                defaults = channel_defaults(data_path, size)
+                if data_path not in channels:
+                    group = next((fc.group.name for fc in fcurves if fc.group), channel_group_name(data_path))
+                    channels[data_path] = (np.tile(defaults, (len(frames), 1)), set(), group)
+                result, keyed, group = channels[data_path]
+
+                value = np.tile(defaults, (len(action_frames), 1))
+                for fcurve in fcurves:
+                    value[:, fcurve.array_index] = evaluate_fcurve(fcurve, action_frames)
+                    keyed.add(fcurve.array_index)
+                mix_mode = channel_mix_mode(data_path)
+                if mix_mode == 'QUATERNION':
+                    keyed.update(range(4))
+                result[active] = blend_values(result[active], value, influence, strip.blend_type, mix_mode, defaults)
+    return channels
+
+OBJECT_TRANSFORM_PATHS = {'location', 'rotation_euler', 'rotation_quaternion', 'rotation_axis_angle', 'scale'}
+
+def is_visual_path(data_path, visual_paths):
+    if data_path in visual_paths:
+        return True
+    if data_path.startswith('pose.bones["'):
+        prefix = data_path[:data_path.index('"]') + 3]
+        return prefix in visual_paths
+    return False
+
+@profiled('function')
+def write_channels(action, channels, frames, skip=None):
+    frames = np.asarray(frames, dtype=np.float64)
+    for data_path, (values, keyed, group) in channels.items():
+        if skip and skip(data_path):
+            continue
+        for index in sorted(keyed):
+            fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+            write_keyframes(fcurve, np.column_stack((frames, values[:, index])))
+
+def copy_fcurve(source, action):
+    fcurve = action.fcurves.find(source.data_path, index=source.array_index)
+    if fcurve is None:
+        group = source.group.name if source.group else channel_group_name(source.data_path)
+        fcurve = action.fcurves.new(source.data_path, index=source.array_index, action_group=group)
+    co, handle_left, handle_right, interpolation = read_keyframes(source)
+    write_keyframes(fcurve, co, interpolation, handle_left, handle_right, read_handle_types(source))
+    return fcurve
+
+def replace_keyframes(fcurve, co, drop, handle_left=None, handle_right=None):
+    # Write co into the curve together with the existing keys not flagged in drop.
+    # New keys get auto clamped handles unless free handles are given.
+    co = np.asarray(co, dtype=np.float32).reshape(-1, 2)
+    old_co, old_left, old_right, old_interpolation = read_keyframes(fcurve)
+    left_types, right_types = read_handle_types(fcurve)
+    keep = ~drop(old_co[:, 0])
+    count = len(co)
+
+    merged_co = np.concatenate((old_co[keep], co))
+    order = np.argsort(merged_co[:, 0], kind='stable')
+    interpolation = np.concatenate((old_interpolation[keep], np.full(count, KEY_BEZIER, dtype=np.int32)))
+    new_types = np.full(count, HANDLE_AUTO_CLAMPED if handle_left is None else HANDLE_FREE, dtype=np.int32)
+    handle_left = np.concatenate((old_left[keep], co if handle_left is None else handle_left))
+    handle_right = np.concatenate((old_right[keep], co if handle_right is None else handle_right))
+    handle_types = (np.concatenate((left_types[keep], new_types))[order],
+                    np.concatenate((right_types[keep], new_types))[order])
+    write_keyframes(fcurve, merged_co[order], interpolation[order], handle_left[order], handle_right[order], handle_types)
+
+def splice_keyframes(fcurve, co, first=None, last=None, handle_left=None, handle_right=None):
+    # Replace the keys between first and last with co, keeping the keys outside
+    co = np.asarray(co, dtype=np.float32).reshape(-1, 2)
+    if first is None:
+        first, last = co[:, 0].min(), co[:, 0].max()
+    replace_keyframes(fcurve, co, lambda frames: (frames >= first) & (frames <= last), handle_left, handle_right)
+
+def upsert_keyframes(fcurve, frames, values):
+    # Insert or overwrite keys at the given frames in a single write
+    frames = np.asarray(frames, dtype=np.float32)
+    co = np.column_stack((frames, np.asarray(values, dtype=np.float32)))
+    replace_keyframes(fcurve, co, lambda old_frames: np.isin(old_frames, frames))
+
+def fold_edit_delta(base, delta, influence, mix_mode, defaults):
+    # Layer values that give the same result as keying delta with COMBINE on top
+    # of the layer at the given strip influence
+    inf = influence[:, None]
+    if mix_mode == 'QUATERNION':
+        return quaternion_power(quaternion_multiply(quaternion_power(base, influence), delta), 1.0 / influence)
+    if mix_mode == 'MULTIPLY':
+        scale = np.where(defaults == 0.0, 1.0, defaults)
+        ratio = delta / scale
+        return base * np.sign(ratio) * np.abs(ratio) ** (1.0 / inf)
+    return base + (delta - defaults) / inf
+
+def extract_combine_delta(base, target, mix_mode, defaults):
+    # Layer values that turn base into target when keyed with COMBINE at full influence
+    if mix_mode == 'QUATERNION':
+        return continuous_quaternions(quaternion_multiply(quaternion_inverse(base), target))
+    if mix_mode == 'MULTIPLY':
+        scale = np.where(defaults == 0.0, 1.0, defaults)
+        safe = np.where(base == 0.0, 1.0, base)
+        # A zero scale below can't be undone, so that frame keeps the rest value
+        return np.where(base == 0.0, scale, target / safe * scale)
+    return target - base + defaults
+
+def unblend_values(lower, result, influence, blend_type, mix_mode, defaults):
+    # Inverse of blend_values: the strip value that blends lower into result.
+    # Influence must be above zero.
+    inf = influence[:, None]
+    if blend_type == 'COMBINE':
+        delta = extract_combine_delta(lower, result, mix_mode, defaults)
+        if mix_mode == 'QUATERNION':
+            # The short way round, so partial influence can still reach it
+            delta = delta * np.where(delta[:, :1] < 0.0, -1.0, 1.0)
+        return fold_edit_delta(np.tile(defaults, (len(result), 1)), delta, influence, mix_mode, defaults)
+    if blend_type == 'ADD':
+        return (result - lower) / inf
+    if blend_type == 'SUBTRACT':
+        return (lower - result) / inf
+    if blend_type == 'MULTIPLY':
+        return (result / np.where(lower == 0.0, 1.0, lower) - 1.0 + inf) / inf
+    return (result - lower * (1.0 - inf)) / inf
+
+# Frames baked on either side of a sparse edit when it is folded into the layer
+EDIT_BLEND_MARGIN = 10
+
+def splice_edit_action(strip, working):
+    # Fold the curves keyed in a sparse edit action back into the strip's action.
+    # The edit action is in scene time and only holds the changes made on top of the layer.
+    action = strip.action
+    channels = {}
+    for fcurve in working.fcurves:
+        if len(fcurve.keyframe_points):
+            channels.setdefault(fcurve.data_path, []).append(fcurve)
+
+    for data_path, edited in channels.items():
+        size = max(channel_size(data_path), max(fcurve.array_index for fcurve in edited) + 1)
+        defaults = channel_defaults(data_path, size)
+        mix_mode = channel_mix_mode(data_path)
+        originals = [action.fcurves.find(data_path, index=index) for index in range(size)]
+
+        first = min(fcurve.keyframe_points[0].co.x for fcurve in edited)
+        last = max(fcurve.keyframe_points[-1].co.x for fcurve in edited)
+        # Bake a short margin too, up to the layer keys next to the edit, so the segments
+        # joining the edit to the kept keys follow the edited motion
+        scale = abs(strip.scale) or 1.0
+        margin_first, margin_last = first - EDIT_BLEND_MARGIN, last + EDIT_BLEND_MARGIN
+        for fcurve in originals:
+            if fcurve and len(fcurve.keyframe_points):
+                keys = strip.frame_start + (read_keyframes(fcurve)[0][:, 0] - strip.action_frame_start) * scale
+                margin_first = max(margin_first, keys[keys < first].max(initial=-np.inf) + 1.0)
+                margin_last = min(margin_last, keys[keys > last].min(initial=np.inf) - 1.0)
+        first, last = min(first, margin_first), max(last, margin_last)
+        frames = np.arange(np.floor(first), np.ceil(last) + 1.0)
+        action_frames, active = strip_action_frames(strip, frames)
+        # Repeated strips map several scene frames onto one action frame; the first one wins
+        action_frames, unique = np.unique(action_frames[active], return_index=True)
+        frames = frames[active][unique]
+        if not len(frames):
+            continue
+
+        # Where the layer has no influence the edit cannot be folded into it
+        influence = strip_influence(strip, frames)
+        editable = influence > 1e-3
+        influence = np.where(editable, influence, 1.0)
+
+        delta = np.tile(defaults, (len(frames), 1))
+        for fcurve in edited:
+            delta[:, fcurve.array_index] = evaluate_fcurve(fcurve, frames)
+        base = np.tile(defaults, (len(frames), 1))
+        for index, fcurve in enumerate(originals):
+            if fcurve:
+                base[:, index] = evaluate_fcurve(fcurve, action_frames)
+        values = np.where(editable[:, None], fold_edit_delta(base, delta, influence, mix_mode, defaults), base)
+
+        # Past its keys the edit holds its end values. Those are folded into the layer's
+        # own keys outside the edited span, keeping their interpolation and handles.
+        if np.any(np.abs(delta[[0, -1]] - defaults) > 1e-6):
+            fold_edit_ends(strip, originals, delta[[0, -1]], action_frames[0], action_frames[-1], mix_mode, defaults)
+
+        indices = range(size) if mix_mode == 'QUATERNION' else sorted({fcurve.array_index for fcurve in edited})
+        for index in indices:
+            fcurve = originals[index]
+            co = np.column_stack((action_frames, values[:, index]))
+            if fcurve is None:
+                fcurve = action.fcurves.new(data_path, index=index, action_group=channel_group_name(data_path))
+                write_keyframes(fcurve, co)
+            else:
+                splice_keyframes(fcurve, co, action_frames[0], action_frames[-1])
+
+def fold_edit_ends(strip, originals, ends, first, last, mix_mode, defaults):
+    # Fold the held start/end values of an edit into the keys before first and after
+    # last (action frames). Each key moves with its handles, so the curve keeps its shape.
+    scale = abs(strip.scale) or 1.0
+    curves = [read_keyframes(fcurve) if fcurve else None for fcurve in originals]
+    moved = []
+    for index, fcurve in enumerate(originals):
+        if fcurve is None or not len(curves[index][0]):
+            continue
+        co, handle_left, handle_right, interpolation = curves[index]
+        key_frames = co[:, 0].astype(np.float64)
+        outside = (key_frames < first) | (key_frames > last)
+        if not outside.any():
+            continue
+        key_frames = key_frames[outside]
+        base = np.tile(defaults, (len(key_frames), 1))
+        for other, curve in enumerate(originals):
+            if curve:
+                base[:, other] = evaluate_fcurve(curve, key_frames)
+        delta = np.where((key_frames < first)[:, None], ends[0], ends[1])
+        influence = strip_influence(strip, strip.frame_start + (key_frames - strip.action_frame_start) * scale)
+        editable = influence > 1e-3
+        folded = fold_edit_delta(base, delta, np.where(editable, influence, 1.0), mix_mode, defaults)
+        offset = np.where(editable, folded[:, index] - base[:, index], 0.0)
+        moved.append((fcurve, outside, offset, curves[index]))
+
+    # Written after every component is evaluated, so quaternions fold from the original keys
+    for fcurve, outside, offset, (co, handle_left, handle_right, interpolation) in moved:
+        for points in (co, handle_left, handle_right):
+            points[outside, 1] += offset
+        write_keyframes(fcurve, co, interpolation, handle_left, handle_right, read_handle_types(fcurve))
+
+# Rough in-memory sizes of Blender's FCurve and BezTriple structs, used for the
+# history budget and to report what a purge frees
+ACTION_BYTES = 1024
+FCURVE_BYTES = 256
+KEYFRAME_BYTES = 72
+
+def estimate_action_bytes(action):
+    return ACTION_BYTES + sum(FCURVE_BYTES + KEYFRAME_BYTES * len(fcurve.keyframe_points) for fcurve in action.fcurves)
+
+def new_layer_action(name, source=None):
+    # Actions created by the add-on are tagged so a purge can tell them apart from user actions
+    action = source.copy() if source else bpy.data.actions.new(name=name)
+    action.name = name
+    action["animation_layers"] = True
+    profile_count("actions_created")
+    return action
+
+def is_layer_action(action):
+    if action.get("animation_layers"):
+        return True
+    # Actions from files saved before they were tagged. A fake user means someone chose to keep it.
+    if action.use_fake_user:
+        return False
+    return action.name.startswith(("Action_", "Merged_")) or action.name.endswith(("_edit", "_merged"))
+
+def orphan_layer_actions():
+    # Actions only referenced by name from a layer are still in use
+    protected = set()
+    for obj in bpy.data.objects:
+        for layer in obj.animation_layers:
+            protected.update(version.action_name for version in layer.versions)
+            for key in ("original_action_name", "edit_action_name"):
+                if key in layer:
+                    protected.add(layer[key])
+        for snapshot in obj.animation_layer_snapshots:
+            protected.update(strip[0] for record in json.loads(snapshot.state)["layers"] for strip in record[4])
+    return [action for action in bpy.data.actions
+            if is_layer_action(action) and action.name not in protected
+            and action.users - int(action.use_fake_user) == 0]
+
+def snapshot_channels(action, data_paths, name):
+    snapshot = new_layer_action(name)
+    for fcurve in action.fcurves:
+        if fcurve.data_path in data_paths:
+            copy_fcurve(fcurve, snapshot)
+    return snapshot
+
+def push_layer_version(layer, action, label, channels=None):
+    # channels lists the data paths of a partial version, None keeps the whole action
+    now = int(time.time())
+    version = layer.versions.add()
+    version.action_name = action.name
+    version.label = label
+    version.created = now
+    version.last_used = now
+    version.size = estimate_action_bytes(action)
+    version.partial = channels is not None
+    version.channels = json.dumps(sorted(channels)) if channels is not None else ""
+    action.use_fake_user = True
+    action["animation_layers"] = True
+    trim_layer_history(layer, bpy.context.scene.animation_layer_settings)
+
+def drop_layer_version(layer, index):
+    action = bpy.data.actions.get(layer.versions[index].action_name)
+    layer.versions.remove(index)
+    if action:
+        action.use_fake_user = False
+        if action.users == 0:
+            bpy.data.actions.remove(action)
+
+def trim_layer_history(layer, settings):
+    budget = settings.history_max_megabytes * 1024 * 1024
+    while len(layer.versions):
+        total = sum(version.size for version in layer.versions)
+        if len(layer.versions) <= settings.history_max_versions and (not budget or total <= budget):
+            break
+        # Least recently used goes first
+        drop_layer_version(layer, min(range(len(layer.versions)), key=lambda i: layer.versions[i].last_used))
+
+def finish_sparse_edit(obj, layer, track):
+    anim_data = obj.animation_data
+    working = anim_data.action
+    if working and working.name == layer.get("edit_action_name"):
+        # Only the curves about to change go into the history
+        action = track.strips[0].action
+        channels = {fcurve.data_path for fcurve in working.fcurves}
+        push_layer_version(layer, snapshot_channels(action, channels, f"{action.name}_partial"), "Before edit", channels)
+        splice_edit_action(track.strips[0], working)
+        anim_data.action = None
+        bpy.data.actions.remove(working)
+    track.mute = not layer.visible
+    for key in ("original_action_name", "edit_action_name", "edit_mode"):
+        if key in layer:
+            del layer[key]
+    layer.is_editing = False
+
+# Key reduction tolerances per channel type. Rotations are in radians; for
+# quaternion components this angle is halved, which is the same rotation error.
+OPTIMIZE_TOLERANCES = {'LOCATION': 0.0005, 'ROTATION': math.radians(0.05), 'SCALE': 0.0005, 'OTHER': 0.0005}
+REMOVABLE_CHANNELS = {'location', 'rotation_euler', 'rotation_quaternion', 'rotation_axis_angle', 'scale',
+                      'delta_location', 'delta_rotation_euler', 'delta_rotation_quaternion', 'delta_scale'}
+
+def channel_tolerance(data_path, tolerances):
+    prop = channel_property(data_path)
+    if prop in {'location', 'delta_location'}:
+        return tolerances['LOCATION']
+    if prop in {'rotation_quaternion', 'delta_rotation_quaternion'}:
+        return tolerances['ROTATION'] * 0.5
+    if prop in {'rotation_euler', 'rotation_axis_angle', 'delta_rotation_euler'}:
+        return tolerances['ROTATION']
+    if prop in {'scale', 'delta_scale'}:
+        return tolerances['SCALE']
+    return tolerances['OTHER']
+
+def simplify_samples(x, y, tolerance):
+    # Ramer-Douglas-Peucker on the value error, splitting every open segment of a level at once.
+    # Returns the mask of samples whose linear interpolation stays within tolerance of all samples.
+    keep = np.zeros(len(x), dtype=bool)
+    keep[[0, -1]] = True
+    starts = np.array([0])
+    ends = np.array([len(x) - 1])
+    while len(starts):
+        lengths = ends - starts - 1
+        open_segments = lengths > 0
+        starts, ends, lengths = starts[open_segments], ends[open_segments], lengths[open_segments]
+        if not len(starts):
+            break
+        bounds = np.cumsum(lengths) - lengths
+        segment = np.repeat(np.arange(len(starts)), lengths)
+        inner = starts[segment] + 1 + np.arange(lengths.sum()) - bounds[segment]
+        x0, y0 = x[starts][segment], y[starts][segment]
+        x1, y1 = x[ends][segment], y[ends][segment]
+        error = np.abs(y[inner] - (y0 + (y1 - y0) * (x[inner] - x0) / (x1 - x0)))
+
+        # Worst sample of every segment, the first of its group once sorted by segment then error
+        worst = np.lexsort((-error, segment))[bounds]
+        split = error[worst] > tolerance
+        pivots = inner[worst[split]]
+        keep[pivots] = True
+        starts, ends = np.concatenate((starts[split], pivots)), np.concatenate((pivots, ends[split]))
+    return keep
+
+def span_worst(error, keys):
+    # Index of the largest error between every pair of consecutive keys
+    span = np.cumsum(keys) - 1
+    order = np.lexsort((-error, span))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = span[order][1:] != span[order][:-1]
+    return order[first]
+
+def reduce_fcurve_keys(fcurve, tolerance):
+    co, handle_left, handle_right, interpolation = read_keyframes(fcurve)
+    count = len(co)
+    if count < 3 or any(not mod.mute for mod in fcurve.modifiers):
+        return count
+
+    if np.all(interpolation == KEY_CONSTANT):
+        # Stepped curves only lose keys that hold the value of the key before them
+        keep = np.ones(count, dtype=bool)
+        keep[1:] = np.abs(np.diff(co[:, 1])) > tolerance
+        if keep.all():
+            return count
+        write_keyframes(fcurve, co[keep], interpolation[keep])
+        return int(keep.sum())
+    if np.any(interpolation > KEY_BEZIER):
+        return count
+
+    # The reduced curve has to match the original on every frame and every key
+    x = co[:, 0].astype(np.float64)
+    frames = np.union1d(np.arange(np.ceil(x[0]), np.floor(x[-1]) + 1.0), x)
+    reference = evaluate_keyframes(co, handle_left, handle_right, interpolation, frames, fcurve.extrapolation)
+    linear = simplify_samples(frames, reference, tolerance)
+    if linear.sum() >= count:
+        return count
+
+    # Auto clamped handles keep the motion smooth; add back the worst frame of every span that drifts
+    keep = simplify_samples(frames, reference, tolerance * 8.0)
+    for _ in range(16):
+        write_keyframes(fcurve, np.column_stack((frames[keep], reference[keep])))
+        error = np.abs(evaluate_keyframes(*read_keyframes(fcurve), frames, fcurve.extrapolation) - reference)
+        drifting = error > tolerance
+        if not drifting.any():
+            return int(keep.sum())
+        worst = span_worst(error, keep)
+        keep[worst[drifting[worst]]] = True
+        if keep.sum() >= count:
+            break
+
+    # Straight segments between the reduced keys are within tolerance by construction
+    co = np.column_stack((frames[linear], reference[linear]))
+    write_keyframes(fcurve, co, np.full(len(co), KEY_LINEAR, dtype=np.int32))
+    return len(co)
+
+def constant_fcurve(fcurve, co, tolerance):
+    # Judged on the evaluated curve, since handles can move it between keys of equal value.
+    # One frame past each end catches linear extrapolation.
+    if np.ptp(co[:, 1]) > tolerance:
+        return False
+    x = co[:, 0].astype(np.float64)
+    frames = np.union1d(np.arange(np.floor(x[0]) - 1.0, np.ceil(x[-1]) + 2.0), x)
+    return np.ptp(evaluate_fcurve(fcurve, frames)) <= tolerance
+
+def optimize_action(action, tolerances, remove_defaults=True):
+    # remove_defaults drops channels that hold their rest value, which is only safe for combine strips
+    keys_before = sum(len(fcurve.keyframe_points) for fcurve in action.fcurves)
+    bytes_before = estimate_action_bytes(action)
+    channels = {}
+    for fcurve in action.fcurves:
+        channels.setdefault(fcurve.data_path, []).append(fcurve)
+
+    removed = 0
+    for data_path, fcurves in channels.items():
+        tolerance = channel_tolerance(data_path, tolerances)
+        size = max(channel_size(data_path), max(fcurve.array_index for fcurve in fcurves) + 1)
+        defaults = channel_defaults(data_path, size)
+        constant = {}
+        for fcurve in fcurves:
+            if any(not mod.mute for mod in fcurve.modifiers):
+                continue
+            co = read_keyframes(fcurve)[0]
+            if len(co) and constant_fcurve(fcurve, co, tolerance):
+                constant[fcurve.array_index] = co[0]
+
+        if (remove_defaults and channel_property(data_path) in REMOVABLE_CHANNELS and len(constant) == len(fcurves)
+                and all(abs(key[1] - defaults[index]) <= tolerance for index, key in constant.items())):
+            for fcurve in fcurves:
+                action.fcurves.remove(fcurve)
+            removed += len(fcurves)
+            continue
+
+        for fcurve in fcurves:
+            if fcurve.array_index in constant:
+                if len(fcurve.keyframe_points) > 1:
+                    write_keyframes(fcurve, constant[fcurve.array_index][None])
+            else:
+                reduce_fcurve_keys(fcurve, tolerance)
+
+    profile_count("fcurves_removed", removed)
+    return {
+        "keys_before": keys_before,
+        "keys_after": sum(len(fcurve.keyframe_points) for fcurve in action.fcurves),
+        "bytes_before": bytes_before,
+        "bytes_after": estimate_action_bytes(action),
+        "fcurves_removed": removed,
+    }
+
+def optimize_report(totals):
+    saved = (totals["bytes_before"] - totals["bytes_after"]) / (1024 * 1024)
+    return (f"Keys {totals['keys_before']} -> {totals['keys_after']}, "
+            f"{totals['fcurves_removed']} unchanged F-curve(s) removed, about {saved:.2f} MB saved")
+
+def rotation_to_quaternions(m):
+    # Vectorized Shepperd conversion of (n, 3, 3) rotation matrices, kept sign-continuous
+    n = len(m)
+    q = np.empty((n, 4))
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+    diagonal = np.stack((trace, m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]), axis=1)
+    branch = np.argmax(diagonal, axis=1)
+
+    b = branch == 0
+    s = np.sqrt(np.maximum(trace[b] + 1.0, 1e-12)) * 2.0
+    q[b] = np.column_stack((0.25 * s, (m[b, 2, 1] - m[b, 1, 2]) / s,
+                            (m[b, 0, 2] - m[b, 2, 0]) / s, (m[b, 1, 0] - m[b, 0, 1]) / s))
+    b = branch == 1
+    s = np.sqrt(np.maximum(1.0 + m[b, 0, 0] - m[b, 1, 1] - m[b, 2, 2], 1e-12)) * 2.0
+    q[b] = np.column_stack(((m[b, 2, 1] - m[b, 1, 2]) / s, 0.25 * s,
+                            (m[b, 0, 1] + m[b, 1, 0]) / s, (m[b, 0, 2] + m[b, 2, 0]) / s))
+    b = branch == 2
+    s = np.sqrt(np.maximum(1.0 + m[b, 1, 1] - m[b, 0, 0] - m[b, 2, 2], 1e-12)) * 2.0
+    q[b] = np.column_stack(((m[b, 0, 2] - m[b, 2, 0]) / s, (m[b, 0, 1] + m[b, 1, 0]) / s,
+                            0.25 * s, (m[b, 1, 2] + m[b, 2, 1]) / s))
+    b = branch == 3
+    s = np.sqrt(np.maximum(1.0 + m[b, 2, 2] - m[b, 0, 0] - m[b, 1, 1], 1e-12)) * 2.0
+    q[b] = np.column_stack(((m[b, 1, 0] - m[b, 0, 1]) / s, (m[b, 0, 2] + m[b, 2, 0]) / s,
+                            (m[b, 1, 2] + m[b, 2, 1]) / s, 0.25 * s))
+
+    q /= np.linalg.norm(q, axis=1)[:, None]
+    return continuous_quaternions(q)
+
+def continuous_quaternions(q):
+    # Flip signs so consecutive rows never jump to the opposite hemisphere
+    if len(q):
+        q[0] *= np.sign(q[0, 0]) or 1.0
+        flips = np.sign(np.einsum('ij,ij->i', q[1:], q[:-1]))
+        flips[flips == 0] = 1.0
+        q[1:] *= np.cumprod(flips)[:, None]
+    return q
+
+EULER_AXES = {'XYZ': (0, 1, 2), 'XZY': (0, 2, 1), 'YXZ': (1, 0, 2), 'YZX': (1, 2, 0), 'ZXY': (2, 0, 1), 'ZYX': (2, 1, 0)}
+
+def rotation_to_eulers(m, order):
+    # Euler angles of (n, 3, 3) rotation matrices for a Blender rotation order,
+    # unwrapped over time like Euler.make_compatible
+    i, j, k = EULER_AXES[order]
+    sign = 1.0 if (j - i) % 3 == 1 else -1.0
+    cy = np.hypot(m[:, i, i], m[:, j, i])
+    angles = np.empty((len(m), 3))
+    angles[:, i] = np.arctan2(sign * m[:, k, j], m[:, k, k])
+    angles[:, j] = np.arctan2(-sign * m[:, k, i], cy)
+    angles[:, k] = np.arctan2(sign * m[:, j, i], m[:, i, i])
+    return np.unwrap(angles, axis=0)
+
+def matrices_to_channels(matrices, rotation_mode):
+    # Split (n, 4, 4) local matrices into {property: (n, size)} transform channels
+    basis = matrices[:, :3, :3]
+    scale = np.linalg.norm(basis, axis=1)
+    rotation = basis / np.where(scale > 1e-12, scale, 1.0)[:, None, :]
+    negative = np.linalg.det(basis) < 0.0
+    rotation[negative] *= -1.0
+    scale[negative] *= -1.0
+
+    channels = {'location': matrices[:, :3, 3], 'scale': scale}
+    if rotation_mode == 'QUATERNION':
+        channels['rotation_quaternion'] = rotation_to_quaternions(rotation)
+    elif rotation_mode == 'AXIS_ANGLE':
+        q = rotation_to_quaternions(rotation)
+        half = np.arccos(np.clip(q[:, 0], -1.0, 1.0))
+        sin_half = np.sin(half)
+        axis = np.where(sin_half[:, None] > 1e-8, q[:, 1:] / np.where(sin_half > 1e-8, sin_half, 1.0)[:, None],
+                        np.array([0.0, 1.0, 0.0]))
+        channels['rotation_axis_angle'] = np.column_stack((2.0 * half, axis))
+    else:
+        channels['rotation_euler'] = rotation_to_eulers(rotation, rotation_mode)
+    return channels
+
+def bone_data_path(bone_name):
+    return f'pose.bones["{bpy.utils.escape_identifier(bone_name)}"]'
+
+def constraint_bones(pose_bone, constraint):
+    # Names of the bones a bone constraint moves, IK and Spline IK also move the parents in their chain
+    if constraint.type not in {'IK', 'SPLINE_IK'}:
+        return {pose_bone.name}
+    chain = [pose_bone] + list(pose_bone.parent_recursive)
+    if constraint.type == 'IK' and not constraint.use_tail:
+        chain = chain[1:]
+    if constraint.chain_count:
+        chain = chain[:constraint.chain_count]
+    return {bone.name for bone in chain}
+
+@profiled('function')
+def visual_sweep(context, targets, frame_start, frame_end, frames=None):
+    # Step the scene once over the frame range, or only over the given frames, and
+    # capture the visual local transforms of every target. targets maps an object to
+    # the set of pose bone names to capture, plus None for the object's own transform.
+    # Returns (frames, {object: {data_path: (values, group_name)}})
+    scene = context.scene
+    if frames is None:
+        frames = np.arange(frame_start, frame_end + 1, dtype=np.float64)
+    profile_count("frames_evaluated", len(frames))
+    recorders = []
+    for obj, names in targets.items():
+        recorder = {"obj": obj, "bones": [], "object": None in names}
+        if obj.type == 'ARMATURE':
+            pose_bones = obj.pose.bones
+            wanted = [bone for bone in pose_bones if bone.name in names]
+            needed = {bone.name for bone in wanted} | {bone.parent.name for bone in wanted if bone.parent}
+            recorder["bones"] = wanted
+            recorder["rows"] = [i for i, bone in enumerate(pose_bones) if bone.name in needed]
+            recorder["row_of"] = {pose_bones[i].name: n for n, i in enumerate(recorder["rows"])}
+            recorder["buffer"] = np.empty(len(pose_bones) * 16, dtype=np.float32)
+            recorder["pose"] = np.empty((len(frames), len(recorder["rows"]), 4, 4), dtype=np.float32)
+            # Bones that do not fully inherit their parent's transform go through convert_space
+            recorder["special"] = [bone for bone in wanted if not bone.bone.use_inherit_rotation
+                                   or bone.bone.inherit_scale != 'FULL' or not bone.bone.use_local_location]
+            recorder["local"] = {bone.name: np.empty((len(frames), 4, 4)) for bone in recorder["special"]}
+        if recorder["object"]:
+            recorder["world"] = np.empty((len(frames), 4, 4))
+            recorder["parent"] = np.empty((len(frames), 4, 4)) if obj.parent else None
+        recorders.append(recorder)
+
+    original_frame = scene.frame_current
+    depsgraph = context.evaluated_depsgraph_get()
+    for f, frame in enumerate(frames):
+        scene.frame_set(int(frame))
+        for recorder in recorders:
+            # Read the evaluated copies, which hold the result of constraints and IK
+            obj = recorder["obj"].evaluated_get(depsgraph)
+            if recorder["bones"]:
+                obj.pose.bones.foreach_get('matrix', recorder["buffer"])
+                # RNA matrices are column-major
+                mats = recorder["buffer"].reshape(-1, 4, 4)[recorder["rows"]]
+                recorder["pose"][f] = mats.transpose(0, 2, 1)
+                for bone in recorder["special"]:
+                    evaluated_bone = obj.pose.bones[bone.name]
+                    recorder["local"][bone.name][f] = np.array(obj.convert_space(
+                        pose_bone=evaluated_bone, matrix=evaluated_bone.matrix, from_space='POSE', to_space='LOCAL'))
+            if recorder["object"]:
+                recorder["world"][f] = np.array(obj.matrix_world)
+                if recorder["parent"] is not None:
+                    recorder["parent"][f] = np.array(obj.parent.matrix_world)
+    scene.frame_set(original_frame)
+
+    results = {}
+    for recorder in recorders:
+        obj = recorder["obj"]
+        channels = results[obj] = {}
+        for bone in recorder["bones"]:
+            if bone.name in recorder["local"]:
+                local = recorder["local"][bone.name]
+            else:
+                pose = recorder["pose"][:, recorder["row_of"][bone.name]].astype(np.float64)
+                rest = np.array(bone.bone.matrix_local)
+                if bone.parent:
+                    parent_pose = recorder["pose"][:, recorder["row_of"][bone.parent.name]].astype(np.float64)
+                    offset = np.linalg.inv(np.array(bone.parent.bone.matrix_local)) @ rest
+                    local = np.linalg.inv(parent_pose @ offset) @ pose
+                else:
+                    local = np.linalg.inv(rest) @ pose
+            prefix = bone_data_path(bone.name)
+            for prop, values in matrices_to_channels(local, bone.rotation_mode).items():
+                channels[f"{prefix}.{prop}"] = (values, bone.name)
+        if recorder["object"]:
+            local = recorder["world"]
+            if recorder["parent"] is not None:
+                local = np.linalg.inv(recorder["parent"] @ np.array(obj.matrix_parent_inverse)) @ local
+            for prop, values in matrices_to_channels(local, obj.rotation_mode).items():
+                channels[prop] = (values, "Object Transforms")
+    return frames, results
+
+def write_channel_span(action, data_path, values, frames, group):
+    # Write (frames, size) values over their frame span, replacing existing keys in that span
+    for index in range(values.shape[1]):
+        co = np.column_stack((frames, values[:, index]))
+        fcurve = action.fcurves.find(data_path, index=index)
+        if fcurve:
+            splice_keyframes(fcurve, co, frames[0], frames[-1])
+        else:
+            fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+            write_keyframes(fcurve, co)
+
+def hermite_slopes(x, y):
+    # Three point derivatives on uneven spacing, one sided at the ends
+    slopes = np.zeros(len(x))
+    if len(x) < 2:
+        return slopes
+    dx = np.diff(x)
+    secant = np.diff(y) / dx
+    slopes[0], slopes[-1] = secant[0], secant[-1]
+    slopes[1:-1] = (secant[:-1] * dx[1:] + secant[1:] * dx[:-1]) / (dx[:-1] + dx[1:])
+    return slopes
+
+def hermite_values(x, y, slopes, frames):
+    seg = np.clip(np.searchsorted(x, frames, side='right') - 1, 0, len(x) - 2)
+    width = x[seg + 1] - x[seg]
+    t = (frames - x[seg]) / width
+    t2, t3 = t * t, t * t * t
+    return ((2.0 * t3 - 3.0 * t2 + 1.0) * y[seg] + (t3 - 2.0 * t2 + t) * width * slopes[seg]
+            + (3.0 * t2 - 2.0 * t3) * y[seg + 1] + (t3 - t2) * width * slopes[seg + 1])
+
+def select_hermite_keys(x, y, tolerance, fixed):
+    # Start from the fixed samples and add the worst sample of every span whose Hermite
+    # fit misses a sample, until the curve through the keys fits them all
+    keys = fixed.copy()
+    keys[[0, -1]] = True
+    while True:
+        kx, ky = x[keys], y[keys]
+        if len(kx) < 2:
+            return keys
+        error = np.abs(y - hermite_values(kx, ky, hermite_slopes(kx, ky), x))
+        error[keys] = 0.0
+        if error.max() <= tolerance:
+            return keys
+        worst = span_worst(error, keys)
+        keys[worst[error[worst] > tolerance]] = True
+
+def write_hermite_keys(action, data_path, index, group, x, y):
+    # Free handles a third of the way to the neighbouring keys make Blender's Bezier the same Hermite curve
+    slopes = hermite_slopes(x, y)
+    left = np.diff(x, prepend=x[0]) / 3.0
+    right = np.diff(x, append=x[-1]) / 3.0
+    co = np.column_stack((x, y))
+    handle_left = np.column_stack((x - left, y - slopes * left))
+    handle_right = np.column_stack((x + right, y + slopes * right))
+    fcurve = action.fcurves.find(data_path, index=index)
+    if fcurve:
+        splice_keyframes(fcurve, co, x[0], x[-1], handle_left, handle_right)
+    else:
+        fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+        write_keyframes(fcurve, co, None, handle_left, handle_right)
+
+def align_rotations(values, layout):
+    # Samples taken out of order lose the continuity a contiguous sweep gives them
+    columns = {}
+    for column, (key, index, _) in enumerate(layout):
+        columns.setdefault(key, []).append(column)
+    for (_, data_path), group in columns.items():
+        prop = channel_property(data_path)
+        if prop == 'rotation_quaternion' and len(group) == 4:
+            values[:, group] = continuous_quaternions(values[:, group])
+        elif prop == 'rotation_euler':
+            values[:, group] = np.unwrap(values[:, group], axis=0)
+    return values
+
+def adaptive_samples(evaluate, first, last, step, anchors=(), align=False):
+    # Sample every step frames, then sample the middle of every span whose Hermite fit
+    # misses it and make that sample a key of the channels that missed. evaluate(frames)
+    # returns {(object name, data path): (values, keyed indices, group)}.
+    # Returns (frames, values, keys, layout) with a boolean key mask per column.
+    layout = []
+
+    def sample(frames):
+        channels = evaluate(frames)
+        if not layout:
+            layout.extend(((key, index, group) for key, (values, keyed, group) in sorted(channels.items())
+                           for index in sorted(keyed)))
+        if not layout:
+            return np.zeros((len(frames), 0))
+        return np.column_stack([channels[key][0][:, index] for key, index, _ in layout])
+
+    frames = np.unique(np.concatenate((np.arange(first, last, max(step, 1)), [last], anchors))).astype(np.float64)
+    values = sample(frames)
+    keys = np.ones(values.shape, dtype=bool)
+    tolerances = [channel_tolerance(key[1], OPTIMIZE_TOLERANCES) for key, _, _ in layout]
+    if align:
+        values = align_rotations(values, layout)
+
+    while True:
+        wanted = {}
+        for column in range(values.shape[1]):
+            x = frames[keys[:, column]]
+            wide = np.nonzero(np.diff(x) > 1.0)[0]
+            if len(wide):
+                wanted[column] = np.floor((x[wide] + x[wide + 1]) * 0.5)
+        if not wanted:
+            break
+
+        new = np.setdiff1d(np.concatenate(list(wanted.values())), frames)
+        if len(new):
+            frames = np.concatenate((frames, new))
+            values = np.concatenate((values, sample(new)))
+            keys = np.concatenate((keys, np.zeros((len(new), keys.shape[1]), dtype=bool)))
+            order = np.argsort(frames)
+            frames, values, keys = frames[order], values[order], keys[order]
+            if align:
+                values = align_rotations(values, layout)
+
+        refined = False
+        for column, mids in wanted.items():
+            x = frames[keys[:, column]]
+            y = values[keys[:, column], column]
+            rows = np.searchsorted(frames, mids)
+            missed = np.abs(values[rows, column] - hermite_values(x, y, hermite_slopes(x, y), mids)) > tolerances[column]
+            if missed.any():
+                keys[rows[missed], column] = True
+                refined = True
+        if not refined:
+            break
+
+    # The coarse samples of a hold are not needed as keys once the samples around them are known
+    fixed = np.isin(frames, np.concatenate(([first, last], anchors)))
+    for column in range(values.shape[1]):
+        keys[:, column] = select_hermite_keys(frames, values[:, column], tolerances[column], fixed)
+    profile_count("adaptive_samples", len(frames))
+    return frames, values, keys, layout
+
+def write_adaptive_channels(action, evaluate, first, last, step):
+    frames, values, keys, layout = adaptive_samples(evaluate, first, last, step)
+    for column, ((_, data_path), index, group) in enumerate(layout):
+        rows = keys[:, column]
+        write_hermite_keys(action, data_path, index, group, frames[rows], values[rows, column])
+
+def stack_sampler(obj, layers, data_paths):
+    def evaluate(frames):
+        channels = evaluate_layer_stack(obj, layers, frames, data_paths)
+        return {(obj.name, data_path): channel for data_path, channel in channels.items()}
+    return evaluate
+
+def operator_objects(context, all_selected):
+    # Objects a layer operator acts on: the active object, or every selected object
+    if not all_selected:
+        return [context.object] if context.object else []
+    objects = [obj for obj in context.selected_objects if obj != context.object]
+    if context.object and context.object.select_get():
+        objects.insert(0, context.object)
+    return objects
+
+# Bulk import of channel data into new layers. Text formats are parsed in chunks
+# into a disk backed buffer and every source is copied into the F-curves a block of
+# columns at a time, so a long take never has to fit in memory as a whole.
+IMPORT_CHUNK_FRAMES = 4096
+IMPORT_BLOCK_COLUMNS = 64
+BVH_AXES = {'X': 0, 'Y': 1, 'Z': 2}
+
+def create_layer(obj, name, action, start):
+    layers = obj.animation_layers
+    layer = layers.add()
+    layer.name = name
+
+    if obj.animation_data is None:
+        obj.animation_data_create()
+
+    track = obj.animation_data.nla_tracks.new(prev=None)
+    track.name = layer.name
+    layer.nla_track_name = track.name
+    invalidate_layer_cache(obj)
+
+    strip = track.strips.new(name=action.name, start=start, action=action)
+    strip.blend_type = 'COMBINE'
+    strip.use_auto_blend = False
+    strip.influence = 1.0
+    strip.use_animated_influence = True  # Enable animated influence by default
+
+    # Set the action's blending mode to 'COMBINE'
+    if obj.animation_data.action:
+        obj.animation_data.action_blend_type = 'COMBINE'
+
+    obj.active_animation_layer = len(layers) - 1
+    return layer
+
+def pin_strip_to_action(strip):
+    # Map action frames 1:1 onto scene frames over the action's whole key range, so
+    # keys written at scene frames play where they were written and are never clipped
+    if not any(len(fcurve.keyframe_points) for fcurve in strip.action.fcurves):
+        return
+    first, last = strip.action.frame_range
+    first = math.floor(first)
+    last = max(math.ceil(last), first + 1)
+    strip.scale = 1.0
+    strip.repeat = 1.0
+    # Grow before shrinking, so the start never passes the end
+    strip.action_frame_end = max(last, strip.action_frame_end)
+    strip.action_frame_start = first
+    strip.action_frame_end = last
+    strip.frame_end = max(last, strip.frame_end)
+    strip.frame_start = first
+    strip.frame_end = last
+
+def parse_channel_name(name):
+    # 'pose.bones["Hips"].location[0]' -> ('pose.bones["Hips"].location', 0)
+    name = name.strip()
+    if name.endswith(']'):
+        head, _, index = name[:-1].rpartition('[')
+        if index.isdigit():
+            return head, int(index)
+    return name, 0
+
+def take_columns(names):
+    columns = []
+    for name in names:
+        data_path, index = parse_channel_name(str(name))
+        columns.append((data_path, index, channel_group_name(data_path)))
+    return columns
+
+def read_channel_list(path):
+    # One channel per line, or a JSON list of channel names
+    with open(path) as handle:
+        text = handle.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [line for line in text.splitlines() if line.strip() and not line.startswith('#')]
+
+def take_buffer(rows, width):
+    # Scratch array on disk, removed once the last reference to it is gone
+    return np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+', shape=(rows, width))
+
+def read_npz_array(path, name):
+    # Stream one array out of an archive into a scratch file and map it, so a compressed
+    # take is never held in memory whole
+    with zipfile.ZipFile(path) as archive, archive.open(f"{name}.npy") as member:
+        version = np.lib.format.read_magic(member)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(member)
+        if not int(np.prod(shape)):
+            return np.empty(shape, dtype=dtype)
+        scratch = tempfile.TemporaryFile()
+        shutil.copyfileobj(member, scratch)
+    scratch.flush()
+    return np.memmap(scratch, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C')
+
+def read_numpy_take(path, channels_path=None):
+    # .npy files are memory mapped and need a channel list next to them (take.npy -> take.channels).
+    # .npz archives hold 'values' plus optional 'channels' and 'frames' arrays; 'values' is
+    # unpacked to a scratch file and mapped from there.
+    names = frames = None
+    if path.lower().endswith('.npz'):
+        values = read_npz_array(path, 'values')
+        with np.load(path) as archive:
+            if 'channels' in archive.files:
+                names = list(archive['channels'])
+            if 'frames' in archive.files:
+                frames = np.asarray(archive['frames'], dtype=np.float64)
+    else:
+        values = np.load(path, mmap_mode='r')
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+    if channels_path or names is None:
+        names = read_channel_list(channels_path or os.path.splitext(path)[0] + ".channels")
+    if len(names) != values.shape[1]:
+        raise ValueError(f"{len(names)} channel names for {values.shape[1]} columns")
+    return take_columns(names), values, frames
+
+def read_csv_take(path, chunk_frames=IMPORT_CHUNK_FRAMES):
+    # A header row names the channels; a first column called 'frame' gives the frame of every row
+    with open(path, newline='') as handle:
+        header = next(csv.reader([handle.readline()]))
+        rows = sum(1 for line in handle if line.strip())
+        has_frames = header[0].strip().lower() == 'frame'
+        names = header[1:] if has_frames else header
+        if not rows:
+            raise ValueError(f"No rows in {path}")
+
+        handle.seek(0)
+        handle.readline()
+        data = take_buffer(rows, len(header))
+        row = 0
+        while row < rows:
+            lines = [line for line in islice(handle, chunk_frames) if line.strip()]
+            if not lines:
+                break
+            chunk = np.loadtxt(lines, delimiter=',', ndmin=2, dtype=np.float32)
+            data[row:row + len(chunk)] = chunk
+            row += len(chunk)
+    if has_frames:
+        return take_columns(names), data[:, 1:], np.asarray(data[:, 0], dtype=np.float64)
+    return take_columns(names), data, None
+
+def read_bvh_header(handle):
+    joints = []
+    stack = []
+    pending = None
+    channel_count = 0
+    for line in handle:
+        tokens = line.split()
+        if not tokens:
+            continue
+        key = tokens[0].upper()
+        if key in {'ROOT', 'JOINT'}:
+            pending = {"name": " ".join(tokens[1:]), "channels": [], "start": 0}
+            joints.append(pending)
+        elif key == 'END':
+            pending = None
+        elif key == '{':
+            stack.append(pending)
+        elif key == '}':
+            stack.pop()
+        elif key == 'CHANNELS':
+            pending["channels"] = [name.upper() for name in tokens[2:2 + int(tokens[1])]]
+            pending["start"] = channel_count
+            channel_count += int(tokens[1])
+        elif key == 'MOTION':
+            break
+    frame_count = int(handle.readline().split(':')[1])
+    frame_time = float(handle.readline().split(':')[1])
+    return joints, channel_count, frame_count, frame_time
+
+def axis_rotation_matrices(axis, angles):
+    c, s = np.cos(angles), np.sin(angles)
+    m = np.zeros((len(angles), 3, 3))
+    i, j = [a for a in range(3) if a != axis]
+    m[:, axis, axis] = 1.0
+    m[:, i, i] = c
+    m[:, j, j] = c
+    m[:, j, i] = s
+    m[:, i, j] = -s
+    return m
+
+def bvh_targets(obj, joints):
+    # Joints are matched to pose bones by name; their channels follow each bone's rotation mode
+    targets = []
+    columns = []
+    for joint in joints:
+        bone = obj.pose.bones.get(joint["name"])
+        if not bone or not joint["channels"]:
+            continue
+        props = []
+        if any(name.endswith('POSITION') for name in joint["channels"]):
+            props.append(('location', 3))
+        if bone.rotation_mode == 'QUATERNION':
+            props.append(('rotation_quaternion', 4))
+        elif bone.rotation_mode == 'AXIS_ANGLE':
+            props.append(('rotation_axis_angle', 4))
+        else:
+            props.append(('rotation_euler', 3))
+        prefix = bone_data_path(bone.name)
+        columns.extend((f"{prefix}.{prop}", index, bone.name) for prop, size in props for index in range(size))
+        targets.append((joint, bone, props))
+    return targets, columns
+
+def bvh_pose_channels(targets, motion, scale):
+    # Same conversion as Blender's BVH importer: BVH rotations are taken into each
+    # bone's rest orientation and positions are made relative to the bone's rest head
+    count = len(motion)
+    pieces = []
+    for joint, bone, props in targets:
+        rotation = np.broadcast_to(np.eye(3), (count, 3, 3))
+        location = np.zeros((count, 3))
+        for offset, name in enumerate(joint["channels"]):
+            values = motion[:, joint["start"] + offset].astype(np.float64)
+            if name.endswith('ROTATION'):
+                rotation = rotation @ axis_rotation_matrices(BVH_AXES[name[0]], np.radians(values))
+            elif name.endswith('POSITION'):
+                location[:, BVH_AXES[name[0]]] = values * scale
+
+        rest = np.array(bone.bone.matrix_local)[:3, :3]
+        rest_inverse = np.linalg.inv(rest)
+        local = np.zeros((count, 4, 4))
+        local[:, :3, :3] = rest_inverse @ rotation @ rest
+        local[:, :3, 3] = (location - np.array(bone.bone.head_local)) @ rest_inverse.T
+        local[:, 3, 3] = 1.0
+        channels = matrices_to_channels(local, bone.rotation_mode)
+        pieces.extend(channels[prop] for prop, _ in props)
+    return np.column_stack(pieces)
+
+def join_rotation_chunk(values, previous, columns):
+    # Chunks are converted on their own, so keep rotations continuous with the row before them
+    groups = {}
+    for column, (data_path, _, _) in enumerate(columns):
+        groups.setdefault(data_path, []).append(column)
+    for data_path, group in groups.items():
+        prop = channel_property(data_path)
+        if prop == 'rotation_quaternion' and np.dot(values[0, group], previous[group]) < 0.0:
+            values[:, group] *= -1.0
+        elif prop == 'rotation_euler':
+            turns = np.round((previous[group] - values[0, group]) / (2.0 * np.pi))
+            values[:, group] += turns * 2.0 * np.pi
+    return values
+
+def read_bvh_take(obj, path, scale=1.0, chunk_frames=IMPORT_CHUNK_FRAMES):
+    if obj.type != 'ARMATURE':
+        raise ValueError("BVH takes are imported onto an armature with bones named like the joints")
+    with open(path) as handle:
+        joints, _, frame_count, frame_time = read_bvh_header(handle)
+        targets, columns = bvh_targets(obj, joints)
+        if not targets:
+            raise ValueError(f"No bone of '{obj.name}' matches a joint in {os.path.basename(path)}")
+        data = take_buffer(frame_count, len(columns))
+        row = 0
+        while row < frame_count:
+            motion = np.loadtxt(islice(handle, min(chunk_frames, frame_count - row)), ndmin=2)
+            if not len(motion):
+                break
+            values = bvh_pose_channels(targets, motion, scale)
+            if row:
+                values = join_rotation_chunk(values, np.asarray(data[row - 1], dtype=np.float64), columns)
+            data[row:row + len(values)] = values
+            row += len(values)
+    return columns, data[:row], frame_time
+
+def write_take(action, columns, data, frames, block=IMPORT_BLOCK_COLUMNS):
+    # Every F-curve gets all of its keys in one bulk write
+    co = np.empty((len(frames), 2), dtype=np.float32)
+    co[:, 0] = frames
+    interpolation = np.full(len(frames), KEY_LINEAR, dtype=np.int32)
+    for start in range(0, len(columns), block):
+        values = np.asarray(data[:, start:start + block], dtype=np.float32)
+        for offset, (data_path, index, group) in enumerate(columns[start:start + block]):
+            co[:, 1] = values[:, offset]
+            fcurve = action.fcurves.find(data_path, index=index)
+            if fcurve is None:
+                fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+            write_keyframes(fcurve, co, interpolation)
+
+@profiled('function')
+def import_take(context, obj, filepath, channels_path=None, frame_start=1, frame_step=1.0,
+                use_frame_time=False, scale=1.0, layer_name=None):
+    # Import a .bvh, .npy, .npz or .csv take into a new layer of obj and return the layer.
+    # Files without their own frame numbers are keyed from frame_start every frame_step frames.
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension == '.bvh':
+        columns, data, frame_time = read_bvh_take(obj, filepath, scale)
+        frames = None
+        if use_frame_time:
+            frame_step = frame_time * context.scene.render.fps / context.scene.render.fps_base
+    elif extension in {'.npy', '.npz'}:
+        columns, data, frames = read_numpy_take(filepath, channels_path)
+    elif extension == '.csv':
+        columns, data, frames = read_csv_take(filepath)
+    else:
+        raise ValueError(f"Unsupported take format '{extension}'")
+    if not len(data):
+        raise ValueError(f"No frames in {os.path.basename(filepath)}")
+    if frames is None:
+        frames = frame_start + np.arange(len(data)) * frame_step
+
+    name = layer_name or os.path.splitext(os.path.basename(filepath))[0]
+    action = new_layer_action(f"Action_{name}")
+    write_take(action, columns, data, frames)
+    layer = create_layer(obj, name, action, int(np.floor(frames[0])))
+    invalidate_evaluation_cache(obj)
+    invalidate_layer_cache(obj)
+    profile_count("keyframes_imported", len(frames) * len(columns))
+    return layer
+
+# Layer archives (.animlayers): a columnar binary file with every layer stack of a
+# set of objects. Layout:
+#   8 bytes   magic b"ANIMLAYR"
+#   uint32    format version, uint32 reserved, uint64 header size (little endian)
+#   header    UTF-8 JSON: objects -> layers -> strips, plus a list of key blocks
+#   padding   to a multiple of ARCHIVE_ALIGN
+#   data      the columns of every key block, each aligned to ARCHIVE_ALIGN
+# A key block holds the keys of one action or of one strip's own curves, channel
+# after channel. Its channel table gives every channel's key offset and count, so
+# any range of channels is a slice of each memory mapped column.
+ARCHIVE_MAGIC = b"ANIMLAYR"
+ARCHIVE_VERSION = 1
+ARCHIVE_ALIGN = 64
+ARCHIVE_COLUMNS = (
+    ("frames", "<f4", ()),
+    ("values", "<f4", ()),
+    ("handle_left", "<f4", (2,)),
+    ("handle_right", "<f4", (2,)),
+    ("interpolation", "<u1", ()),
+    ("handle_types", "<u1", (2,)),
+)
+LAYER_MASK_PROPS = ("use_mask", "mask_bone_collections", "mask_patterns", "mask_paths", "mask_invert")
+STRIP_ARCHIVE_PROPS = ("frame_start", "frame_end", "action_frame_start", "action_frame_end", "scale", "repeat",
+                       "blend_type", "extrapolation", "blend_in", "blend_out", "use_reverse", "mute",
+                       "influence", "use_animated_influence", "use_animated_time")
+
+def aligned(size):
+    return -(-size // ARCHIVE_ALIGN) * ARCHIVE_ALIGN
+
+def archive_block(fcurves, blocks, start):
+    # Lay out the columns of one key block from start; returns the offset after it
+    channels = []
+    count = 0
+    for fcurve in fcurves:
+        keys = len(fcurve.keyframe_points)
+        channels.append({"data_path": fcurve.data_path, "index": fcurve.array_index,
+                         "group": fcurve.group.name if getattr(fcurve, 'group', None) else "",
+                         "extrapolation": fcurve.extrapolation, "offset": count, "count": keys})
+        count += keys
+    columns = {}
+    for name, dtype, shape in ARCHIVE_COLUMNS:
+        columns[name] = {"offset": start, "dtype": dtype, "shape": [count, *shape]}
+        start += aligned(count * np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64)))
+    blocks.append({"channels": channels, "count": count, "columns": columns})
+    return len(blocks) - 1, start
+
+def write_archive_block(handle, data_start, block, fcurves):
+    # One block at a time, so only the keys of a single action are in memory
+    parts = {name: [] for name, _, _ in ARCHIVE_COLUMNS}
+    for fcurve in fcurves:
+        co, handle_left, handle_right, interpolation = read_keyframes(fcurve)
+        left_types, right_types = read_handle_types(fcurve)
+        parts["frames"].append(co[:, 0])
+        parts["values"].append(co[:, 1])
+        parts["handle_left"].append(handle_left)
+        parts["handle_right"].append(handle_right)
+        parts["interpolation"].append(interpolation)
+        parts["handle_types"].append(np.column_stack((left_types, right_types)))
+    for name, dtype, shape in ARCHIVE_COLUMNS:
+        column = block["columns"][name]
+        empty = np.zeros((0, *shape), dtype=dtype)
+        handle.seek(data_start + column["offset"])
+        handle.write(np.ascontiguousarray(np.concatenate(parts[name] or [empty]), dtype=dtype).tobytes())
+
+@profiled('function')
+def export_layer_archive(filepath, objects):
+    # Write the layer stacks of objects; returns the number of keys written
+    header = {"version": ARCHIVE_VERSION, "objects": [], "blocks": []}
+    pending = []
+    offset = 0
+    for obj in objects:
+        record = {"name": obj.name, "active_layer": obj.active_animation_layer, "layers": []}
+        for layer in obj.animation_layers:
+            track = get_layer_track(obj, layer)
+            layer_record = {"name": layer.name, "visible": layer.visible, "solo": layer.solo,
+                            "influence": layer.influence, "selected": layer.selected, "strips": []}
+            mask = layer_mask(obj, layer)
+            if mask is not None:
+                layer_record["mask"] = {prop: getattr(layer, prop) for prop in LAYER_MASK_PROPS}
+            for strip in (track.strips if track else ()):
+                strip_record = {prop: getattr(strip, prop) for prop in STRIP_ARCHIVE_PROPS}
+                strip_record["name"] = strip.name
+                strip_record["action"] = strip.action.name if strip.action else None
+                strip_record["action_block"] = None
+                if strip.action:
+                    # Masked out channels are left out of the archive
+                    fcurves = [fcurve for fcurve in strip.action.fcurves
+                               if mask is None or mask_allows(mask, fcurve.data_path)]
+                    strip_record["action_block"], offset = archive_block(fcurves, header["blocks"], offset)
+                    pending.append(fcurves)
+                # The strip's own curves, the animated influence among them
+                fcurves = list(strip.fcurves)
+                strip_record["strip_block"], offset = archive_block(fcurves, header["blocks"], offset)
+                pending.append(fcurves)
+                layer_record["strips"].append(strip_record)
+            record["layers"].append(layer_record)
+        header["objects"].append(record)
+
+    text = json.dumps(header).encode('utf-8')
+    data_start = aligned(24 + len(text))
+    with open(filepath, 'wb') as handle:
+        handle.write(ARCHIVE_MAGIC)
+        handle.write(np.array([ARCHIVE_VERSION, 0], dtype='<u4').tobytes())
+        handle.write(np.array([len(text)], dtype='<u8').tobytes())
+        handle.write(text)
+        for block, fcurves in zip(header["blocks"], pending):
+            write_archive_block(handle, data_start, block, fcurves)
+        handle.truncate(data_start + offset)
+    return sum(block["count"] for block in header["blocks"])
+
+def open_layer_archive(filepath):
+    # Parse the header and memory map the data; columns are only read when sliced
+    with open(filepath, 'rb') as handle:
+        if handle.read(8) != ARCHIVE_MAGIC:
+            raise ValueError(f"{os.path.basename(filepath)} is not a layer archive")
+        version = int(np.frombuffer(handle.read(8), dtype='<u4')[0])
+        if version > ARCHIVE_VERSION:
+            raise ValueError(f"Layer archive version {version} is newer than this add-on")
+        size = int(np.frombuffer(handle.read(8), dtype='<u8')[0])
+        header = json.loads(handle.read(size).decode('utf-8'))
+    data_start = aligned(24 + size)
+    data_size = os.path.getsize(filepath) - data_start
+    data = np.memmap(filepath, dtype=np.uint8, mode='r', offset=data_start) if data_size > 0 else np.zeros(0, np.uint8)
+    return {"header": header, "data": data}
+
+def archive_channels(archive, block_index, first=0, last=None):
+    # Channel records and column views for channels first..last of a key block
+    block = archive["header"]["blocks"][block_index]
+    channels = block["channels"][first:last]
+    if not channels:
+        return channels, {}
+    start = channels[0]["offset"]
+    stop = channels[-1]["offset"] + channels[-1]["count"]
+    columns = {}
+    for name, dtype, shape in ARCHIVE_COLUMNS:
+        column = block["columns"][name]
+        width = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        raw = archive["data"][column["offset"] + start * width:column["offset"] + stop * width]
+        columns[name] = raw.view(dtype).reshape(-1, *shape)
+    return channels, columns
+
+def restore_archive_curves(fcurves, archive, block_index, create=True):
+    # Recreate every channel of a block through one bulk write per F-curve. Strip
+    # curves (create False) can only be filled, not created.
+    channels, columns = archive_channels(archive, block_index)
+    base = channels[0]["offset"] if channels else 0
+    for channel in channels:
+        keys = slice(channel["offset"] - base, channel["offset"] - base + channel["count"])
+        fcurve = fcurves.find(channel["data_path"], index=channel["index"])
+        if fcurve is None:
+            if not create:
+                continue  # Strip curves only exist while their property is animated
+            fcurve = fcurves.new(channel["data_path"], index=channel["index"],
+                                 action_group=channel["group"] or channel_group_name(channel["data_path"]))
+        fcurve.extrapolation = channel["extrapolation"]
+        co = np.column_stack((columns["frames"][keys], columns["values"][keys]))
+        types = columns["handle_types"][keys]
+        write_keyframes(fcurve, co, columns["interpolation"][keys], columns["handle_left"][keys],
+                        columns["handle_right"][keys], (types[:, 0], types[:, 1]))
+    return len(channels)
+
+@profiled('function')
+def import_layer_archive(context, filepath, targets, replace=False):
+    # targets maps an archived object name to the object that receives its layers
+    archive = open_layer_archive(filepath)
+    imported = 0
+    for record in archive["header"]["objects"]:
+        obj = targets.get(record["name"])
+        if obj is None:
+            continue
+        invalidate_evaluation_cache(obj)
+        if replace:
+            while len(obj.animation_layers):
+                layer = obj.animation_layers[0]
+                track = get_layer_track(obj, layer)
+                if track:
+                    obj.animation_data.nla_tracks.remove(track)
+                while layer.versions:
+                    drop_layer_version(layer, 0)
+                obj.animation_layers.remove(0)
+            invalidate_layer_cache(obj)
+
+        with layer_state_batch(obj):
+            for layer_record in record["layers"]:
+                strips = layer_record["strips"]
+                actions = []
+                for strip_record in strips:
+                    action = new_layer_action(strip_record["action"] or f"Action_{layer_record['name']}")
+                    if strip_record["action_block"] is not None:
+                        restore_archive_curves(action.fcurves, archive, strip_record["action_block"])
+                    actions.append(action)
+                if not strips:
+                    actions.append(new_layer_action(f"Action_{layer_record['name']}"))
+                first_start = round(strips[0]["frame_start"]) if strips else context.scene.frame_start
+                layer = create_layer(obj, layer_record["name"], actions[0], first_start)
+                track = get_layer_track(obj, layer)
+                for strip_record, action in zip(strips[1:], actions[1:]):
+                    track.strips.new(name=strip_record["name"], start=round(strip_record["frame_start"]), action=action)
+                for strip, strip_record in zip(track.strips, strips):
+                    strip.name = strip_record["name"]
+                    # The strip's end follows from its action range, scale and repeat
+                    for prop in STRIP_ARCHIVE_PROPS:
+                        if prop not in {"frame_start", "frame_end"}:
+                            setattr(strip, prop, strip_record[prop])
+                    restore_archive_curves(strip.fcurves, archive, strip_record["strip_block"], create=False)
+                layer.visible = layer_record["visible"]
+                layer.solo = layer_record["solo"]
+                layer.influence = layer_record["influence"]
+                layer.selected = layer_record["selected"]
+                for prop, value in layer_record.get("mask", {}).items():
+                    setattr(layer, prop, value)
+                imported += 1
+        obj.active_animation_layer = min(record["active_layer"], len(obj.animation_layers) - 1)
+        invalidate_layer_cache(obj)
+        apply_layer_masks(obj)
+    return imported
+
+# Per-key hashes of the source F-curves at the last merge, keyed by
+# (action name, data path, array index). Only kept in memory; the layer stores digests.
+MERGE_SNAPSHOTS = {}
+# Actions edited since they were last hashed, filled by mark_dirty_actions
+DIRTY_ACTIONS = set()
+HASH_WEIGHTS = np.array([0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F, 0x165667B1, 0xD3A2646D], dtype=np.uint64)
+
+@persistent
+def mark_dirty_actions(scene, depsgraph):
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Action):
+            DIRTY_ACTIONS.add(update.id.original.name)
+
+@persistent
+def clear_merge_snapshots(*args):
+    MERGE_SNAPSHOTS.clear()
+    DIRTY_ACTIONS.clear()
+
+def fcurve_snapshot(action, fcurve):
+    snapshot = MERGE_SNAPSHOTS.get((action.name, fcurve.data_path, fcurve.array_index))
+    if snapshot is not None and action.name not in DIRTY_ACTIONS:
+        return snapshot
+    co, handle_left, handle_right, interpolation = read_keyframes(fcurve)
+    bits = np.column_stack((co, handle_left, handle_right)).view(np.uint32)
+    digest = hashlib.sha1(bits.tobytes() + interpolation.tobytes()).hexdigest()
+    hashes = (bits.astype(np.uint64) * HASH_WEIGHTS).sum(axis=1) + interpolation.astype(np.uint64)
+    bounded = fcurve_key_range(fcurve) is not None
+    return digest, hashes, co[:, 0].astype(np.float64), bounded
+
+def strip_digest(strip):
+    state = (strip.action.name, strip.frame_start, strip.frame_end, strip.scale, strip.repeat,
+             strip.use_reverse, strip.action_frame_start, strip.action_frame_end, strip.extrapolation,
+             strip.blend_type, strip.influence, strip.use_animated_influence)
+    fcurve = strip.fcurves.find('influence') if strip.use_animated_influence else None
+    keys = read_keyframes(fcurve)[0].tobytes() if fcurve else b''
+    return hashlib.sha1(repr(state).encode() + keys).hexdigest()
+
+@profiled('function')
+def collect_merge_state(obj, layers):
+    # Content hashes of everything a merge of these layers depends on
+    state = {"sources": [layer.nla_track_name for layer in layers], "tracks": {}}
+    snapshots = {}
+    for track in layer_tracks(obj, layers):
+        strips = track_strips(track)
+        actions = {}
+        for strip in strips:
+            if strip.action.name in actions:
+                continue
+            curves = actions[strip.action.name] = {}
+            for fcurve in strip.action.fcurves:
+                if fcurve.mute:
+                    continue
+                snapshot = fcurve_snapshot(strip.action, fcurve)
+                snapshots[(strip.action.name, fcurve.data_path, fcurve.array_index)] = snapshot
+                curves.setdefault(fcurve.data_path, {})[str(fcurve.array_index)] = snapshot[0]
+        state["tracks"][track.name] = {"strips": [strip_digest(strip) for strip in strips], "actions": actions}
+    return state, snapshots
+
+def changed_key_span(old, new):
+    # Action frame span affected by the keys that differ between two snapshots
+    old_hashes, new_hashes = old[1], new[1]
+    count = min(len(old_hashes), len(new_hashes))
+    same = old_hashes[:count] == new_hashes[:count]
+    prefix = count if same.all() else int(np.argmin(same))
+    same = old_hashes[::-1][:count - prefix] == new_hashes[::-1][:count - prefix]
+    suffix = len(same) if same.all() else int(np.argmin(same))
+
+    # Segments next to a changed key change shape too, so include the neighbours
+    first = -np.inf if prefix == 0 else min(old[2][prefix - 1], new[2][prefix - 1])
+    last = np.inf if suffix == 0 else max(old[2][len(old_hashes) - suffix], new[2][len(new_hashes) - suffix])
+    return first, last
+
+@profiled('function')
+def merge_dirty_spans(obj, layers, old_state, new_state, snapshots, old_snapshots=None):
+    # {data_path: None} for channels to re-evaluate entirely, {data_path: (first, last)}
+    # for channels where only a scene frame span changed
+    if old_snapshots is None:
+        old_snapshots = MERGE_SNAPSHOTS
+    dirty = {}
+
+    def mark(data_path, span):
+        if data_path in dirty:
+            if dirty[data_path] is None or span is None:
+                span = None
+            else:
+                span = (min(span[0], dirty[data_path][0]), max(span[1], dirty[data_path][1]))
+        dirty[data_path] = span
+
+    for track in layer_tracks(obj, layers):
+        old_track = old_state["tracks"].get(track.name, {"strips": None, "actions": {}})
+        new_track = new_state["tracks"][track.name]
+        full = old_track["strips"] != new_track["strips"]
+        strips = track_strips(track)
+
+        for action_name in set(old_track["actions"]) | set(new_track["actions"]):
+            old_curves = old_track["actions"].get(action_name, {})
+            new_curves = new_track["actions"].get(action_name, {})
+            for data_path in set(old_curves) | set(new_curves):
+                old_digests = old_curves.get(data_path, {})
+                new_digests = new_curves.get(data_path, {})
+                for index in set(old_digests) | set(new_digests):
+                    if old_digests.get(index) == new_digests.get(index) and not full:
+                        continue
+                    key = (action_name, data_path, int(index))
+                    old, new = old_snapshots.get(key), snapshots.get(key)
+                    if full or old is None or new is None or old[0] != old_digests.get(index) or not new[3]:
+                        mark(data_path, None)
+                        continue
+                    span = changed_key_span(old, new)
+                    for strip in strips:
+                        if strip.action.name == action_name:
+                            mark(data_path, strip_scene_range(strip, span))
+    return dirty
+
+def store_merge_state(layer, state, index, snapshots):
+    state["spans"] = {data_path: list(span) for data_path, span in index.items()}
+    layer["merge_state"] = json.dumps(state)
+    MERGE_SNAPSHOTS.update(snapshots)
+    for track in state["tracks"].values():
+        DIRTY_ACTIONS.difference_update(track["actions"])
+
+# Per-object map of NLA track name -> (track index, has keys, holds the active action),
+# keyed by object pointer. Tracks are looked up by index and checked by name on
+# access, so an outdated entry never touches a removed track.
+LAYER_TRACK_CACHE = {}
+
+def layer_track_entries(obj):
+    anim_data = obj.animation_data
+    if anim_data is None:
+        return {}
+    key = obj.as_pointer()
+    entries = LAYER_TRACK_CACHE.get(key)
+    if entries is None:
+        active_action = anim_data.action
+        entries = {}
+        for i, track in enumerate(anim_data.nla_tracks):
+            strips = track.strips
+            has_keys = any(strip.action and strip.action.fcurves for strip in strips)
+            is_active = bool(active_action and len(strips) and strips[0].action == active_action)
+            entries[track.name] = (i, has_keys, is_active)
+        LAYER_TRACK_CACHE[key] = entries
+    return entries
+
+def invalidate_layer_cache(obj=None):
+    invalidate_scene_layer_index()
+    if obj is None:
+        LAYER_TRACK_CACHE.clear()
+    else:
+        LAYER_TRACK_CACHE.pop(obj.as_pointer(), None)
+
+def get_layer_track(obj, layer):
+    entry = layer_track_entries(obj).get(layer.nla_track_name)
+    if entry is None:
+        return None
+    tracks = obj.animation_data.nla_tracks
+    if entry[0] < len(tracks):
+        track = tracks[entry[0]]
+        if track.name == layer.nla_track_name:
+            return track
+    invalidate_layer_cache(obj)
+    return tracks.get(layer.nla_track_name)
+
+def layer_track_status(obj, layer):
+    # (has keys, holds the active action) without walking strips or F-curves
+    entry = layer_track_entries(obj).get(layer.nla_track_name)
+    return (entry[1], entry[2]) if entry else (False, False)
+
+@persistent
+def update_layer_track_cache(scene, depsgraph):
+    if not LAYER_TRACK_CACHE and SCENE_LAYER_INDEX["rows"] is None:
+        return
+    for update in depsgraph.updates:
+        data = update.id.original
+        if isinstance(data, bpy.types.Action):
+            LAYER_TRACK_CACHE.clear()
+            invalidate_scene_layer_index()
+            return
+        if isinstance(data, bpy.types.Object):
+            LAYER_TRACK_CACHE.pop(data.as_pointer(), None)
+            invalidate_scene_layer_index()
+
+@persistent
+def clear_layer_track_cache(*args):
+    LAYER_TRACK_CACHE.clear()
+    invalidate_layer_masks()
+    invalidate_scene_layer_index()
+
+# Compiled channel masks by (object pointer, track name). A mask is compiled when
+# its layer's mask settings are applied and answers lookups from a per-path memo.
+LAYER_MASKS = {}
+
+def mask_bone_names(obj, collection_names):
+    if obj.type != 'ARMATURE' or not collection_names:
+        return frozenset()
+    armature = obj.data
+    if hasattr(armature, 'collections_all'):
+        bones = set()
+        for name in collection_names:
+            collection = armature.collections_all.get(name)
+            if collection:
+                bones.update(bone.name for bone in collection.bones)
+        return frozenset(bones)
+    # Bone groups before Blender 4.0
+    return frozenset(bone.name for bone in obj.pose.bones if bone.bone_group and bone.bone_group.name in collection_names)
+
+def split_mask_list(text):
+    return [item.strip() for item in text.split(',') if item.strip()]
+
+def compile_layer_mask(obj, layer):
+    patterns = split_mask_list(layer.mask_patterns)
+    paths = json.loads(layer.mask_paths) if layer.mask_paths else []
+    return {
+        "bones": mask_bone_names(obj, set(split_mask_list(layer.mask_bone_collections))),
+        "paths": frozenset(paths),
+        "prefixes": tuple(prefix for path in paths for prefix in (path + ".", path + "[")),
+        "pattern": re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns)) if patterns else None,
+        "invert": layer.mask_invert,
+        "memo": {},
+    }
+
+def layer_mask(obj, layer):
+    # The compiled mask of a layer, None when the layer affects every channel
+    if not layer.use_mask:
+        return None
+    key = (obj.as_pointer(), layer.nla_track_name)
+    mask = LAYER_MASKS.get(key)
+    if mask is None:
+        mask = LAYER_MASKS[key] = compile_layer_mask(obj, layer)
+    return mask
+
+def mask_allows(mask, data_path):
+    allowed = mask["memo"].get(data_path)
+    if allowed is None:
+        bone = channel_group_name(data_path) if data_path.startswith('pose.bones["') else None
+        pattern = mask["pattern"]
+        matched = (bone in mask["bones"] or data_path in mask["paths"] or data_path.startswith(mask["prefixes"])
+                   or bool(pattern and (pattern.match(data_path) or (bone and pattern.match(bone)))))
+        allowed = mask["memo"][data_path] = matched != mask["invert"]
+    return allowed
+
+def mask_allows_bone(mask, bone_name):
+    prefix = bone_data_path(bone_name)
+    return any(mask_allows(mask, f"{prefix}.{prop}") for prop in OBJECT_TRANSFORM_PATHS)
+
+def invalidate_layer_masks(obj=None):
+    if obj is None:
+        LAYER_MASKS.clear()
+        return
+    pointer = obj.as_pointer()
+    for key in [key for key in LAYER_MASKS if key[0] == pointer]:
+        del LAYER_MASKS[key]
+
+@profiled('function')
+def apply_layer_mask(obj, layer):
+    # Mute the layer's F-curves outside its mask, so the NLA, merges and bakes skip
+    # them. Curves the user muted stay muted when the mask is cleared.
+    LAYER_MASKS.pop((obj.as_pointer(), layer.nla_track_name), None)
+    mask = layer_mask(obj, layer)
+    track = get_layer_track(obj, layer)
+    if not track:
+        return False
+    masked = set(json.loads(layer.masked_curves)) if layer.masked_curves else set()
+    muted = []
+    changed = False
+    if mask is not None:
+        # Muting curves of an action other layers or objects use would mask them too,
+        # so the layer gets its own copy first
+        for action in dict.fromkeys(strip.action for strip in track.strips if strip.action):
+            own_users = sum(strip.action == action for strip in track.strips)
+            if action.users - action.use_fake_user <= own_users or all(
+                    fcurve.mute or mask_allows(mask, fcurve.data_path) for fcurve in action.fcurves):
+                continue
+            single = action.copy()
+            for strip in track.strips:
+                if strip.action == action:
+                    strip.action = single
+            if layer.get("original_action_name") == action.name:
+                layer["original_action_name"] = single.name
+            invalidate_layer_cache(obj)
+    for action in dict.fromkeys(strip.action for strip in track.strips if strip.action):
+        for fcurve in action.fcurves:
+            key = f"{fcurve.data_path}[{fcurve.array_index}]"
+            if mask is not None and not mask_allows(mask, fcurve.data_path):
+                if not fcurve.mute:
+                    fcurve.mute = True
+                    changed = True
+                    muted.append(key)
+                elif key in masked:
+                    muted.append(key)
+            elif key in masked and fcurve.mute:
+                fcurve.mute = False
+                changed = True
+    layer.masked_curves = json.dumps(muted) if muted else ""
+    if changed:
+        invalidate_evaluation_cache(obj)
+        obj.update_tag(refresh={'TIME'})
+    return changed
+
+def apply_layer_masks(obj):
+    # New curves from edits, keys or merges start unmuted, so masks are re-applied after operators
+    for layer in obj.animation_layers:
+        if layer.use_mask or layer.masked_curves:
+            apply_layer_mask(obj, layer)
+
+# Layers of every object in a scene for the scene layer view. The index is rebuilt
+# on the first draw after a change and the filtered, sorted view is kept until the
+# index or the filter settings change, so a redraw only touches the rows it shows.
+SCENE_LAYER_INDEX = {"scene": None, "rows": None, "view": None, "view_key": None}
+LAYER_STATE_FILTERS = [
+    ('ALL', "All", "Every layer"),
+    ('VISIBLE', "Visible", "Layers that are shown"),
+    ('HIDDEN', "Hidden", "Layers that are hidden"),
+    ('SOLO', "Solo", "Soloed layers"),
+    ('KEYED', "Has Keys", "Layers whose action has keys"),
+    ('EDITING', "Editing", "Layers in edit mode"),
+]
+
+def layer_state_matches(state, visible, solo, keyed, editing):
+    return {'ALL': True, 'VISIBLE': visible, 'HIDDEN': not visible, 'SOLO': solo,
+            'KEYED': keyed, 'EDITING': editing}[state]
+
+def invalidate_scene_layer_index():
+    SCENE_LAYER_INDEX["rows"] = None
+    SCENE_LAYER_INDEX["view"] = None
+
+def scene_layer_rows(scene):
+    if SCENE_LAYER_INDEX["rows"] is None or SCENE_LAYER_INDEX["scene"] != scene.as_pointer():
+        rows = []
+        for obj in scene.objects:
+            layers = obj.animation_layers
+            if not layers:
+                continue
+            entries = layer_track_entries(obj)
+            for index, layer in enumerate(layers):
+                entry = entries.get(layer.nla_track_name)
+                rows.append({"object": obj.name, "index": index, "name": layer.name, "visible": layer.visible,
+                             "solo": layer.solo, "influence": layer.influence, "keyed": bool(entry and entry[1]),
+                             "editing": layer.is_editing})
+        SCENE_LAYER_INDEX.update(scene=scene.as_pointer(), rows=rows, view=None)
+        profile_count("scene_index_rebuilds")
+    return SCENE_LAYER_INDEX["rows"]
+
+def scene_layer_view(scene, settings):
+    rows = scene_layer_rows(scene)
+    key = (settings.index_filter_name.lower(), settings.index_filter_state, settings.index_sort, settings.index_sort_reverse)
+    if SCENE_LAYER_INDEX["view"] is None or SCENE_LAYER_INDEX["view_key"] != key:
+        text, state, sort, reverse = key
+        view = [row for row in rows
+                if (not text or text in row["name"].lower() or text in row["object"].lower())
+                and layer_state_matches(state, row["visible"], row["solo"], row["keyed"], row["editing"])]
+        if sort == 'NAME':
+            view.sort(key=lambda row: (row["name"].lower(), row["object"]), reverse=reverse)
+        elif sort == 'INFLUENCE':
+            view.sort(key=lambda row: row["influence"], reverse=reverse)
+        elif reverse:
+            view.reverse()
+        SCENE_LAYER_INDEX.update(view=view, view_key=key)
+    return SCENE_LAYER_INDEX["view"]
+
+# Influence changes staged while the slider is dragged, committed once the
+# slider has been idle for INFLUENCE_COMMIT_DELAY seconds.
+# Keyed by (object name, track name) -> {frame: value}
+PENDING_INFLUENCE_KEYS = {}
+INFLUENCE_COMMIT_DELAY = 0.3
+INFLUENCE_STAGING = {"last_change": 0.0}
+
+def key_track_influence(track, frames, values):
+    for strip in track.strips:
+        if strip.mute:
+            continue
+        strip.use_animated_influence = True
+        fcurve = strip.fcurves.find('influence')
+        if fcurve:
+            upsert_keyframes(fcurve, frames, values)
+    invalidate_evaluation_cache(track.id_data)
+
+def stage_influence_key(obj, layer, frame, value):
+    track = get_layer_track(obj, layer)
+    if not track:
+        return
+    # Show the value live without keying it; the animated influence is restored on commit
+    for strip in track.strips:
+        if not strip.mute:
+            strip.use_animated_influence = False
+            strip.influence = value
+    PENDING_INFLUENCE_KEYS.setdefault((obj.name, layer.nla_track_name), {})[frame] = value
+    INFLUENCE_STAGING["last_change"] = time.monotonic()
+    if not bpy.app.timers.is_registered(commit_influence_keys):
+        bpy.app.timers.register(commit_influence_keys, first_interval=INFLUENCE_COMMIT_DELAY)
+
+@profiled('function')
+def flush_influence_keys(push_undo=True):
+    pending = dict(PENDING_INFLUENCE_KEYS)
+    PENDING_INFLUENCE_KEYS.clear()
+    for (object_name, track_name), keys in pending.items():
+        obj = bpy.data.objects.get(object_name)
+        track = obj.animation_data.nla_tracks.get(track_name) if obj and obj.animation_data else None
+        if track:
+            frames = sorted(keys)
+            key_track_influence(track, frames, [keys[frame] for frame in frames])
+    if pending and push_undo:
+        try:
+            bpy.ops.ed.undo_push(message="Layer Influence")
+        except RuntimeError:
+            pass
+
+def commit_influence_keys():
+    idle = time.monotonic() - INFLUENCE_STAGING["last_change"]
+    if idle < INFLUENCE_COMMIT_DELAY:
+        return INFLUENCE_COMMIT_DELAY - idle
+    flush_influence_keys()
+    return None
+
+@persistent
+def flush_influence_keys_on_save(*args):
+    flush_influence_keys(push_undo=False)
+
+@persistent
+def discard_influence_keys(*args):
+    PENDING_INFLUENCE_KEYS.clear()
+
+# Objects whose transforms changed since the last live key commit
+PENDING_LIVE_KEYS = set()
+LIVE_KEY_DELAY = 0.3
+LIVE_KEY_TOLERANCE = 1e-4
+LIVE_KEY_STAGING = {"last_change": 0.0, "frame": None}
+ROTATION_PATHS = {'QUATERNION': 'rotation_quaternion', 'AXIS_ANGLE': 'rotation_axis_angle'}
+KEYING_CHANNELS = {
+    'LOC_ROT_SCALE': ('location', 'rotation', 'scale'),
+    'LOCATION': ('location',),
+    'ROTATION': ('rotation',),
+    'SCALE': ('scale',),
+}
+
+def keying_paths(obj, channels, action=None):
+    # Data paths of the selected pose bones in pose mode, otherwise of the object itself
+    if obj.type == 'ARMATURE' and obj.mode == 'POSE':
+        owners = [(bone_data_path(bone.name) + ".", bone.rotation_mode) for bone in obj.pose.bones if bone.bone.select]
+    else:
+        owners = [("", obj.rotation_mode)]
+    if channels == 'AVAILABLE':
+        keyed = dict.fromkeys(fcurve.data_path for fcurve in action.fcurves) if action else {}
+        if obj.type == 'ARMATURE' and obj.mode == 'POSE':
+            return [path for path in keyed if any(path.startswith(prefix) for prefix, _ in owners)]
+        return [path for path in keyed if not path.startswith('pose.bones["')]
+    paths = []
+    for prefix, rotation_mode in owners:
+        for prop in KEYING_CHANNELS[channels]:
+            if prop == 'rotation':
+                prop = ROTATION_PATHS.get(rotation_mode, 'rotation_euler')
+            paths.append(prefix + prop)
+    return paths
+
+def channel_value(obj, data_path):
+    owner, name, item = resolve_channel(obj, data_path)
+    value = owner[name] if item else getattr(owner, name)
+    return np.array(value, dtype=np.float64).reshape(1, -1)
+
+@profiled('function')
+def key_layer_channels(obj, layer, frame, data_paths, only_changed=False):
+    # Key the current values of data_paths into the layer's own action as the
+    # layer values that reproduce them on top of the other visible layers.
+    # Returns the number of channels keyed.
+    track = get_layer_track(obj, layer)
+    if not track:
+        return 0
+    frames = np.array([float(frame)])
+    strips = track_strips(track)
+    for i, strip in enumerate(strips):
+        next_start = strips[i + 1].frame_start if i + 1 < len(strips) else None
+        action_frames, active = strip_action_frames(strip, frames, next_start)
+        if active[0] and strip.action:
+            break
+    else:
+        return 0
+    influence = strip_influence(strip, frames)
+    if influence[0] <= 1e-6:
+        return 0
+
+    mask = layer_mask(obj, layer)
+    current = {}
+    for data_path in data_paths:
+        if mask is not None and not mask_allows(mask, data_path):
+            continue
+        try:
+            current[data_path] = channel_value(obj, data_path)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            continue
+    entries = layer_track_entries(obj)
+    position = entries[layer.nla_track_name][0]
+    others = [other for other in obj.animation_layers
+              if other.visible and other != layer and other.nla_track_name in entries]
+    below = evaluate_layer_stack(obj, [other for other in others if entries[other.nla_track_name][0] < position],
+                                 frames, current)
+    above = evaluate_layer_stack(obj, [other for other in others if entries[other.nla_track_name][0] > position],
+                                 frames, current)
+    shown = evaluate_layer_stack(obj, others + [layer], frames, current) if only_changed else {}
+
+    action = strip.action
+    keyed = 0
+    for data_path, value in current.items():
+        size = value.shape[1]
+        defaults = channel_defaults(data_path, size)
+        mix_mode = channel_mix_mode(data_path)
+        if only_changed:
+            result = shown[data_path][0] if data_path in shown else defaults[None]
+            change = np.abs(value - result)
+            if mix_mode == 'QUATERNION':
+                change = np.minimum(change, np.abs(value + result))
+            if change.max() <= LIVE_KEY_TOLERANCE:
+                continue
+
+        # Take the layers above off the shown value, then solve for this layer's value
+        top = above[data_path][0] if data_path in above else defaults[None]
+        if mix_mode == 'QUATERNION':
+            value = quaternion_multiply(value, quaternion_inverse(top))
+        else:
+            value = extract_combine_delta(top, value, mix_mode, defaults)
+        lower = below[data_path][0] if data_path in below else defaults[None]
+        local = unblend_values(lower, value, influence, strip.blend_type, mix_mode, defaults)[0]
+
+        fcurves = [action.fcurves.find(data_path, index=index) for index in range(size)]
+        if mix_mode == 'QUATERNION' and all(fcurves):
+            # Stay in the hemisphere of the keys around this frame
+            previous = np.array([evaluate_fcurve(fcurve, action_frames)[0] for fcurve in fcurves])
+            if np.dot(previous, local) < 0.0:
+                local = -local
+        group = channel_group_name(data_path)
+        for index, fcurve in enumerate(fcurves):
+            if fcurve is None:
+                fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+            upsert_keyframes(fcurve, action_frames, local[index:index + 1])
+        keyed += 1
+
+    if keyed:
+        action.update_tag()
+        invalidate_evaluation_cache(obj)
+        invalidate_layer_cache(obj)
+    profile_count("live_keys", keyed)
+    return keyed
+
+@persistent
+def stage_live_keys(scene, depsgraph):
+    if not scene.animation_layer_settings.live_keying:
+        return
+    # Playback and scrubbing also update transforms, only a change on the same frame is a pose edit
+    if LIVE_KEY_STAGING["frame"] != scene.frame_current:
+        LIVE_KEY_STAGING["frame"] = scene.frame_current
+        PENDING_LIVE_KEYS.clear()
+        return
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Object) and (update.is_updated_transform or update.is_updated_geometry):
+            obj = update.id.original
+            if obj.animation_layers:
+                PENDING_LIVE_KEYS.add(obj.name)
+    if PENDING_LIVE_KEYS:
+        # Commit once the transform has settled, not on every step of a drag
+        LIVE_KEY_STAGING["last_change"] = time.monotonic()
+        if not bpy.app.timers.is_registered(commit_live_keys):
+            bpy.app.timers.register(commit_live_keys, first_interval=LIVE_KEY_DELAY)
+
+@profiled('function')
+def flush_live_keys(push_undo=True):
+    pending = list(PENDING_LIVE_KEYS)
+    PENDING_LIVE_KEYS.clear()
+    scene = bpy.context.scene
+    if scene is None or any(screen.is_animation_playing for screen in bpy.data.screens):
+        return
+    keyed = 0
+    for object_name in pending:
+        obj = bpy.data.objects.get(object_name)
+        if not obj or not obj.animation_layers or not obj.select_get():
+            continue
+        # An active action or tweaked strip is part of the shown pose but not of the
+        # layer solve, so its motion would be keyed into the layer
+        anim_data = obj.animation_data
+        if anim_data and (anim_data.action or anim_data.use_tweak_mode):
+            continue
+        layer = obj.animation_layers[obj.active_animation_layer]
+        if layer.is_editing:
+            continue  # Keys go to the working action while editing
+        keyed += key_layer_channels(obj, layer, scene.frame_current, keying_paths(obj, 'LOC_ROT_SCALE'),
+                                    only_changed=True)
+    if keyed and push_undo:
+        try:
+            bpy.ops.ed.undo_push(message="Key Layer")
+        except RuntimeError:
+            pass
+
+def commit_live_keys():
+    idle = time.monotonic() - LIVE_KEY_STAGING["last_change"]
+    if idle < LIVE_KEY_DELAY:
+        return LIVE_KEY_DELAY - idle
+    flush_live_keys()
+    return None
+
+@persistent
+def discard_live_keys(*args):
+    PENDING_LIVE_KEYS.clear()
+    LIVE_KEY_STAGING["frame"] = None
+
+# Depth of nested suspend_layer_updates() blocks; the layer property callbacks
+# do nothing while it is above zero
+LAYER_UPDATE_STATE = {"suspended": 0}
+
+@contextmanager
+def suspend_layer_updates():
+    LAYER_UPDATE_STATE["suspended"] += 1
+    try:
+        yield
+    finally:
+        LAYER_UPDATE_STATE["suspended"] -= 1
+
+@profiled('function')
+def apply_layer_mute_state(obj):
+    # Sync every layer track's mute with its layer in one pass, touching only
+    # the tracks that differ, and tag a single animation update
+    changed = False
+    for layer in obj.animation_layers:
+        track = get_layer_track(obj, layer)
+        if track and track.mute == layer.visible:
+            track.mute = not layer.visible
+            changed = True
+    if changed:
+        obj.update_tag(refresh={'TIME'})
+    return changed
+
+@contextmanager
+def layer_state_batch(obj):
+    # Change any number of layer states on obj with the callbacks suspended,
+    # then apply the resulting track state once:
+    #     with layer_state_batch(obj):
+    #         for layer in obj.animation_layers:
+    #             layer.visible = layer.selected
+    with suspend_layer_updates():
+        yield
+    apply_layer_mute_state(obj)
+
+# Layer stack snapshots. A state is {"layers": [[track, visible, solo, influence,
+# strips]], "tracks": [track names in NLA order]} with one [action, influence,
+# animated influence, mute] record per strip, stored as compact JSON on the object.
+LAYER_STATE_FIELDS = ("track", "visible", "solo", "influence", "strips")
+
+def capture_layer_state(obj):
+    layers = []
+    for layer in obj.animation_layers:
+        track = get_layer_track(obj, layer)
+        # The static influence only matters while the influence isn't animated
+        strips = [[strip.action.name if strip.action else None,
+                   None if strip.use_animated_influence else round(strip.influence, 6),
+                   strip.use_animated_influence, strip.mute] for strip in (track.strips if track else ())]
+        layers.append([layer.nla_track_name, layer.visible, layer.solo, round(layer.influence, 6), strips])
+    names = {layer.nla_track_name for layer in obj.animation_layers}
+    tracks = [track.name for track in obj.animation_data.nla_tracks if track.name in names] if obj.animation_data else []
+    return {"layers": layers, "tracks": tracks}
+
+def diff_layer_state(current, target):
+    # What has to change to get from current to target: {"layers": {track: {field: value}},
+    # "order": layer order or None, "tracks": track order or None}. Strip changes are
+    # {strip index: record}. Layers missing on either side are left alone.
+    now = {record[0]: record for record in current["layers"]}
+    layers = {}
+    for record in target["layers"]:
+        old = now.get(record[0])
+        if old is None:
+            continue
+        fields = {}
+        for i, field in enumerate(LAYER_STATE_FIELDS[1:4], 1):
+            if record[i] != old[i]:
+                fields[field] = record[i]
+        strips = {index: strip for index, (strip, old_strip) in enumerate(zip(record[4], old[4])) if strip != old_strip}
+        if strips:
+            fields["strips"] = strips
+        if fields:
+            layers[record[0]] = fields
+
+    order = [record[0] for record in target["layers"] if record[0] in now]
+    present = [record[0] for record in current["layers"] if record[0] in set(order)]
+    tracks = [name for name in target["tracks"] if name in now]
+    present_tracks = [name for name in current["tracks"] if name in set(tracks)]
+    return {"layers": layers, "order": order if order != present else None,
+            "tracks": tracks if tracks != present_tracks else None}
+
+@profiled('function')
+def apply_layer_state(obj, state):
+    # Touch only the layers, strips and tracks that differ from state, in one batched
+    # update. Returns the number of changed properties.
+    diff = diff_layer_state(capture_layer_state(obj), state)
+    changes = 0
+    with layer_state_batch(obj):
+        for layer in obj.animation_layers:
+            fields = diff["layers"].get(layer.nla_track_name)
+            if not fields or layer.is_editing:
+                continue
+            for field in ("visible", "solo", "influence"):
+                if field in fields:
+                    setattr(layer, field, fields[field])
+                    changes += 1
+            track = get_layer_track(obj, layer)
+            for index, (action_name, influence, animated, mute) in fields.get("strips", {}).items():
+                strip = track.strips[index]
+                action = bpy.data.actions.get(action_name) if action_name else None
+                if action is not None and strip.action != action:
+                    strip.action = action
+                    changes += 1
+                if strip.use_animated_influence != animated:
+                    strip.use_animated_influence = animated
+                    changes += 1
+                if not animated and round(strip.influence, 6) != influence:
+                    strip.influence = influence
+                    changes += 1
+                if strip.mute != mute:
+                    strip.mute = mute
+                    changes += 1
+
+    layers = obj.animation_layers
+    if diff["order"]:
+        active = layers[obj.active_animation_layer].nla_track_name if layers else None
+        names = [layer.nla_track_name for layer in layers]
+        for position, name in enumerate(diff["order"]):
+            index = names.index(name)
+            if index != position:
+                layers.move(index, position)
+                names.insert(position, names.pop(index))
+                changes += 1
+        obj.active_animation_layer = names.index(active)
+    if diff["tracks"]:
+        tracks = obj.animation_data.nla_tracks
+        names = [track.name for track in tracks]
+        # Only the layer tracks are put in order, among the slots they already take
+        slots = sorted(names.index(name) for name in diff["tracks"])
+        for slot, name in zip(slots, diff["tracks"]):
+            index = names.index(name)
+            if index != slot:
+                tracks.move(index, slot)
+                names.insert(slot, names.pop(index))
+                changes += 1
+    if changes:
+        invalidate_layer_cache(obj)
+        invalidate_evaluation_cache(obj)
+        obj.update_tag(refresh={'TIME'})
+    return changes
+
+# Evaluated layer stacks by object pointer, least recently used first. While an
+# object's entry is in use its layer tracks are muted and frame changes write the
+# cached values instead of letting the NLA evaluate every strip.
+LAYER_EVAL_CACHE = OrderedDict()
+# Edit counter per action name, so every cache entry can tell which actions changed since it was built
+ACTION_EDITS = {}
+
+def resolve_channel(obj, data_path):
+    # (owner, attribute, is custom property) that a data path writes to
+    if data_path.endswith('"]'):
+        split = data_path.rfind('["')
+        owner_path, name, item = data_path[:split], data_path[split + 2:-2], True
+    else:
+        owner_path, _, name = data_path.rpartition('.')
+        item = False
+    owner = obj.path_resolve(owner_path) if owner_path else obj
+    return owner, name, item
+
+def plan_cache_writes(obj, entry):
+    # Bone transforms are written with one foreach_set per property, anything else one by one
+    bone_writes = {}
+    other_writes = []
+    pose_bones = obj.pose.bones if obj.pose else None
+    for data_path in entry["values"]:
+        prop = channel_property(data_path)
+        if pose_bones is not None and data_path.startswith('pose.bones["') and prop in OBJECT_TRANSFORM_PATHS:
+            row = pose_bones.find(channel_group_name(data_path))
+            if row >= 0 and data_path == f"{bone_data_path(pose_bones[row].name)}.{prop}":
+                bone_writes.setdefault(prop, []).append((row, data_path))
+                continue
+        try:
+            other_writes.append((data_path,) + resolve_channel(obj, data_path))
+        except ValueError:
+            continue  # Path no longer exists, the NLA would not write it either
+    entry["bone_writes"] = bone_writes
+    entry["other_writes"] = other_writes
+    entry["bytes"] = sum(values.nbytes for values in entry["values"].values()) + sum(
+        snapshot[1].nbytes + snapshot[2].nbytes for snapshot in entry["snapshots"].values())
+    entry["seen"] = {name: ACTION_EDITS.get(name, 0) for track in entry["state"]["tracks"].values()
+                     for name in track["actions"]}
+
+def strip_curves_fingerprint(strip):
+    # The influence curve lives on the strip, so its edits never show up as action updates
+    return tuple(hash(np.concatenate(read_keyframes(fcurve)[:3]).tobytes()) for fcurve in strip.fcurves)
+
+def strip_layout(obj, layers):
+    # Cheap per-frame check for strip changes that are not edits to an action. An animated
+    # influence is read at the current frame, so only its curve is compared.
+    return tuple((strip.action.name, strip.frame_start, strip.frame_end, strip.scale, strip.repeat,
+                  strip.use_reverse, strip.action_frame_start, strip.action_frame_end, strip.blend_in,
+                  strip.blend_out, strip.use_animated_influence, strip.blend_type, strip.extrapolation,
+                  None if strip.use_animated_influence else strip.influence, strip_curves_fingerprint(strip))
+                 for track in layer_tracks(obj, layers) for strip in track_strips(track))
+
+@profiled('function')
+def build_evaluation_cache(obj, layers, frame_start, frame_end):
+    frames = np.arange(frame_start, frame_end + 1, dtype=np.float64)
+    state, snapshots = collect_merge_state(obj, layers)
+    channels = evaluate_layer_stack(obj, layers, frames)
+    entry = {
+        "name": obj.name,
+        "frames": frames,
+        "state": state,
+        "snapshots": snapshots,
+        "values": {data_path: values.astype(np.float32) for data_path, (values, keyed, group) in channels.items()},
+        "keyed": {data_path: sorted(keyed) for data_path, (values, keyed, group) in channels.items()},
+    }
+    plan_cache_writes(obj, entry)
+    return entry
+
+@profiled('function')
+def refresh_evaluation_cache(obj, layers, entry):
+    # Re-evaluate only the channels and frames whose keys changed
+    state, snapshots = collect_merge_state(obj, layers)
+    dirty = merge_dirty_spans(obj, layers, entry["state"], state, snapshots, entry["snapshots"])
+    frames = entry["frames"]
+    spans = {}
+    for data_path, span in dirty.items():
+        first, last = frames[0], frames[-1]
+        if span is not None:
+            first, last = max(np.floor(span[0]), first), min(np.ceil(span[1]), last)
+        if first <= last:
+            spans.setdefault((int(first), int(last)), set()).add(data_path)
+
+    for (first, last), data_paths in spans.items():
+        rows = slice(first - int(frames[0]), last - int(frames[0]) + 1)
+        channels = evaluate_layer_stack(obj, layers, frames[rows], data_paths)
+        for data_path in data_paths:
+            if data_path not in channels:
+                if rows == slice(0, len(frames)):
+                    # No layer keys this channel any more
+                    entry["values"].pop(data_path, None)
+                    entry["keyed"].pop(data_path, None)
+                continue
+            values, keyed, group = channels[data_path]
+            if data_path not in entry["values"]:
+                entry["values"][data_path] = np.empty((len(frames), values.shape[1]), dtype=np.float32)
+            entry["values"][data_path][rows] = values
+            entry["keyed"][data_path] = sorted(keyed)
+
+    entry["state"] = state
+    entry["snapshots"] = snapshots
+    plan_cache_writes(obj, entry)
+
+def cached_evaluation(obj, scene):
+    # The cache entry to play obj from, or None when the NLA has to evaluate it
+    anim_data = obj.animation_data
+    if anim_data.action or anim_data.use_tweak_mode or not anim_data.use_nla:
+        return None
+    if any(layer.is_editing for layer in obj.animation_layers):
+        return None
+    # Tracks that are not layers would be evaluated on their own
+    names = {layer.nla_track_name for layer in obj.animation_layers}
+    if any(not track.mute and track.name not in names for track in anim_data.nla_tracks):
+        return None
+
+    layers = [layer for layer in obj.animation_layers if layer.visible]
+    key = (tuple(layer.nla_track_name for layer in layers), scene.frame_start, scene.frame_end,
+           strip_layout(obj, layers))
+    pointer = obj.as_pointer()
+    entry = LAYER_EVAL_CACHE.get(pointer)
+    if entry is None or entry["key"] != key:
+        entry = build_evaluation_cache(obj, layers, scene.frame_start, scene.frame_end)
+        entry["key"] = key
+        LAYER_EVAL_CACHE[pointer] = entry
+        trim_evaluation_cache(scene.animation_layer_settings)
+    else:
+        LAYER_EVAL_CACHE.move_to_end(pointer)
+        if any(ACTION_EDITS.get(name, 0) != count for name, count in entry["seen"].items()):
+            refresh_evaluation_cache(obj, layers, entry)
+    return entry
+
+def write_cached_frame(obj, entry, row):
+    pose_bones = obj.pose.bones if obj.pose else None
+    for prop, writes in entry["bone_writes"].items():
+        buffer = entry.setdefault("buffers", {}).get(prop)
+        size = entry["values"][writes[0][1]].shape[1]
+        if buffer is None or len(buffer) != len(pose_bones) * size:
+            buffer = entry["buffers"][prop] = np.empty(len(pose_bones) * size, dtype=np.float32)
+        pose_bones.foreach_get(prop, buffer)
+        view = buffer.reshape(len(pose_bones), size)
+        for bone_row, data_path in writes:
+            keyed = entry["keyed"][data_path]
+            view[bone_row, keyed] = entry["values"][data_path][row, keyed]
+        pose_bones.foreach_set(prop, buffer)
+    for data_path, owner, name, item in entry["other_writes"]:
+        values = entry["values"][data_path][row]
+        current = owner[name] if item else getattr(owner, name)
+        if isinstance(current, (bool, int, float)):
+            value = type(current)(round(values[0]) if isinstance(current, int) else values[0])
+            if item:
+                owner[name] = value
+            else:
+                setattr(owner, name, value)
+        else:
+            for index in entry["keyed"][data_path]:
+                current[index] = type(current[index])(values[index])
+
+def mute_cached_tracks(obj, entry):
+    muted = entry.setdefault("muted", set())
+    for layer in obj.animation_layers:
+        track = get_layer_track(obj, layer) if layer.visible else None
+        if track:
+            muted.add(track.name)
+            if not track.mute:
+                track.mute = True
+
+def unmute_cached_tracks(obj, entry):
+    # Only the tracks the cache muted, other code may mute tracks on purpose (e.g. edit mode)
+    muted = entry.get("muted")
+    if not muted:
+        return
+    for layer in obj.animation_layers:
+        if layer.nla_track_name in muted:
+            track = get_layer_track(obj, layer)
+            if track:
+                track.mute = not layer.visible
+    muted.clear()
+
+def cached_object(pointer, entry):
+    obj = bpy.data.objects.get(entry["name"])
+    return obj if obj and obj.as_pointer() == pointer else None
+
+def trim_evaluation_cache(settings):
+    budget = settings.evaluation_cache_megabytes * 1024 * 1024
+    while len(LAYER_EVAL_CACHE) > 1 and sum(entry["bytes"] for entry in LAYER_EVAL_CACHE.values()) > budget:
+        release_evaluation_cache(next(iter(LAYER_EVAL_CACHE)))
+
+def release_evaluation_cache(pointer=None):
+    # Drop cache entries and hand their objects back to the NLA
+    pointers = list(LAYER_EVAL_CACHE) if pointer is None else [pointer]
+    for pointer in pointers:
+        entry = LAYER_EVAL_CACHE.pop(pointer, None)
+        obj = cached_object(pointer, entry) if entry else None
+        if obj:
+            unmute_cached_tracks(obj, entry)
+
+def invalidate_evaluation_cache(obj):
+    release_evaluation_cache(obj.as_pointer())
+
+@persistent
+def apply_evaluation_cache(scene, *args):
+    if not scene.animation_layer_settings.use_evaluation_cache:
+        return
+    frame = scene.frame_current_final
+    for obj in scene.objects:
+        if not obj.animation_layers or not obj.animation_data:
+            continue
+        entry = cached_evaluation(obj, scene)
+        if entry is None:
+            release_evaluation_cache(obj.as_pointer())
+            continue
+        # Subframes and frames outside the scene range are left to the NLA
+        row = frame - entry["frames"][0]
+        if row != int(row) or not 0 <= row < len(entry["frames"]):
+            unmute_cached_tracks(obj, entry)
+            continue
+        mute_cached_tracks(obj, entry)
+        write_cached_frame(obj, entry, int(row))
+        # The tracks are muted, so only this tag makes the evaluated pose pick up the write
+        obj.update_tag(refresh={'OBJECT'})
+
+@persistent
+def track_cache_edits(scene, depsgraph):
+    edited = set()
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Action):
+            name = update.id.original.name
+            ACTION_EDITS[name] = ACTION_EDITS.get(name, 0) + 1
+            edited.add(name)
+        elif isinstance(update.id, bpy.types.Object) and update.id.original.as_pointer() in LAYER_EVAL_CACHE:
+            # Strip settings and influence curves are edited on the object, in the NLA or Graph Editor
+            obj = update.id.original
+            layers = [layer for layer in obj.animation_layers if layer.visible]
+            if strip_layout(obj, layers) != LAYER_EVAL_CACHE[obj.as_pointer()]["key"][3]:
+                release_evaluation_cache(obj.as_pointer())
+    if not edited:
+        return
+    # Show edits right away, the cache catches up on the next frame change
+    for pointer, entry in LAYER_EVAL_CACHE.items():
+        obj = cached_object(pointer, entry) if edited.intersection(entry["seen"]) else None
+        if obj:
+            unmute_cached_tracks(obj, entry)
+
+@persistent
+def restore_cached_tracks(*args):
+    # Files are always saved with the layer tracks in their real mute state
+    for pointer, entry in LAYER_EVAL_CACHE.items():
+        obj = cached_object(pointer, entry)
+        if obj:
+            unmute_cached_tracks(obj, entry)
+
+@persistent
+def clear_evaluation_cache(*args):
+    # Undo can reallocate objects, so they are found by name only
+    for entry in LAYER_EVAL_CACHE.values():
+        obj = bpy.data.objects.get(entry["name"])
+        if obj:
+            unmute_cached_tracks(obj, entry)
+    LAYER_EVAL_CACHE.clear()
+    ACTION_EDITS.clear()
+
+class AnimationLayerSettings(PropertyGroup):
+    coalesce_influence_keys: BoolProperty(
+        name="Coalesce Influence Keys",
+        description="Key influence changes once when the slider is released instead of on every slider step",
+        default=True
+    )
+    live_keying: BoolProperty(
+        name="Auto Key Active Layer",
+        description="Key transform changes of the selected bones or objects straight into the active layer. "
+                    "Turns Blender's own auto keying off while on, it keys into the active action instead",
+        default=False,
+        update=lambda self, context: self.update_live_keying(context)
+    )
+    affect_all_selected: BoolProperty(
+        name="Affect All Selected Objects",
+        description="Layer buttons act on every selected object instead of only the active one",
+        default=False
+    )
+    history_max_versions: IntProperty(
+        name="Versions per Layer",
+        description="Previous actions kept per layer, the least recently used are deleted first",
+        default=5,
+        min=0
+    )
+    use_evaluation_cache: BoolProperty(
+        name="Cache Layer Evaluation",
+        description="Evaluate the layers once over the scene range and play the cached result back, "
+                    "instead of evaluating every strip on each frame",
+        default=False,
+        update=lambda self, context: None if self.use_evaluation_cache else release_evaluation_cache()
+    )
+    evaluation_cache_megabytes: FloatProperty(
+        name="Cache Budget (MB)",
+        description="Memory the evaluation cache may use, the least recently played objects are dropped first",
+        default=256.0,
+        min=1.0
+    )
+    index_filter_name: StringProperty(
+        name="Filter",
+        description="Only list layers whose name or object name contains this text",
+        default=""
+    )
+    index_filter_state: EnumProperty(
+        items=LAYER_STATE_FILTERS,
+        name="Show",
+        description="Only list layers in this state",
+        default='ALL'
+    )
+    index_sort: EnumProperty(
+        items=[
+            ('OBJECT', "Object", "Objects in scene order, layers in stack order"),
+            ('NAME', "Name", "Layer name"),
+            ('INFLUENCE', "Influence", "Layer influence"),
+        ],
+        name="Sort By",
+        default='OBJECT'
+    )
+    index_sort_reverse: BoolProperty(name="Reverse", default=False)
+    index_page: IntProperty(name="Page", default=1, min=1)
+    index_page_size: IntProperty(
+        name="Rows per Page",
+        description="Layers drawn at a time in the scene layer list",
+        default=20,
+        min=5,
+        max=200
+    )
+    history_max_megabytes: FloatProperty(
+        name="History Budget (MB)",
+        description="Estimated memory the versions of one layer may use, 0 for no limit",
+        default=64.0,
+        min=0.0
+    )
+
+    def update_live_keying(self, context):
+        # Blender's auto keying would key the same change into an active action as well,
+        # so it is switched off while the layer keys and restored afterwards
+        tool_settings = context.scene.tool_settings
+        if self.live_keying:
+            self["restore_auto_key"] = tool_settings.use_keyframe_insert_auto
+            tool_settings.use_keyframe_insert_auto = False
+            LIVE_KEY_STAGING["frame"] = context.scene.frame_current
+        elif self.get("restore_auto_key"):
+            tool_settings.use_keyframe_insert_auto = True
+            self["restore_auto_key"] = False
+
+class LayerVersion(PropertyGroup):
+    action_name: StringProperty()
+    label: StringProperty()
+    created: IntProperty()
+    last_used: IntProperty()
+    size: IntProperty()
+    partial: BoolProperty(default=False)
+    channels: StringProperty()  # JSON list of the data paths a partial version holds
+
+class LayerSnapshot(PropertyGroup):
+    name: StringProperty()
+    state: StringProperty()  # Compact JSON, see capture_layer_state
+
+class AnimationLayer(PropertyGroup):
+    name: StringProperty(default="New Layer", update=lambda self, context: invalidate_scene_layer_index())
+    visible: BoolProperty(default=True, update=lambda self, context: self.update_visibility(context))
+    influence: FloatProperty(default=1.0, min=0.0, max=1.0, update=lambda self, context: self.update_influence(context))
+    nla_track_name: StringProperty()
+    selected: BoolProperty(default=False)
+    solo: BoolProperty(default=False, update=lambda self, context: self.update_solo(context))
+    is_editing: BoolProperty(default=False)
+    versions: CollectionProperty(type=LayerVersion)
+    use_mask: BoolProperty(
+        name="Channel Mask",
+        description="Limit the layer to the channels of its mask, the others are muted and skipped by merges, bakes and exports",
+        default=False,
+        update=lambda self, context: self.update_mask(context)
+    )
+    mask_bone_collections: StringProperty(
+        name="Bone Collections",
+        description="Comma separated bone collections (bone groups before Blender 4.0) whose bones the layer affects",
+        update=lambda self, context: self.update_mask(context)
+    )
+    mask_patterns: StringProperty(
+        name="Patterns",
+        description="Comma separated wildcard patterns matched against bone names and data paths, e.g. *_L, *finger*, *.rotation_*",
+        update=lambda self, context: self.update_mask(context)
+    )
+    mask_paths: StringProperty(update=lambda self, context: self.update_mask(context))  # JSON list of data paths or owner paths
+    mask_invert: BoolProperty(
+        name="Invert",
+        description="Exclude the mask channels instead of limiting the layer to them",
+        default=False,
+        update=lambda self, context: self.update_mask(context)
+    )
+    masked_curves: StringProperty()  # JSON list of the curves the mask muted
+
+    @profiled('property')
+    def update_mask(self, context):
+        if LAYER_UPDATE_STATE["suspended"]:
+            return
+        apply_layer_mask(self.id_data, self)
+
+    @profiled('property')
+    def update_visibility(self, context):
+        invalidate_scene_layer_index()
+        if LAYER_UPDATE_STATE["suspended"]:
+            return
+        obj = self.id_data
+        track = get_layer_track(obj, self)
+        if track:
+            track.mute = not self.visible
+
+    @profiled('property')
+    def update_influence(self, context):
+        invalidate_scene_layer_index()
+        if LAYER_UPDATE_STATE["suspended"]:
+            return
+        obj = self.id_data
+        # The cache mutes the tracks, hand them back to the NLA so the slider shows live
+        invalidate_evaluation_cache(obj)
+        frame = context.scene.frame_current
+        if context.scene.animation_layer_settings.coalesce_influence_keys:
+            stage_influence_key(obj, self, frame, self.influence)
+            return
+        track = get_layer_track(obj, self)
+        if track and track.strips:
+            key_track_influence(track, [frame], [self.influence])
+
+    @profiled('property')
+    def update_solo(self, context):
+        invalidate_scene_layer_index()
+        if LAYER_UPDATE_STATE["suspended"]:
+            return
+        obj = self.id_data
+        with layer_state_batch(obj):
+            if self.solo:
+                for layer in obj.animation_layers:
+                    if layer != self:
+                        layer.visible = False
+            else:
+                for layer in obj.animation_layers:
+                    layer.visible = True
+
+    def animate_influence(self, context, value):
+        obj = self.id_data
+        with suspend_layer_updates():
+            self.influence = value
+        # Key right away through the same batched path the slider commits with
+        PENDING_INFLUENCE_KEYS.pop((obj.name, self.nla_track_name), None)
+        track = get_layer_track(obj, self)
+        if track and track.strips:
+            key_track_influence(track, [context.scene.frame_current], [value])
+
+class ANIMLAYER_UL_layers(UIList):
+    filter_state: EnumProperty(items=LAYER_STATE_FILTERS, name="Show", default='ALL')
+
+    @profiled('draw')
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname):
+        if self.layout_type in {'DEFAULT', 'COMPACT'}:
+            row = layout.row(align=True)
+            row.prop(item, "selected", text="")
+            row.prop(item, "name", text="", emboss=False)
+            row.prop(item, "visible", text="", icon='HIDE_OFF' if item.visible else 'HIDE_ON', emboss=False)
+            
+            influence_row = row.row(align=True)
+            influence_row.prop(item, "influence", text="", emboss=False, slider=True)
+            
+            # Add error handling for operator creation
+            try:
+                op = influence_row.operator("animlayer.animate_influence", text="", icon='KEY_HLT')
+                if op:
+                    op.layer_name = item.name
+                else:
+                    influence_row.label(text="", icon='ERROR')
+            except Exception as e:
+                profile_event("animate_influence button failed", 'draw', error=str(e))
+                influence_row.label(text="", icon='ERROR')
+            
+            row.prop(item, "solo", text="", icon='SOLO_ON' if item.solo else 'SOLO_OFF', emboss=False)
+
+            has_keys, is_active = layer_track_status(context.object, item)
+            if is_active:
+                row.label(text="", icon='RADIOBUT_ON')
+
+            if has_keys:
+                row.label(text="", icon='KEYTYPE_KEYFRAME_VEC')
+
+    def draw_filter(self, context, layout):
+        row = layout.row(align=True)
+        row.prop(self, "filter_name", text="")
+        row.prop(self, "use_filter_invert", text="", icon='ARROW_LEFTRIGHT')
+        row = layout.row(align=True)
+        row.prop(self, "filter_state", text="")
+        row.prop(self, "use_filter_sort_alpha", text="", icon='SORTALPHA')
+        row.prop(self, "use_filter_sort_reverse", text="", icon='SORT_DESC' if self.use_filter_sort_reverse else 'SORT_ASC')
+
+    @profiled('draw')
+    def filter_items(self, context, data, propname):
+        layers = getattr(data, propname)
+        helper = bpy.types.UI_UL_list
+        if self.filter_name:
+            flags = helper.filter_items_by_name(self.filter_name, self.bitflag_filter_item, layers, "name")
+        else:
+            flags = [self.bitflag_filter_item] * len(layers)
+        if self.filter_state != 'ALL':
+            # One cache lookup for the whole list instead of an NLA query per row
+            entries = layer_track_entries(data)
+            for i, layer in enumerate(layers):
+                entry = entries.get(layer.nla_track_name)
+                if not layer_state_matches(self.filter_state, layer.visible, layer.solo,
+                                           bool(entry and entry[1]), layer.is_editing):
+                    flags[i] &= ~self.bitflag_filter_item
+        order = helper.sort_items_by_name(layers, "name") if self.use_filter_sort_alpha else []
+        return flags, order
+
+    def has_keyframes(self, context, item):
+        return layer_track_status(context.object, item)[0]
+        
+class MultiObjectOperator:
+    all_selected: BoolProperty(
+        name="All Selected Objects",
+        description="Apply the operation to every selected object in one step",
+        default=False
+    )
+    requires_layers = True
+
+    @profiled('operator')
+    def execute(self, context):
+        for obj in operator_objects(context, self.all_selected):
+            if obj.animation_layers or not self.requires_layers:
+                invalidate_evaluation_cache(obj)
+                self.execute_object(context, obj)
+                invalidate_layer_cache(obj)
+                apply_layer_masks(obj)
+        return {'FINISHED'}
+
+class ANIMLAYER_OT_animate_influence(Operator):
+    bl_idname = "animlayer.animate_influence"
+    bl_label = "Animate Influence"
+    bl_description = "Animate the influence of the layer"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    layer_name: StringProperty()
+
+    @profiled('operator')
+    def execute(self, context):
+        obj = context.object
+        layer = next((layer for layer in obj.animation_layers if layer.name == self.layer_name), None)
+        if layer:
+            layer.animate_influence(context, layer.influence)
+        else:
+            self.report({'WARNING'}, f"Layer not found: {self.layer_name}")
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+class ANIMLAYER_OT_add_layer(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.add_layer"
+    bl_label = "Add Animation Layer"
+    bl_description = "Add a new animation layer"
+    bl_options = {'REGISTER', 'UNDO'}
+    requires_layers = False
+
+    def execute_object(self, context, obj):
+        name = f"Layer {len(obj.animation_layers) + 1}"
+        # Create a default action for the new layer
+        create_layer(obj, name, new_layer_action(f"Action_{name}"), context.scene.frame_start)
+
+class ANIMLAYER_OT_remove_layer(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.remove_layer"
+    bl_label = "Remove Animation Layer"
+    bl_description = "Remove the selected animation layer"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.object.animation_layers
+
+    def execute_object(self, context, obj):
+        layers = obj.animation_layers
+        
+        for i in range(len(layers) - 1, -1, -1):
+            if layers[i].selected:
+                if obj.animation_data:
+                    nla_track = get_layer_track(obj, layers[i])
+                    if nla_track:
+                        obj.animation_data.nla_tracks.remove(nla_track)
+                while layers[i].versions:
+                    drop_layer_version(layers[i], 0)
+                layers.remove(i)
+        
+        obj.active_animation_layer = min(obj.active_animation_layer, len(layers) - 1)
+
+class ANIMLAYER_OT_assign_to_layer(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.assign_to_layer"
+    bl_label = "Assign to Layer"
+    bl_description = "Assign current animation to the active layer"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.object
+        return (obj and obj.animation_data and
+                obj.animation_layers and len(obj.animation_layers) > 0)
+
+    def execute_object(self, context, obj):
+        active_layer = obj.animation_layers[obj.active_animation_layer]
+
+        # A sparse edit only holds changes, so it is folded into the layer instead of replacing it
+        if active_layer.get("edit_mode") == 'SPARSE' and obj.animation_data:
+            track = get_layer_track(obj, active_layer)
+            if track and track.strips:
+                finish_sparse_edit(obj, active_layer, track)
+            return
+        
+        if obj.animation_data:
+            # Deactivate NLA tracks if active
+            if obj.animation_data.use_tweak_mode:
+                obj.animation_data.use_tweak_mode = False
+            
+            # If there's no current action, create a new one
+            if not obj.animation_data.action:
+                obj.animation_data.action = new_layer_action(f"Action_{active_layer.name}")
+            
+            current_action = obj.animation_data.action
+            track = get_layer_track(obj, active_layer)
+            
+            if track:
+                replaced = [strip.action for strip in track.strips if strip.action]
+
+                # Remove existing strips
+                for strip in track.strips:
+                    track.strips.remove(strip)
+                
+                # Create a new strip with the current action
+                new_strip = track.strips.new(name=current_action.name, start=context.scene.frame_start, action=current_action)
+                new_strip.blend_type = 'COMBINE'
+                new_strip.use_auto_blend = False
+                new_strip.influence = active_layer.influence
+                new_strip.use_animated_influence = True
+
+                # If we're assigning an edited action back to its original layer, replace the original action
+                if "original_action_name" in active_layer:
+                    original_action = bpy.data.actions.get(active_layer["original_action_name"])
+                    if original_action:
+                        original_action.user_remap(current_action)
+                        replaced.append(original_action)
+                    for key in ("original_action_name", "edit_action_name", "edit_mode"):
+                        if key in active_layer:
+                            del active_layer[key]
+
+                # Replaced actions go to the layer's history instead of lingering as orphans
+                for action in dict.fromkeys(replaced):
+                    if action != current_action:
+                        push_layer_version(active_layer, action, "Before assign")
+
+                # Set the action's blending mode to 'COMBINE'
+                obj.animation_data.action_blend_type = 'COMBINE'
+
+                # Clear the current action from the object
+                obj.animation_data.action = None
+
+                # Unmute the track
+                track.mute = False
+
+class ANIMLAYER_OT_edit_layer(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.edit_layer"
+    bl_label = "Edit Layer Animation"
+    bl_description = "Edit the animation in the selected layer"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    mode: EnumProperty(
+        items=[
+            ('SPARSE', "Changes Only", "Start from an empty action that only holds the curves you key, "
+                                       "the rest of the layer keeps playing underneath"),
+            ('COPY', "Full Copy", "Edit a complete copy of the layer's action"),
+        ],
+        name="Mode",
+        description="How the layer's action is opened for editing",
+        default='SPARSE'
+    )
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.object
+        return obj and obj.animation_layers and len(obj.animation_layers) > 0
+
+    def execute_object(self, context, obj):
+        active_layer = obj.animation_layers[obj.active_animation_layer]
+        
+        if obj.animation_data:
+            track = get_layer_track(obj, active_layer)
+            if track and track.strips:
+                # Unlink the current action if it exists
+                if obj.animation_data.action:
+                    obj.animation_data.action = None
+                
+                original_action = track.strips[0].action
+                if self.mode == 'SPARSE':
+                    # Keys made on top of the layer become the changes to fold back on exit
+                    new_action = new_layer_action(f"{original_action.name}_edit")
+                else:
+                    # Create a copy of the strip's action and set it as the active action
+                    new_action = new_layer_action(f"{original_action.name}_edit", original_action)
+                obj.animation_data.action = new_action
+                
+                # Set the action's blending mode to 'COMBINE'
+                obj.animation_data.action_blend_type = 'COMBINE'
+                obj.animation_data.action_influence = 1.0
+                
+                # Mute the NLA track while editing a full copy, a hidden layer stays muted
+                track.mute = self.mode == 'COPY' or not active_layer.visible
+                
+                # Store the original action name in the layer for later reference
+                active_layer["original_action_name"] = original_action.name
+                active_layer["edit_action_name"] = new_action.name
+                active_layer["edit_mode"] = self.mode
+
+                # Set editing state
+                active_layer.is_editing = True
+
+class ANIMLAYER_OT_merge_layers(Operator):
+    bl_idname = "animlayer.merge_layers"
+    bl_label = "Merge Selected Layers"
+    bl_description = "Merge all selected layers into a new layer"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    method: EnumProperty(
+        items=[
+            ('DIRECT', "Direct", "Combine the layer F-curves directly, baking only constrained or driven channels visually"),
+            ('VISUAL', "Visual Bake", "Bake the evaluated result of every frame with visual keying"),
+        ],
+        name="Method",
+        description="How the selected layers are combined",
+        default='DIRECT'
+    )
+    keep_sources: BoolProperty(
+        name="Keep Source Layers",
+        description="Hide the source layers instead of removing them and link them to the merged layer, "
+                    "so merging them again only re-evaluates the channels and frames that changed",
+        default=False
+    )
+    all_selected: BoolProperty(
+        name="All Selected Objects",
+        description="Merge the selected layers of every selected object, sharing one pass over the frame range",
+        default=False
+    )
+    sampling: EnumProperty(
+        items=[
+            ('FRAMES', "Every Frame", "Key every frame of the merged range"),
+            ('ADAPTIVE', "Adaptive", "Sample coarsely and refine only where the layered motion needs it, "
+                                     "keying Bezier curves that fit the result"),
+        ],
+        name="Sampling",
+        description="Which frames of the layered result are evaluated and keyed",
+        default='FRAMES'
+    )
+    coarse_step: IntProperty(
+        name="Coarse Step",
+        description="Frames between the first adaptive samples. Motion shorter than this between two samples can be missed",
+        default=8,
+        min=2
+    )
+    clean_curves: BoolProperty(
+        name="Optimize Result",
+        description="Remove redundant keys and unchanged channels from the merged action",
+        default=True
+    )
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.object
+        return obj and obj.animation_layers and any(layer.selected for layer in obj.animation_layers)
+
+    @profiled('operator')
+    def execute(self, context):
+        objects = [obj for obj in operator_objects(context, self.all_selected)
+                   if any(layer.selected for layer in obj.animation_layers)]
+
+        # Each object is merged on its own, then every visual channel is captured in one sweep
+        jobs = []
+        for obj in objects:
+            invalidate_evaluation_cache(obj)
+            if not obj.animation_data:
+                obj.animation_data_create()
+            anim_data = obj.animation_data
+            original_action = anim_data.action
+            original_tweak_mode = anim_data.use_tweak_mode
+            anim_data.use_tweak_mode = False
+
+            cached_layer = self.find_cached_merge(obj) if self.method == 'DIRECT' and self.keep_sources else None
+            if cached_layer:
+                job = self.remerge(context, obj, cached_layer)
+                if job is None:
+                    self.report({'WARNING'}, f"Merged layer '{cached_layer.name}' has no action to update")
+                    anim_data.use_tweak_mode = original_tweak_mode
+                    continue
+            elif self.method == 'DIRECT':
+                job = self.merge_direct(context, obj)
+            else:
+                job = self.merge_visual(context, obj)
+            job.update(obj=obj, action=original_action, tweak_mode=original_tweak_mode)
+            jobs.append(job)
+
+        self.bake_visual_channels(context, jobs)
+
+        # The bake keys every frame, most of which the optimizer can drop
+        totals = {}
+        if self.clean_curves:
+            for job in jobs:
+                for key, value in optimize_action(job["merged_action"], OPTIMIZE_TOLERANCES).items():
+                    totals[key] = totals.get(key, 0) + value
+
+        remerged = 0
+        for job in jobs:
+            obj = job["obj"]
+            if "cached_layer" in job:
+                # Spliced and rewritten keys can fall outside the strip's old range
+                pin_strip_to_action(get_layer_track(obj, job["cached_layer"]).strips[0])
+                store_merge_state(job["cached_layer"], job["state"], job["index"], job["snapshots"])
+                remerged += job["count"]
+            else:
+                self.add_merged_layer(context, obj, job["merged_action"])
+
+            # Restore original state
+            anim_data = obj.animation_data
+            if job["action"] and job["action"].users > 0:  # Check if still exists
+                anim_data.action = job["action"]
+            else:
+                anim_data.action = None
+            anim_data.use_tweak_mode = job["tweak_mode"]
+            obj.active_animation_layer = len(obj.animation_layers) - 1
+            invalidate_layer_cache(obj)
+
+        if any("cached_layer" in job for job in jobs):
+            self.report({'INFO'}, f"Re-merged {remerged} changed channel(s)")
+        elif totals:
+            self.report({'INFO'}, optimize_report(totals))
+        return {'FINISHED'}
+
+    def add_merged_layer(self, context, obj, merged_action):
+        animation_layers = obj.animation_layers
+        scene = context.scene
+        keep_sources = self.method == 'DIRECT' and self.keep_sources
+        if keep_sources:
+            sources = [layer for layer in animation_layers if layer.selected]
+            source_names = {layer.nla_track_name for layer in sources}
+            state, snapshots = collect_merge_state(obj, sources)
+            index = build_channel_index(obj, sources, scene.frame_start, scene.frame_end)
+
+        # Create merged layer with NLA strip
+        new_layer = animation_layers.add()
+        new_layer.name = "Merged"
+        new_track = obj.animation_data.nla_tracks.new()
+        new_track.name = new_layer.name
+        new_layer.nla_track_name = new_track.name
+
+        # Create and assign the baked action
+        merged_action.name = f"Merged_{obj.name}"
+        # Sparse merges start keying at the first changed frame, not at the scene start
+        first_key = merged_action.frame_range[0] if merged_action.fcurves else scene.frame_start
+        new_strip = new_track.strips.new(
+            name=merged_action.name,
+            start=int(np.floor(first_key)),
+            action=merged_action
+        )
+        new_strip.blend_type = 'COMBINE'
+        pin_strip_to_action(new_strip)
+
+        # Keep the sources hidden and remember what the merge was built from
+        if keep_sources:
+            store_merge_state(new_layer, state, index, snapshots)
+            with layer_state_batch(obj):
+                for layer in animation_layers:
+                    if layer.nla_track_name in source_names:
+                        layer.selected = False
+                        layer.visible = False
+            return
+
+        # Remove original layers after successful merge
+        layers_to_remove = [i for i, layer in enumerate(animation_layers) if layer.selected]
+        for i in reversed(sorted(layers_to_remove)):
+            if i < len(animation_layers):  # Prevent index errors
+                track = get_layer_track(obj, animation_layers[i])
+                if track:
+                    obj.animation_data.nla_tracks.remove(track)
+                animation_layers.remove(i)
+
+    def find_cached_merge(self, obj):
+        selected = {layer.nla_track_name for layer in obj.animation_layers if layer.selected}
+        for layer in obj.animation_layers:
+            if "merge_state" not in layer:
+                continue
+            sources = set(json.loads(layer["merge_state"])["sources"])
+            if selected == {layer.nla_track_name} or selected - {layer.nla_track_name} == sources:
+                return layer
+        return None
+
+    def remerge(self, context, obj, merged_layer):
+        scene = context.scene
+        state = json.loads(merged_layer["merge_state"])
+        sources = [layer for layer in obj.animation_layers if layer.nla_track_name in state["sources"]]
+        track = get_layer_track(obj, merged_layer)
+        if not (track and track.strips and track.strips[0].action):
+            return None
+        merged_action = track.strips[0].action
+
+        new_state, snapshots = collect_merge_state(obj, sources)
+        dirty = merge_dirty_spans(obj, sources, state, new_state, snapshots)
+        index = build_channel_index(obj, sources, scene.frame_start, scene.frame_end)
+        visual_paths = self.get_visual_paths(obj, {path: index[path] for path in dirty if path in index})
+
+        rewrites = {}
+        splices = {}
+        for data_path, span in dirty.items():
+            new_span = index.get(data_path)
+            old_span = tuple(state["spans"].get(data_path, ()))
+            if new_span and is_visual_path(data_path, visual_paths):
+                continue
+            if span is None or old_span != new_span:
+                for fcurve in [fc for fc in merged_action.fcurves if fc.data_path == data_path]:
+                    merged_action.fcurves.remove(fcurve)
+                if new_span:
+                    rewrites.setdefault(new_span, set()).add(data_path)
+                continue
+            first, last = max(int(np.floor(span[0])), new_span[0]), min(int(np.ceil(span[1])), new_span[1])
+            if first <= last:
+                splices.setdefault((first, last), set()).add(data_path)
+
+        for (first, last), data_paths in rewrites.items():
+            if self.sampling == 'ADAPTIVE':
+                write_adaptive_channels(merged_action, stack_sampler(obj, sources, data_paths),
+                                        first, last, self.coarse_step)
+                continue
+            frames = np.arange(first, last + 1, dtype=np.float64)
+            write_channels(merged_action, evaluate_layer_stack(obj, sources, frames, data_paths), frames)
+        for (first, last), data_paths in splices.items():
+            if self.sampling == 'ADAPTIVE':
+                # Both ends of the span are keys, so the new curve joins the keys around it
+                write_adaptive_channels(merged_action, stack_sampler(obj, sources, data_paths),
+                                        first, last, self.coarse_step)
+                continue
+            frames = np.arange(first, last + 1, dtype=np.float64)
+            channels = evaluate_layer_stack(obj, sources, frames, data_paths)
+            for data_path, (values, keyed, group) in channels.items():
+                for array_index in sorted(keyed):
+                    fcurve = merged_action.fcurves.find(data_path, index=array_index)
+                    if fcurve is None:
+                        fcurve = merged_action.fcurves.new(data_path, index=array_index, action_group=group)
+                    splice_keyframes(fcurve, np.column_stack((frames, values[:, array_index])), first, last)
+
+        return {
+            "merged_action": merged_action,
+            "sources": set(state["sources"]),
+            "visual_paths": visual_paths,
+            "frame_range": index_frame_range({path: index[path] for path in dirty if path in index}),
+            "cached_layer": merged_layer,
+            "state": new_state,
+            "index": index,
+            "snapshots": snapshots,
+            "count": len(dirty),
+        }
+
+    def merge_direct(self, context, obj):
+        scene = context.scene
+        layers = [layer for layer in obj.animation_layers if layer.selected]
+        index = build_channel_index(obj, layers, scene.frame_start, scene.frame_end)
+        visual_paths = self.get_visual_paths(obj, index)
+        merged_action = new_layer_action(f"Merged_{obj.name}")
+
+        # Channels sharing a frame span are evaluated together
+        spans = {}
+        for data_path, span in index.items():
+            if not is_visual_path(data_path, visual_paths):
+                spans.setdefault(span, set()).add(data_path)
+        for (first, last), data_paths in spans.items():
+            if self.sampling == 'ADAPTIVE':
+                write_adaptive_channels(merged_action, stack_sampler(obj, layers, data_paths),
+                                        first, last, self.coarse_step)
+                continue
+            frames = np.arange(first, last + 1, dtype=np.float64)
+            write_channels(merged_action, evaluate_layer_stack(obj, layers, frames, data_paths), frames)
 
-class AnimationLayer(PropertyGroup):
-    name: StringProperty(default="New Layer")
-    visible: BoolProperty(default=True, update=lambda self, context: self.update_visibility(context))
-    influence: FloatProperty(default=1.0, min=0.0, max=1.0, update=lambda self, context: self.update_influence(context))
-    nla_track_name: StringProperty()
-    selected: BoolProperty(default=False)
-    solo: BoolProperty(default=False, update=lambda self, context: self.update_solo(context))
-    is_editing: BoolProperty(default=False)
+        # Constrained and driven channels can only be captured by evaluating the scene
+        return {
+            "merged_action": merged_action,
+            "sources": {layer.nla_track_name for layer in layers},
+            "visual_paths": visual_paths,
+            "frame_range": index_frame_range(index),
+        }
 
-    def update_visibility(self, context):
-        obj = context.object
-        if obj.animation_data and obj.animation_data.nla_tracks:
-            track = obj.animation_data.nla_tracks.get(self.nla_track_name)
-            if track:
-                track.mute = not self.visible
+    def merge_visual(self, context, obj):
+        scene = context.scene
+        layers = [layer for layer in obj.animation_layers if layer.selected]
+        index = build_channel_index(obj, layers, scene.frame_start, scene.frame_end)
 
-    def update_influence(self, context):
-        obj = context.object
-        if obj.animation_data and obj.animation_data.nla_tracks:
-            track = obj.animation_data.nla_tracks.get(self.nla_track_name)
-            if track and track.strips:
-                for strip in track.strips:
-                    if not strip.mute:
-                        strip.influence = self.influence
-                        if not strip.fcurves.find('influence'):
-                            strip.fcurves.new('influence')
-                        strip.keyframe_insert("influence", frame=context.scene.frame_current)
+        # Only bake what the layers key, plus constrained bones that depend on it
+        visual_paths = {bone_data_path(name) + "." for name in index_bone_names(index)}
+        visual_paths.update(path for path in self.get_visual_paths(obj, index) if path.startswith('pose.bones["'))
+        if obj.type != 'ARMATURE' or any(path in OBJECT_TRANSFORM_PATHS for path in index):
+            visual_paths.update(OBJECT_TRANSFORM_PATHS)
+        return {
+            "merged_action": new_layer_action(f"Merged_{obj.name}"),
+            "sources": {layer.nla_track_name for layer in layers},
+            "visual_paths": visual_paths,
+            "frame_range": index_frame_range(index) or (scene.frame_start, scene.frame_end),
+        }
 
-    def update_solo(self, context):
-        obj = context.object
-        if self.solo:
-            for layer in obj.animation_layers:
-                if layer != self:
-                    layer.visible = False
+    @staticmethod
+    def get_visual_paths(obj, index):
+        # Data path prefixes whose evaluated value depends on constraints or drivers.
+        # Constrained bones are only included when they or their targets are keyed.
+        paths = set()
+        if obj.type == 'ARMATURE':
+            keyed_bones = index_bone_names(index)
+            for bone in obj.pose.bones:
+                constraints = [c for c in bone.constraints if not c.mute and c.influence > 0.0]
+                if not constraints:
+                    continue
+                if bone.name in keyed_bones or any(
+                        getattr(c, 'target', None) not in (None, obj) or getattr(c, 'subtarget', '') in keyed_bones
+                        for c in constraints):
+                    paths.add(bone_data_path(bone.name) + ".")
+        if any(not constraint.mute and constraint.influence > 0.0 for constraint in obj.constraints):
+            paths.update(OBJECT_TRANSFORM_PATHS)
+        if obj.animation_data:
+            # Only transforms can be captured visually, other driven properties are left to their drivers
+            paths.update(driver.data_path for driver in obj.animation_data.drivers
+                         if channel_property(driver.data_path) in OBJECT_TRANSFORM_PATHS)
+        return paths
+
+    def bake_visual_channels(self, context, jobs):
+        jobs = [job for job in jobs if job["visual_paths"] and job["frame_range"]]
+        if not jobs:
+            return
+
+        targets = {}
+        saved = []
+        for job in jobs:
+            obj = job["obj"]
+            anim_data = obj.animation_data
+            saved.append((anim_data, anim_data.action, [(track, track.mute) for track in anim_data.nla_tracks]))
+
+            # Only the merged layers contribute to the bake
+            anim_data.action = None
+            for track in anim_data.nla_tracks:
+                track.mute = track.name not in job["sources"]
+
+            names = targets.setdefault(obj, set())
+            for path in job["visual_paths"]:
+                if path.startswith('pose.bones["'):
+                    names.add(channel_group_name(path))
+                elif path in OBJECT_TRANSFORM_PATHS:
+                    names.add(None)
+
+        frame_start = min(job["frame_range"][0] for job in jobs)
+        frame_end = max(job["frame_range"][1] for job in jobs)
+        if self.sampling == 'ADAPTIVE':
+            # Every refinement round is one more sweep, over only the frames some channel still misses
+            visual_paths = {job["obj"].name: job["visual_paths"] for job in jobs}
+
+            def evaluate(frames):
+                channels = {}
+                for obj, results in visual_sweep(context, targets, frame_start, frame_end, frames)[1].items():
+                    for data_path, (values, group) in results.items():
+                        if is_visual_path(data_path, visual_paths[obj.name]):
+                            channels[(obj.name, data_path)] = (values, range(values.shape[1]), group)
+                return channels
+            anchors = [frame for job in jobs for frame in job["frame_range"]]
+            frames, values, keys, layout = adaptive_samples(evaluate, frame_start, frame_end, self.coarse_step,
+                                                            anchors, align=True)
         else:
-            for layer in obj.animation_layers:
-                layer.visible = True
+            frames, results = visual_sweep(context, targets, frame_start, frame_end)
 
-    def animate_influence(self, context, value):
-        obj = context.object
-        if obj.animation_data and obj.animation_data.nla_tracks:
-            track = obj.animation_data.nla_tracks.get(self.nla_track_name)
-            if track and track.strips:
-                for strip in track.strips:
-                    if not strip.mute:
-                        strip.influence = value
-                        strip.use_animated_influence = True
-                        if strip.action:
-                            fc = strip.action.fcurves.find('influence')
-                            if fc is None:
-                                fc = strip.action.fcurves.new('influence')
-                            fc.keyframe_points.insert(frame=context.scene.frame_current, value=value)
-        self.influence = value
+        for anim_data, action, track_states in saved:
+            anim_data.action = action
+            for track, mute in track_states:
+                track.mute = mute
 
-class ANIMLAYER_UL_layers(UIList):
-    def draw_item(self, context, layout, data, item, icon, active_data, active_propname):
-        if self.layout_type in {'DEFAULT', 'COMPACT'}:
-            row = layout.row(align=True)
-            row.prop(item, "selected", text="")
-            row.prop(item, "name", text="", emboss=False)
-            row.prop(item, "visible", text="", icon='HIDE_OFF' if item.visible else 'HIDE_ON', emboss=False)
-            
-            influence_row = row.row(align=True)
-            influence_row.prop(item, "influence", text="", emboss=False, slider=True)
-            
-            # Add error handling for operator creation
-            try:
-                op = influence_row.operator("animlayer.animate_influence", text="", icon='KEY_HLT')
-                if op:
-                    op.layer_name = item.name
-                else:
-                    influence_row.label(text="", icon='ERROR')
-            except Exception as e:
-                print(f"Error creating animate_influence operator: {e}")
-                influence_row.label(text="", icon='ERROR')
-            
-            row.prop(item, "solo", text="", icon='SOLO_ON' if item.solo else 'SOLO_OFF', emboss=False)
+        for job in jobs:
+            first, last = job["frame_range"]
+            window = (frames >= first) & (frames <= last)
+            if self.sampling == 'ADAPTIVE':
+                for column, ((name, data_path), index, group) in enumerate(layout):
+                    if name == job["obj"].name:
+                        rows = keys[:, column] & window
+                        write_hermite_keys(job["merged_action"], data_path, index, group,
+                                           frames[rows], values[rows, column])
+                continue
+            for data_path, (values, group) in results[job["obj"]].items():
+                if is_visual_path(data_path, job["visual_paths"]):
+                    write_channel_span(job["merged_action"], data_path, values[window], frames[window], group)
 
-            obj = context.object
-            if obj.animation_data and obj.animation_data.action:
-                track = obj.animation_data.nla_tracks.get(item.nla_track_name)
-                if track and track.strips and track.strips[0].action == obj.animation_data.action:
-                    row.label(text="", icon='RADIOBUT_ON')
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
 
-            if self.has_keyframes(context, item):
-                row.label(text="", icon='KEYTYPE_KEYFRAME_VEC')
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "method")
+        if self.method == 'DIRECT':
+            layout.prop(self, "keep_sources")
+        layout.prop(self, "sampling")
+        if self.sampling == 'ADAPTIVE':
+            layout.prop(self, "coarse_step")
+        layout.prop(self, "all_selected")
+        layout.prop(self, "clean_curves")
 
-    def has_keyframes(self, context, item):
+class ANIMLAYER_OT_move_layer(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.move_layer"
+    bl_label = "Move Layer"
+    bl_description = "Move the selected layer up or down"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    direction: EnumProperty(
+        items=[
+            ('UP', "Up", "Move the layer up"),
+            ('DOWN', "Down", "Move the layer down"),
+        ],
+        name="Direction",
+        description="Direction to move the layer",
+        default='UP'
+    )
+
+    @classmethod
+    def poll(cls, context):
         obj = context.object
-        if obj.animation_data and obj.animation_data.nla_tracks:
-            track = obj.animation_data.nla_tracks.get(item.nla_track_name)
-            if track and track.strips:
-                for strip in track.strips:
-                    if strip.action and strip.action.fcurves:
-                        return True
-        return False
+        return obj and obj.animation_layers and len(obj.animation_layers) > 1
+
+    def execute_object(self, context, obj):
+        layers = obj.animation_layers
+        active_index = obj.active_animation_layer
+
+        if self.direction == 'UP' and active_index > 0:
+            layers.move(active_index, active_index - 1)
+            obj.active_animation_layer -= 1
+        elif self.direction == 'DOWN' and active_index < len(layers) - 1:
+            layers.move(active_index, active_index + 1)
+            obj.active_animation_layer += 1
+
+        if obj.animation_data:
+            tracks = obj.animation_data.nla_tracks
+            track = get_layer_track(obj, layers[active_index])
+            if track:
+                if self.direction == 'UP' and active_index > 0:
+                    tracks.move(tracks.find(track.name), tracks.find(track.name) - 1)
+                elif self.direction == 'DOWN' and active_index < len(layers) - 1:
+                    tracks.move(tracks.find(track.name), tracks.find(track.name) + 1)
+
+class ANIMLAYER_OT_exit_edit(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.exit_edit"
+    bl_label = "Exit Edit Mode"
+    bl_description = "Exit layer editing and save changes"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute_object(self, context, obj):
+        active_layer = obj.animation_layers[obj.active_animation_layer]
+        if not active_layer.is_editing:
+            return
         
-class ANIMLAYER_OT_animate_influence(Operator):
-    bl_idname = "animlayer.animate_influence"
-    bl_label = "Animate Influence"
-    bl_description = "Animate the influence of the layer"
+        if obj.animation_data:
+            track = get_layer_track(obj, active_layer)
+            if track and track.strips and active_layer.get("edit_mode") == 'SPARSE':
+                finish_sparse_edit(obj, active_layer, track)
+            elif track and track.strips:
+                edited_action = obj.animation_data.action
+                original_action_name = active_layer.get("original_action_name")
+                
+                if edited_action:
+                    # Keep original action intact, just update the strip
+                    track.strips[0].action = edited_action
+                    edited_action.name = f"{original_action_name}_merged"
+                    
+                    # Keep the original action in the layer's history
+                    original_action = bpy.data.actions.get(original_action_name)
+                    if original_action:
+                        push_layer_version(active_layer, original_action, "Before edit")
+                    
+                    # Clean up
+                    obj.animation_data.action = None
+                    track.mute = not active_layer.visible
+                    for key in ("original_action_name", "edit_action_name", "edit_mode"):
+                        if key in active_layer:
+                            del active_layer[key]
+                    active_layer.is_editing = False
+
+class ANIMLAYER_OT_solo_layer(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.solo_layer"
+    bl_label = "Solo Layer"
+    bl_description = "Solo or unsolo the layer with this name"
     bl_options = {'REGISTER', 'UNDO'}
 
     layer_name: StringProperty()
+    solo: BoolProperty(default=True)
 
-    def execute(self, context):
-        print(f"ANIMLAYER_OT_animate_influence.execute() called with layer_name: {self.layer_name}")
-        obj = context.object
+    def execute_object(self, context, obj):
         layer = next((layer for layer in obj.animation_layers if layer.name == self.layer_name), None)
         if layer:
-            print(f"Found layer: {layer.name}, animating influence")
-            layer.animate_influence(context, layer.influence)
-        else:
-            print(f"Layer not found: {self.layer_name}")
-        return {'FINISHED'}
+            layer.solo = self.solo
 
-class ANIMLAYER_OT_add_layer(Operator):
-    bl_idname = "animlayer.add_layer"
-    bl_label = "Add Animation Layer"
-    bl_description = "Add a new animation layer"
+class ANIMLAYER_OT_optimize_layers(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.optimize_layers"
+    bl_label = "Optimize Layers"
+    bl_description = "Remove redundant keys and unchanged channels from the layer actions"
     bl_options = {'REGISTER', 'UNDO'}
 
+    scope: EnumProperty(
+        items=[
+            ('ACTIVE', "Active Layer", "Optimize the active layer"),
+            ('SELECTED', "Selected Layers", "Optimize every selected layer"),
+        ],
+        name="Layers",
+        default='ACTIVE'
+    )
+    location_tolerance: FloatProperty(
+        name="Location", description="Largest location change a removed key may cause",
+        default=OPTIMIZE_TOLERANCES['LOCATION'], min=0.0, precision=4, subtype='DISTANCE'
+    )
+    rotation_tolerance: FloatProperty(
+        name="Rotation", description="Largest rotation change a removed key may cause",
+        default=OPTIMIZE_TOLERANCES['ROTATION'], min=0.0, precision=3, subtype='ANGLE'
+    )
+    scale_tolerance: FloatProperty(
+        name="Scale", description="Largest scale change a removed key may cause",
+        default=OPTIMIZE_TOLERANCES['SCALE'], min=0.0, precision=4
+    )
+    other_tolerance: FloatProperty(
+        name="Other", description="Largest change a removed key may cause on any other property",
+        default=OPTIMIZE_TOLERANCES['OTHER'], min=0.0, precision=4
+    )
+    remove_unchanged: BoolProperty(
+        name="Remove Unchanged Channels",
+        description="Delete transform channels that hold their rest value on combine layers",
+        default=True
+    )
+
     def execute(self, context):
-        obj = context.object
-        layers = obj.animation_layers
-        new_layer = layers.add()
-        new_layer.name = f"Layer {len(layers)}"
-        
-        if obj.animation_data is None:
-            obj.animation_data_create()
-        
-        nla_tracks = obj.animation_data.nla_tracks
-        new_track = nla_tracks.new(prev=None)
-        new_track.name = new_layer.name
-        new_layer.nla_track_name = new_track.name
-        
-        # Create a default action for the new layer
-        new_action = bpy.data.actions.new(name=f"Action_{new_layer.name}")
-        new_strip = new_track.strips.new(name=new_action.name, start=context.scene.frame_start, action=new_action)
-        new_strip.blend_type = 'COMBINE'
-        new_strip.use_auto_blend = False
-        new_strip.influence = 1.0
-        new_strip.use_animated_influence = True  # Enable animated influence by default
-        
-        # Set the action's blending mode to 'COMBINE'
-        if obj.animation_data.action:
-            obj.animation_data.action_blend_type = 'COMBINE'
-        
-        obj.active_animation_layer = len(layers) - 1
+        self.totals = dict.fromkeys(("keys_before", "keys_after", "bytes_before", "bytes_after", "fcurves_removed"), 0)
+        MultiObjectOperator.execute(self, context)
+        self.report({'INFO'}, optimize_report(self.totals))
         return {'FINISHED'}
-        
-class ANIMLAYER_OT_remove_layer(Operator):
-    bl_idname = "animlayer.remove_layer"
-    bl_label = "Remove Animation Layer"
-    bl_description = "Remove the selected animation layer"
+
+    def execute_object(self, context, obj):
+        tolerances = {'LOCATION': self.location_tolerance, 'ROTATION': self.rotation_tolerance,
+                      'SCALE': self.scale_tolerance, 'OTHER': self.other_tolerance}
+        if self.scope == 'ACTIVE':
+            layers = [obj.animation_layers[obj.active_animation_layer]]
+        else:
+            layers = [layer for layer in obj.animation_layers if layer.selected]
+
+        for layer in layers:
+            track = get_layer_track(obj, layer)
+            if layer.is_editing or not track:
+                continue
+            for action in dict.fromkeys(strip.action for strip in track.strips if strip.action):
+                # A channel at its rest value only contributes nothing when every strip combines it
+                combine = all(strip.blend_type == 'COMBINE' for strip in track.strips if strip.action == action)
+                push_layer_version(layer, new_layer_action(f"{action.name}_unoptimized", action), "Before optimize")
+                stats = optimize_action(action, tolerances, self.remove_unchanged and combine)
+                for key, value in stats.items():
+                    self.totals[key] += value
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "scope")
+        col = layout.column(align=True)
+        col.prop(self, "location_tolerance")
+        col.prop(self, "rotation_tolerance")
+        col.prop(self, "scale_tolerance")
+        col.prop(self, "other_tolerance")
+        layout.prop(self, "remove_unchanged")
+        layout.prop(self, "all_selected")
+
+class ANIMLAYER_OT_import_take(Operator, ImportHelper):
+    bl_idname = "animlayer.import_take"
+    bl_label = "Import Take to Layer"
+    bl_description = ("Import channel data from a BVH, NumPy or CSV file into a new layer. BVH, CSV and .npz takes "
+                      "are unpacked to a scratch file first, .npy takes are mapped without a copy")
     bl_options = {'REGISTER', 'UNDO'}
 
+    filter_glob: StringProperty(default="*.bvh;*.npy;*.npz;*.csv", options={'HIDDEN'})
+    channels: StringProperty(
+        name="Channel List",
+        description="File naming the channel of every column of a .npy take, one per line. "
+                    "Defaults to the take's name with the .channels extension",
+        subtype='FILE_PATH'
+    )
+    frame_start: IntProperty(name="Start Frame", description="Frame of the first row", default=1)
+    frame_step: FloatProperty(name="Frame Step", description="Frames between rows", default=1.0, min=0.001)
+    use_frame_time: BoolProperty(
+        name="Use BVH Frame Time",
+        description="Space BVH frames by their frame time at the scene frame rate instead of the frame step",
+        default=False
+    )
+    scale: FloatProperty(name="Scale", description="Scale of BVH positions", default=1.0, min=0.0001)
+
     @classmethod
     def poll(cls, context):
-        return context.object.animation_layers
+        return context.object is not None
 
+    @profiled('operator')
     def execute(self, context):
         obj = context.object
-        layers = obj.animation_layers
-        
-        for i in range(len(layers) - 1, -1, -1):
-            if layers[i].selected:
-                if obj.animation_data:
-                    nla_track = obj.animation_data.nla_tracks.get(layers[i].nla_track_name)
-                    if nla_track:
-                        obj.animation_data.nla_tracks.remove(nla_track)
-                layers.remove(i)
-        
-        obj.active_animation_layer = min(obj.active_animation_layer, len(layers) - 1)
+        try:
+            layer = import_take(context, obj, self.filepath, bpy.path.abspath(self.channels) or None,
+                                self.frame_start, self.frame_step, self.use_frame_time, self.scale)
+        except (OSError, ValueError, KeyError) as error:
+            self.report({'ERROR'}, f"Could not import {os.path.basename(self.filepath)}: {error}")
+            return {'CANCELLED'}
+        action = get_layer_track(obj, layer).strips[0].action
+        keys = sum(len(fcurve.keyframe_points) for fcurve in action.fcurves)
+        self.report({'INFO'}, f"Imported {len(action.fcurves)} channel(s), {keys} keys into '{layer.name}'")
         return {'FINISHED'}
 
-class ANIMLAYER_OT_assign_to_layer(Operator):
-    bl_idname = "animlayer.assign_to_layer"
-    bl_label = "Assign to Layer"
-    bl_description = "Assign current animation to the active layer"
+class ANIMLAYER_OT_export_layers(Operator, ExportHelper):
+    bl_idname = "animlayer.export_layers"
+    bl_label = "Export Layer Archive"
+    bl_description = "Save the layer stacks of the selected objects to a columnar binary file"
+
+    filename_ext = ".animlayers"
+    filter_glob: StringProperty(default="*.animlayers", options={'HIDDEN'})
+    all_selected: BoolProperty(
+        name="All Selected Objects",
+        description="Export every selected object instead of only the active one",
+        default=True
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return context.object is not None
+
+    @profiled('operator')
+    def execute(self, context):
+        objects = [obj for obj in operator_objects(context, self.all_selected) if obj.animation_layers]
+        if not objects:
+            self.report({'WARNING'}, "No object with animation layers to export")
+            return {'CANCELLED'}
+        keys = export_layer_archive(self.filepath, objects)
+        self.report({'INFO'}, f"Exported {len(objects)} object(s), {keys} keys to {os.path.basename(self.filepath)}")
+        return {'FINISHED'}
+
+class ANIMLAYER_OT_import_layers(Operator, ImportHelper):
+    bl_idname = "animlayer.import_layers"
+    bl_label = "Import Layer Archive"
+    bl_description = "Recreate the layers saved in a layer archive"
     bl_options = {'REGISTER', 'UNDO'}
 
+    filter_glob: StringProperty(default="*.animlayers", options={'HIDDEN'})
+    match_names: BoolProperty(
+        name="Match Object Names",
+        description="Give every archived object's layers to the object of the same name. "
+                    "Otherwise the first archived object goes to the active object",
+        default=True
+    )
+    replace: BoolProperty(
+        name="Replace Layers",
+        description="Remove the existing layers of the receiving objects first",
+        default=False
+    )
+
     @classmethod
     def poll(cls, context):
-        obj = context.object
-        return (obj and obj.animation_data and
-                obj.animation_layers and len(obj.animation_layers) > 0)
+        return context.object is not None
 
+    @profiled('operator')
     def execute(self, context):
-        obj = context.object
-        active_layer = obj.animation_layers[obj.active_animation_layer]
-        
-        if obj.animation_data:
-            # Deactivate NLA tracks if active
-            if obj.animation_data.use_tweak_mode:
-                obj.animation_data.use_tweak_mode = False
-            
-            # If there's no current action, create a new one
-            if not obj.animation_data.action:
-                obj.animation_data.action = bpy.data.actions.new(name=f"Action_{active_layer.name}")
-            
-            current_action = obj.animation_data.action
-            track = obj.animation_data.nla_tracks.get(active_layer.nla_track_name)
-            
-            if track:
-                # Remove existing strips
-                for strip in track.strips:
-                    track.strips.remove(strip)
-                
-                # Create a new strip with the current action
-                new_strip = track.strips.new(name=current_action.name, start=context.scene.frame_start, action=current_action)
-                new_strip.blend_type = 'COMBINE'
-                new_strip.use_auto_blend = False
-                new_strip.influence = active_layer.influence
-                new_strip.use_animated_influence = True
+        try:
+            archive = open_layer_archive(self.filepath)
+        except (OSError, ValueError) as error:
+            self.report({'ERROR'}, f"Could not read {os.path.basename(self.filepath)}: {error}")
+            return {'CANCELLED'}
+        names = [record["name"] for record in archive["header"]["objects"]]
+        if self.match_names:
+            targets = {name: context.scene.objects[name] for name in names if name in context.scene.objects}
+        else:
+            targets = {names[0]: context.object} if names else {}
+        if not targets:
+            self.report({'WARNING'}, "No object in the scene matches the archive")
+            return {'CANCELLED'}
+        count = import_layer_archive(context, self.filepath, targets, self.replace)
+        self.report({'INFO'}, f"Imported {count} layer(s) onto {len(targets)} object(s)")
+        return {'FINISHED'}
 
-                # If we're assigning an edited action back to its original layer, replace the original action
-                if "original_action_name" in active_layer:
-                    original_action = bpy.data.actions.get(active_layer["original_action_name"])
-                    if original_action:
-                        original_action.user_remap(current_action)
-                        bpy.data.actions.remove(original_action)
-                    del active_layer["original_action_name"]
+class ANIMLAYER_OT_bulk_layers(Operator):
+    bl_idname = "animlayer.bulk_layers"
+    bl_label = "Change Listed Layers"
+    bl_description = "Change every layer the scene layer list shows, one batched pass per object"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    action: EnumProperty(
+        items=[
+            ('SHOW', "Show", "Show the layers"),
+            ('HIDE', "Hide", "Hide the layers"),
+            ('ISOLATE', "Isolate", "Show the layers and hide every other layer of their objects"),
+            ('SELECT', "Select", "Select the layers"),
+            ('DESELECT', "Deselect", "Deselect the layers"),
+            ('INFLUENCE', "Set Influence", "Set and key the influence of the layers"),
+        ],
+        name="Action",
+        default='SHOW'
+    )
+    scope: EnumProperty(
+        items=[
+            ('LISTED', "Listed", "Every layer that passes the filter"),
+            ('SELECTED', "Selected", "Selected layers that pass the filter"),
+        ],
+        name="Layers",
+        default='LISTED'
+    )
+    influence: FloatProperty(name="Influence", default=1.0, min=0.0, max=1.0)
+
+    @profiled('operator')
+    def execute(self, context):
+        scene = context.scene
+        targets = {}
+        for row in scene_layer_view(scene, scene.animation_layer_settings):
+            targets.setdefault(row["object"], []).append(row["index"])
+
+        frame = scene.frame_current
+        changed = 0
+        for name, indices in targets.items():
+            obj = scene.objects.get(name)
+            if obj is None:
+                continue
+            layers = obj.animation_layers
+            chosen = [layers[i] for i in sorted(indices)
+                      if i < len(layers) and (self.scope == 'LISTED' or layers[i].selected)]
+            if not chosen:
+                continue
+            invalidate_evaluation_cache(obj)
+            with layer_state_batch(obj):
+                if self.action == 'ISOLATE':
+                    # Track names are unique per object, layer names need not be
+                    chosen_tracks = {layer.nla_track_name for layer in chosen}
+                    for layer in layers:
+                        layer.visible = layer.nla_track_name in chosen_tracks
+                        layer.solo = False
+                for layer in chosen:
+                    if self.action in {'SHOW', 'HIDE'}:
+                        layer.visible = self.action == 'SHOW'
+                    elif self.action in {'SELECT', 'DESELECT'}:
+                        layer.selected = self.action == 'SELECT'
+                    elif self.action == 'INFLUENCE':
+                        layer.influence = self.influence
+            if self.action == 'INFLUENCE':
+                for layer in chosen:
+                    PENDING_INFLUENCE_KEYS.pop((obj.name, layer.nla_track_name), None)
+                    track = get_layer_track(obj, layer)
+                    if track and track.strips:
+                        key_track_influence(track, [frame], [self.influence])
+            changed += len(chosen)
+        invalidate_scene_layer_index()
+        self.report({'INFO'}, f"Changed {changed} layer(s) on {len(targets)} object(s)")
+        return {'FINISHED'}
+
+class ANIMLAYER_OT_bake_visual(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.bake_visual"
+    bl_label = "Bake Visual Transform to Layer"
+    bl_description = "Bake the evaluated transforms of the selected bones or objects, constraints and IK included, into a new layer"
+    bl_options = {'REGISTER', 'UNDO'}
+    requires_layers = False
+
+    only_selected_bones: BoolProperty(
+        name="Only Selected Bones",
+        description="Bake the selected pose bones of armatures instead of all of their bones",
+        default=True
+    )
+    use_preview_range: BoolProperty(
+        name="Preview Range",
+        description="Bake the preview range instead of the scene range when it is enabled",
+        default=True
+    )
+    mute_constraints: BoolProperty(
+        name="Mute Constraints",
+        description="Mute the constraints of the baked bones and objects, so the layer alone drives them. "
+                    "IK stays on while any bone of its chain is left out of the bake",
+        default=True
+    )
+    clean_curves: BoolProperty(
+        name="Optimize Result",
+        description="Remove redundant keys from the baked action",
+        default=True
+    )
+    use_layer_mask: BoolProperty(
+        name="Use Active Layer Mask",
+        description="Only bake the channels in the channel mask of the active layer and give the baked layer the same mask",
+        default=True
+    )
 
-                # Set the action's blending mode to 'COMBINE'
-                obj.animation_data.action_blend_type = 'COMBINE'
+    @profiled('operator')
+    def execute(self, context):
+        # Every object is captured in the same sweep over the frame range
+        scene = context.scene
+        if self.use_preview_range and scene.use_preview_range:
+            frame_start, frame_end = scene.frame_preview_start, scene.frame_preview_end
+        else:
+            frame_start, frame_end = scene.frame_start, scene.frame_end
 
-                # Clear the current action from the object
-                obj.animation_data.action = None
+        targets = {}
+        masks = {}
+        for obj in operator_objects(context, self.all_selected):
+            mask = None
+            if self.use_layer_mask and obj.animation_layers:
+                # Compiled fresh, bone collections may have changed since the mask was applied
+                invalidate_layer_masks(obj)
+                source = obj.animation_layers[obj.active_animation_layer]
+                mask = layer_mask(obj, source)
+                if mask is not None:
+                    masks[obj] = (mask, {prop: getattr(source, prop) for prop in LAYER_MASK_PROPS})
+            names = set()
+            if obj.type == 'ARMATURE':
+                names = {bone.name for bone in obj.pose.bones if (bone.bone.select or not self.only_selected_bones)
+                         and (mask is None or mask_allows_bone(mask, bone.name))}
+            if (obj.type != 'ARMATURE' or obj.constraints) and (
+                    mask is None or any(mask_allows(mask, path) for path in OBJECT_TRANSFORM_PATHS)):
+                names.add(None)
+            if names:
+                targets[obj] = names
+        if not targets:
+            self.report({'WARNING'}, "Nothing selected to bake")
+            return {'CANCELLED'}
 
-                # Unmute the track
-                track.mute = False
+        frames, results = visual_sweep(context, targets, frame_start, frame_end)
+        keys = 0
+        for obj, channels in results.items():
+            invalidate_evaluation_cache(obj)
+            action = new_layer_action(f"Baked_{obj.name}")
+            mask = masks[obj][0] if obj in masks else None
+            skipped = []
+            for data_path, (values, group) in channels.items():
+                if mask is None or mask_allows(mask, data_path):
+                    write_channel_span(action, data_path, values, frames, group)
+                else:
+                    skipped.append(data_path)
+            if self.clean_curves:
+                optimize_action(action, OPTIMIZE_TOLERANCES, remove_defaults=False)
+            keys += sum(len(fcurve.keyframe_points) for fcurve in action.fcurves)
 
+            # The baked transforms are absolute, so the layer replaces what is below it
+            layer = create_layer(obj, f"Baked {len(obj.animation_layers) + 1}", action, frame_start)
+            get_layer_track(obj, layer).strips[0].blend_type = 'REPLACE'
+            if obj in masks:
+                with suspend_layer_updates():
+                    for prop, value in masks[obj][1].items():
+                        setattr(layer, prop, value)
+                apply_layer_mask(obj, layer)
+            if self.mute_constraints:
+                # Only targets baked in full, and only constraints that move nothing else
+                baked = {name for name in targets[obj] if not any(
+                    data_path in OBJECT_TRANSFORM_PATHS if name is None
+                    else data_path.startswith(bone_data_path(name) + ".") for data_path in skipped)}
+                for name in baked:
+                    if name is None:
+                        for constraint in obj.constraints:
+                            constraint.mute = True
+                        continue
+                    bone = obj.pose.bones[name]
+                    for constraint in bone.constraints:
+                        if constraint_bones(bone, constraint) <= baked:
+                            constraint.mute = True
+            invalidate_layer_cache(obj)
+        self.report({'INFO'}, f"Baked {len(results)} object(s) over {len(frames)} frame(s), {keys} keys")
         return {'FINISHED'}
 
-class ANIMLAYER_OT_edit_layer(Operator):
-    bl_idname = "animlayer.edit_layer"
-    bl_label = "Edit Layer Animation"
-    bl_description = "Edit the animation in the selected layer"
+class ANIMLAYER_OT_key_active_layer(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.key_active_layer"
+    bl_label = "Key Active Layer"
+    bl_description = "Key the current pose of the selected bones or objects into the active layer, without editing it"
     bl_options = {'REGISTER', 'UNDO'}
 
-    @classmethod
-    def poll(cls, context):
-        obj = context.object
-        return obj and obj.animation_layers and len(obj.animation_layers) > 0
+    channels: EnumProperty(
+        items=[
+            ('LOC_ROT_SCALE', "Location, Rotation & Scale", "Key all transform channels"),
+            ('LOCATION', "Location", "Key location"),
+            ('ROTATION', "Rotation", "Key rotation in the rotation mode of each bone or object"),
+            ('SCALE', "Scale", "Key scale"),
+            ('AVAILABLE', "Available", "Key the channels the layer already animates"),
+        ],
+        name="Channels",
+        default='LOC_ROT_SCALE'
+    )
 
     def execute(self, context):
-        obj = context.object
-        active_layer = obj.animation_layers[obj.active_animation_layer]
-        
-        if obj.animation_data:
-            track = obj.animation_data.nla_tracks.get(active_layer.nla_track_name)
-            if track and track.strips:
-                # Unlink the current action if it exists
-                if obj.animation_data.action:
-                    obj.animation_data.action = None
-                
-                # Create a copy of the strip's action and set it as the active action
-                original_action = track.strips[0].action
-                new_action = original_action.copy()
-                new_action.name = f"{original_action.name}_edit"
-                obj.animation_data.action = new_action
-                
-                # Set the action's blending mode to 'COMBINE'
-                obj.animation_data.action_blend_type = 'COMBINE'
-                
-                # Mute the NLA track while editing
-                track.mute = True
-                
-                # Store the original action name in the layer for later reference
-                active_layer["original_action_name"] = original_action.name
+        self.keyed = 0
+        MultiObjectOperator.execute(self, context)
+        if not self.keyed:
+            self.report({'WARNING'}, "Nothing keyed: no channels, the layer is being edited or has no strip here")
+            return {'CANCELLED'}
+        self.report({'INFO'}, f"Keyed {self.keyed} channel(s)")
+        return {'FINISHED'}
 
-                # Set editing state
-                active_layer.is_editing = True
+    def execute_object(self, context, obj):
+        layer = obj.animation_layers[obj.active_animation_layer]
+        track = get_layer_track(obj, layer)
+        if layer.is_editing or not track:
+            return
+        action = next((strip.action for strip in track.strips if strip.action), None)
+        paths = keying_paths(obj, self.channels, action)
+        self.keyed += key_layer_channels(obj, layer, context.scene.frame_current, paths)
 
-        return {'FINISHED'}
+class ANIMLAYER_OT_mask_selection(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.mask_selection"
+    bl_label = "Mask Selection"
+    bl_description = "Add the selected bones, or the object transforms outside pose mode, to the channel mask of the active layer"
+    bl_options = {'REGISTER', 'UNDO'}
 
-class ANIMLAYER_OT_merge_layers(Operator):
-    bl_idname = "animlayer.merge_layers"
-    bl_label = "Merge Selected Layers"
-    bl_description = "Merge all selected layers into a new layer"
+    mode: EnumProperty(
+        items=[
+            ('ADD', "Add", "Add the selection to the mask"),
+            ('REMOVE', "Remove", "Remove the selection from the mask"),
+            ('CLEAR', "Clear", "Remove every explicit channel from the mask"),
+        ],
+        name="Mode",
+        default='ADD'
+    )
+
+    def execute_object(self, context, obj):
+        layer = obj.animation_layers[obj.active_animation_layer]
+        if obj.type == 'ARMATURE' and obj.mode == 'POSE':
+            selection = [bone_data_path(bone.name) for bone in obj.pose.bones if bone.bone.select]
+        else:
+            selection = sorted(OBJECT_TRANSFORM_PATHS)
+        paths = json.loads(layer.mask_paths) if layer.mask_paths else []
+        if self.mode == 'ADD':
+            paths += [path for path in selection if path not in paths]
+        elif self.mode == 'REMOVE':
+            paths = [path for path in paths if path not in selection]
+        else:
+            paths = []
+        # The mask is applied once, after the operator
+        with suspend_layer_updates():
+            layer.mask_paths = json.dumps(paths) if paths else ""
+            if self.mode == 'ADD':
+                layer.use_mask = True
+
+class ANIMLAYER_OT_save_snapshot(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.save_snapshot"
+    bl_label = "Save Layer Snapshot"
+    bl_description = "Store the visibility, solo, influence, order and actions of every layer under a name"
     bl_options = {'REGISTER', 'UNDO'}
 
-    @classmethod
-    def poll(cls, context):
-        obj = context.object
-        return obj and obj.animation_layers and any(layer.selected for layer in obj.animation_layers)
+    name: StringProperty(name="Name", description="Snapshot to create or overwrite")
 
-    @staticmethod
-    def get_constraint_targets(armature):
-        targets = set()
-        if armature.type == 'ARMATURE':
-            # Add armature itself for bone-to-bone constraints
-            targets.add(armature)
-            
-            for bone in armature.pose.bones:
-                for constraint in bone.constraints:
-                    # Handle bone-to-bone constraints within same armature
-                    if constraint.type == 'CHILD_OF' and constraint.target == armature:
-                        targets.add(armature)
-        return targets
+    def execute(self, context):
+        # One name for every object, so a crowd switches variations together
+        if not self.name:
+            self.name = f"Variation {len(context.object.animation_layer_snapshots) + 1}"
+        return MultiObjectOperator.execute(self, context)
+
+    def execute_object(self, context, obj):
+        snapshots = obj.animation_layer_snapshots
+        snapshot = next((snapshot for snapshot in snapshots if snapshot.name == self.name), None)
+        if snapshot is None:
+            snapshot = snapshots.add()
+            snapshot.name = self.name
+        state = capture_layer_state(obj)
+        snapshot.state = json.dumps(state, separators=(',', ':'))
+        # The actions of a variation must survive while no strip uses them
+        for record in state["layers"]:
+            for action_name, *_ in record[4]:
+                action = bpy.data.actions.get(action_name) if action_name else None
+                if action:
+                    action.use_fake_user = True
+
+    def invoke(self, context, event):
+        self.name = f"Variation {len(context.object.animation_layer_snapshots) + 1}"
+        return context.window_manager.invoke_props_dialog(self)
+
+class ANIMLAYER_OT_apply_snapshot(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.apply_snapshot"
+    bl_label = "Apply Layer Snapshot"
+    bl_description = "Switch the layers to a saved snapshot, changing only what differs"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    name: StringProperty(name="Name")
 
     def execute(self, context):
-        obj = context.object
-        animation_layers = obj.animation_layers
-        scene = context.scene
+        self.objects = 0
+        self.changes = 0
+        MultiObjectOperator.execute(self, context)
+        if not self.objects:
+            self.report({'WARNING'}, f"No snapshot named {self.name}")
+            return {'CANCELLED'}
+        self.report({'INFO'}, f"Applied {self.name} to {self.objects} object(s), {self.changes} change(s)")
+        return {'FINISHED'}
 
-        # Create animation data if none exists
-        if not obj.animation_data:
-            obj.animation_data_create()
+    def execute_object(self, context, obj):
+        snapshot = next((snapshot for snapshot in obj.animation_layer_snapshots if snapshot.name == self.name), None)
+        if snapshot is None:
+            return
+        self.changes += apply_layer_state(obj, json.loads(snapshot.state))
+        self.objects += 1
 
-        # Get all objects involved in constraints
-        target_objects = self.get_constraint_targets(obj)
-        
-        # Directly manipulate selection without operators
-        for o in context.view_layer.objects:
-            o.select_set(False)
-            
-        obj.select_set(True)
-        for o in target_objects:
-            if o and o.name in context.view_layer.objects:
-                o.select_set(True)
-                
-        context.view_layer.objects.active = obj
+class ANIMLAYER_OT_remove_snapshot(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.remove_snapshot"
+    bl_label = "Remove Layer Snapshot"
+    bl_description = "Delete a saved layer snapshot, Purge Unused Layer Actions then frees its actions"
+    bl_options = {'REGISTER', 'UNDO'}
+    requires_layers = False
 
-        # Store original state
-        original_action = obj.animation_data.action if obj.animation_data else None
-        original_frame = scene.frame_current
-        original_tweak_mode = obj.animation_data.use_tweak_mode if obj.animation_data else False
-        
-        # Store and unmute all tracks during baking
-        original_track_states = []
-        if obj.animation_data:
-            for track in obj.animation_data.nla_tracks:
-                original_track_states.append((track, track.mute))
-                track.mute = False  # Unmute all tracks during baking
+    name: StringProperty(name="Name")
 
-        # Modified bake section
-        if obj.type == 'ARMATURE':
-            bpy.context.view_layer.objects.active = obj
-            bpy.ops.object.mode_set(mode='POSE')
-            bpy.ops.pose.select_all(action='SELECT')
-            
-            # Critical: Bake in POSE mode
-            bpy.ops.nla.bake(
-                frame_start=scene.frame_start,
-                frame_end=scene.frame_end,
-                step=1,
-                only_selected=True,
-                visual_keying=True,
-                clear_constraints=False,
-                clear_parents=False,
-                use_current_action=True,
-                bake_types={'POSE'}
-            )
-            
-            bpy.ops.object.mode_set(mode='OBJECT')
-        else:
-            # For simple objects, bake in OBJECT mode
-            bpy.ops.object.mode_set(mode='OBJECT')
-            bpy.ops.nla.bake(
-                frame_start=scene.frame_start,
-                frame_end=scene.frame_end,
-                step=1,
-                only_selected=True,
-                visual_keying=True,
-                clear_constraints=False,
-                clear_parents=False,
-                use_current_action=True,
-                bake_types={'OBJECT'}
-            )
-
-        # Handle case where bake didn't create an action
-        merged_action = obj.animation_data.action
-        if not merged_action:
-            merged_action = bpy.data.actions.new(name=f"Merged_{obj.name}")
-            obj.animation_data.action = merged_action
+    def execute_object(self, context, obj):
+        snapshots = obj.animation_layer_snapshots
+        index = next((i for i, snapshot in enumerate(snapshots) if snapshot.name == self.name), None)
+        if index is not None:
+            snapshots.remove(index)
 
-        # Create merged layer with NLA strip
-        new_layer = animation_layers.add()
-        new_layer.name = "Merged"
-        new_track = obj.animation_data.nla_tracks.new()
-        new_track.name = new_layer.name
-        new_layer.nla_track_name = new_track.name
+class ANIMLAYER_OT_extract_additive(MultiObjectOperator, Operator):
+    bl_idname = "animlayer.extract_additive"
+    bl_label = "Extract Additive Layer"
+    bl_description = "Add a combine layer holding the difference between a target layer and the base layers, so the base plus the new layer reproduces the target"
+    bl_options = {'REGISTER', 'UNDO'}
 
-        # Create and assign the baked action
-        merged_action = obj.animation_data.action
-        merged_action.name = f"Merged_{obj.name}"
-        new_strip = new_track.strips.new(
-            name=merged_action.name,
-            start=scene.frame_start,
-            action=merged_action
-        )
-        new_strip.blend_type = 'COMBINE'
+    target_layer: StringProperty(
+        name="Target",
+        description="Layer with the finished motion, the active layer when empty"
+    )
+    base: EnumProperty(
+        items=[
+            ('BELOW', "Layers Below", "Every layer below the target"),
+            ('SELECTED', "Selected Layers", "The selected layers other than the target"),
+            ('LAYER', "Single Layer", "The layer named in Base Layer"),
+        ],
+        name="Base",
+        default='BELOW'
+    )
+    base_layer: StringProperty(
+        name="Base Layer",
+        description="Layer to subtract when Base is set to a single layer"
+    )
+    hide_target: BoolProperty(
+        name="Hide Target",
+        description="Hide the target layer, so the base and the new layer play back the target motion",
+        default=True
+    )
+    clean_curves: BoolProperty(
+        name="Optimize Result",
+        description="Reduce the difference to the keys needed to stay within the optimize tolerances",
+        default=True
+    )
 
-        # Remove original layers after successful merge
-        layers_to_remove = [i for i, layer in enumerate(animation_layers) if layer.selected]
-        for i in reversed(sorted(layers_to_remove)):
-            if i < len(animation_layers):  # Prevent index errors
-                track = obj.animation_data.nla_tracks.get(animation_layers[i].nla_track_name)
-                if track:
-                    obj.animation_data.nla_tracks.remove(track)
-                animation_layers.remove(i)
+    def execute(self, context):
+        self.keys = 0
+        self.layers = 0
+        MultiObjectOperator.execute(self, context)
+        if not self.layers:
+            self.report({'WARNING'}, "Nothing to extract: the target layers have no keys or match their base")
+            return {'CANCELLED'}
+        self.report({'INFO'}, f"Extracted {self.layers} additive layer(s) with {self.keys} keys")
+        return {'FINISHED'}
 
-        # Restore original state
-        if original_action and original_action.users > 0:  # Check if still exists
-            obj.animation_data.action = original_action
+    def execute_object(self, context, obj):
+        layers = obj.animation_layers
+        if self.target_layer:
+            target = next((layer for layer in layers if layer.name == self.target_layer), None)
         else:
-            obj.animation_data.action = None
-            
-        if obj.animation_data:
-            obj.animation_data.use_tweak_mode = original_tweak_mode
-            
-        scene.frame_set(original_frame)
-        obj.active_animation_layer = len(animation_layers) - 1
+            target = layers[obj.active_animation_layer]
+        if target is None or target.is_editing or not get_layer_track(obj, target):
+            return
 
-        # Restore original selection
-        for o in target_objects:
-            o.select_set(True)
-        context.view_layer.objects.active = obj
+        entries = layer_track_entries(obj)
+        if self.base == 'BELOW':
+            position = entries[target.nla_track_name][0]
+            bases = [layer for layer in layers
+                     if layer.nla_track_name in entries and entries[layer.nla_track_name][0] < position]
+        elif self.base == 'SELECTED':
+            bases = [layer for layer in layers if layer.selected and layer != target]
+        else:
+            bases = [layer for layer in layers if layer.name == self.base_layer and layer != target]
 
-        return {'FINISHED'}
+        # Only channels the target keys are extracted, over the span where either side moves
+        scene = context.scene
+        targeted = build_channel_index(obj, [target], scene.frame_start, scene.frame_end)
+        index = build_channel_index(obj, bases + [target], scene.frame_start, scene.frame_end)
+        index = {data_path: span for data_path, span in index.items() if data_path in targeted}
+        if not index:
+            return
+        first, last = index_frame_range(index)
+        frames = np.arange(first, last + 1, dtype=np.float64)
+        finished = evaluate_layer_stack(obj, [target], frames, index)
+        below = evaluate_layer_stack(obj, bases, frames, index)
+
+        action = new_layer_action(f"Additive_{target.name}")
+        for data_path, (values, keyed, group) in finished.items():
+            size = values.shape[1]
+            defaults = channel_defaults(data_path, size)
+            base_values = below[data_path][0] if data_path in below else np.tile(defaults, (len(frames), 1))
+            delta = extract_combine_delta(base_values, values, channel_mix_mode(data_path), defaults)
+            span_first, span_last = index[data_path]
+            span = slice(span_first - first, span_last - first + 1)
+            for array_index in sorted(keyed):
+                fcurve = action.fcurves.new(data_path, index=array_index, action_group=group)
+                write_keyframes(fcurve, np.column_stack((frames[span], delta[span, array_index])))
+        if self.clean_curves:
+            optimize_action(action, OPTIMIZE_TOLERANCES)
+        if not action.fcurves:
+            bpy.data.actions.remove(action)
+            return
+        self.keys += sum(len(fcurve.keyframe_points) for fcurve in action.fcurves)
+        self.layers += 1
+
+        # The strip starts on the first remaining key, so action frames stay scene frames
+        create_layer(obj, f"{target.name} Additive", action, int(np.floor(action.frame_range[0])))
+        if self.hide_target:
+            target.visible = False
 
     def invoke(self, context, event):
+        obj = context.object
+        if obj and obj.animation_layers and not self.target_layer:
+            self.target_layer = obj.animation_layers[obj.active_animation_layer].name
         return context.window_manager.invoke_props_dialog(self)
 
     def draw(self, context):
         layout = self.layout
+        obj = context.object
+        layout.prop_search(self, "target_layer", obj, "animation_layers")
+        layout.prop(self, "base")
+        if self.base == 'LAYER':
+            layout.prop_search(self, "base_layer", obj, "animation_layers")
+        layout.prop(self, "hide_target")
         layout.prop(self, "clean_curves")
+        layout.prop(self, "all_selected")
 
-class ANIMLAYER_OT_move_layer(Operator):
-    bl_idname = "animlayer.move_layer"
-    bl_label = "Move Layer"
-    bl_description = "Move the selected layer up or down"
+class ANIMLAYER_OT_restore_version(Operator):
+    bl_idname = "animlayer.restore_version"
+    bl_label = "Restore Version"
+    bl_description = "Restore a previous version of the active layer, keeping the current one in its history"
     bl_options = {'REGISTER', 'UNDO'}
 
-    direction: EnumProperty(
-        items=[
-            ('UP', "Up", "Move the layer up"),
-            ('DOWN', "Down", "Move the layer down"),
-        ],
-        name="Direction",
-        description="Direction to move the layer",
-        default='UP'
-    )
+    index: IntProperty()
 
     @classmethod
     def poll(cls, context):
         obj = context.object
-        return obj and obj.animation_layers and len(obj.animation_layers) > 1
+        return obj and obj.animation_layers and not obj.animation_layers[obj.active_animation_layer].is_editing
 
+    @profiled('operator')
     def execute(self, context):
         obj = context.object
-        layers = obj.animation_layers
-        active_index = obj.active_animation_layer
+        layer = obj.animation_layers[obj.active_animation_layer]
+        track = get_layer_track(obj, layer)
+        if not (track and track.strips and track.strips[0].action and 0 <= self.index < len(layer.versions)):
+            return {'CANCELLED'}
 
-        if self.direction == 'UP' and active_index > 0:
-            layers.move(active_index, active_index - 1)
-            obj.active_animation_layer -= 1
-        elif self.direction == 'DOWN' and active_index < len(layers) - 1:
-            layers.move(active_index, active_index + 1)
-            obj.active_animation_layer += 1
+        version = layer.versions[self.index]
+        stored = bpy.data.actions.get(version.action_name)
+        if stored is None:
+            layer.versions.remove(self.index)
+            self.report({'WARNING'}, f"Action '{version.action_name}' no longer exists")
+            return {'CANCELLED'}
+        version.last_used = int(time.time())
 
-        if obj.animation_data:
-            tracks = obj.animation_data.nla_tracks
-            track = tracks.get(layers[active_index].nla_track_name)
-            if track:
-                if self.direction == 'UP' and active_index > 0:
-                    tracks.move(tracks.find(track.name), tracks.find(track.name) - 1)
-                elif self.direction == 'DOWN' and active_index < len(layers) - 1:
-                    tracks.move(tracks.find(track.name), tracks.find(track.name) + 1)
+        strip = track.strips[0]
+        current = strip.action
+        if version.partial:
+            channels = set(json.loads(version.channels))
+            backup = snapshot_channels(current, channels, f"{current.name}_partial")
+            for fcurve in [fcurve for fcurve in current.fcurves if fcurve.data_path in channels]:
+                current.fcurves.remove(fcurve)
+            for fcurve in stored.fcurves:
+                copy_fcurve(fcurve, current)
+            push_layer_version(layer, backup, "Before restore", channels)
+        else:
+            strip.action = new_layer_action(f"Action_{layer.name}", stored)
+            push_layer_version(layer, current, "Before restore")
 
+        invalidate_layer_cache(obj)
         return {'FINISHED'}
 
-class ANIMLAYER_OT_exit_edit(Operator):
-    bl_idname = "animlayer.exit_edit"
-    bl_label = "Exit Edit Mode"
-    bl_description = "Exit layer editing and save changes"
+class ANIMLAYER_OT_purge_actions(Operator):
+    bl_idname = "animlayer.purge_actions"
+    bl_label = "Purge Unused Layer Actions"
+    bl_description = "Delete the layer actions that no layer, strip or object uses any more"
     bl_options = {'REGISTER', 'UNDO'}
 
+    count: IntProperty(options={'HIDDEN', 'SKIP_SAVE'})
+
+    @profiled('operator')
     def execute(self, context):
+        orphans = orphan_layer_actions()
+        reclaimed = sum(estimate_action_bytes(action) for action in orphans)
+        bpy.data.batch_remove(orphans)
+        self.report({'INFO'}, f"Removed {len(orphans)} action(s), about {reclaimed / (1024 * 1024):.2f} MB")
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        orphans = orphan_layer_actions()
+        if not orphans:
+            self.report({'INFO'}, "No unused layer actions")
+            return {'CANCELLED'}
+        self.count = len(orphans)
+        return context.window_manager.invoke_props_dialog(self)
+
+    def draw(self, context):
+        self.layout.label(text=f"Delete {self.count} unused layer action(s)?", icon='ERROR')
+
+class ANIMLAYER_OT_show_only_selected(Operator):
+    bl_idname = "animlayer.show_only_selected"
+    bl_label = "Show Only Selected Layers"
+    bl_description = "Show the selected layers and hide all others"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
         obj = context.object
-        active_layer = obj.animation_layers[obj.active_animation_layer]
-        
-        if obj.animation_data:
-            track = obj.animation_data.nla_tracks.get(active_layer.nla_track_name)
-            if track and track.strips:
-                edited_action = obj.animation_data.action
-                original_action_name = active_layer.get("original_action_name")
-                
-                if edited_action:
-                    # Keep original action intact, just update the strip
-                    track.strips[0].action = edited_action
-                    edited_action.name = f"{original_action_name}_merged"
-                    
-                    # Restore original action if it exists
-                    original_action = bpy.data.actions.get(original_action_name)
-                    if original_action:
-                        original_action.use_fake_user = True  # Protect from deletion
-                    
-                    # Clean up
-                    obj.animation_data.action = None
-                    track.mute = False
-                    del active_layer["original_action_name"]
-                    active_layer.is_editing = False
+        return obj and obj.animation_layers and any(layer.selected for layer in obj.animation_layers)
 
+    @profiled('operator')
+    def execute(self, context):
+        obj = context.object
+        with layer_state_batch(obj):
+            for layer in obj.animation_layers:
+                layer.visible = layer.selected
+                layer.solo = False
         return {'FINISHED'}
 
 class ANIMLAYER_PT_main_panel(Panel):
@@ -536,27 +4482,302 @@ class ANIMLAYER_PT_main_panel(Panel):
     def draw(self, context):
         layout = self.layout
         obj = context.object
+        all_selected = context.scene.animation_layer_settings.affect_all_selected
 
         row = layout.row()
         row.template_list("ANIMLAYER_UL_layers", "", obj, "animation_layers", obj, "active_animation_layer")
 
         col = row.column(align=True)
-        col.operator("animlayer.add_layer", icon='ADD', text="")
-        col.operator("animlayer.remove_layer", icon='REMOVE', text="")
+        col.operator("animlayer.add_layer", icon='ADD', text="").all_selected = all_selected
+        col.operator("animlayer.remove_layer", icon='REMOVE', text="").all_selected = all_selected
         col.separator()
-        col.operator("animlayer.move_layer", icon='TRIA_UP', text="").direction = 'UP'
-        col.operator("animlayer.move_layer", icon='TRIA_DOWN', text="").direction = 'DOWN'
+        for direction, icon in (('UP', 'TRIA_UP'), ('DOWN', 'TRIA_DOWN')):
+            op = col.operator("animlayer.move_layer", icon=icon, text="")
+            op.direction = direction
+            op.all_selected = all_selected
 
         if obj.animation_layers:
-            layout.operator("animlayer.assign_to_layer", icon='NLA', text="Assign Current Animation to Layer")
+            layout.operator("animlayer.assign_to_layer", icon='NLA',
+                            text="Assign Current Animation to Layer").all_selected = all_selected
             active_layer = obj.animation_layers[obj.active_animation_layer]
             if active_layer.is_editing:
-                layout.operator("animlayer.exit_edit", icon='BACK', text="Exit Edit")
+                layout.operator("animlayer.exit_edit", icon='BACK', text="Exit Edit").all_selected = all_selected
             else:
-                layout.operator("animlayer.edit_layer", icon='GREASEPENCIL', text="Edit Layer Animation")
-            layout.operator("animlayer.merge_layers", icon='AUTOMERGE_ON', text="Merge Selected Layers")
+                layout.operator("animlayer.edit_layer", icon='GREASEPENCIL',
+                                text="Edit Layer Animation").all_selected = all_selected
+                row = layout.row(align=True)
+                row.operator("animlayer.key_active_layer", icon='KEY_HLT',
+                             text="Key Active Layer").all_selected = all_selected
+                row.prop(context.scene.animation_layer_settings, "live_keying", icon='REC', text="")
+            if all_selected:
+                op = layout.operator("animlayer.solo_layer", icon='SOLO_ON' if active_layer.solo else 'SOLO_OFF',
+                                     text="Unsolo Active Layer" if active_layer.solo else "Solo Active Layer")
+                op.layer_name = active_layer.name
+                op.solo = not active_layer.solo
+                op.all_selected = True
+            layout.operator("animlayer.merge_layers", icon='AUTOMERGE_ON',
+                            text="Merge Selected Layers").all_selected = all_selected
+            layout.operator("animlayer.optimize_layers", icon='GRAPH',
+                            text="Optimize Layer Keys").all_selected = all_selected
+            layout.operator("animlayer.extract_additive", icon='MOD_OFFSET',
+                            text="Extract Additive Layer").all_selected = all_selected
+            layout.operator("animlayer.show_only_selected", icon='HIDE_OFF', text="Show Only Selected")
+        layout.operator("animlayer.bake_visual", icon='REC', text="Bake Visual to Layer").all_selected = all_selected
+        layout.operator("animlayer.import_take", icon='IMPORT')
+        row = layout.row(align=True)
+        row.operator("animlayer.export_layers", icon='EXPORT', text="Export Layers")
+        row.operator("animlayer.import_layers", icon='IMPORT', text="Import Layers")
+
+class ANIMLAYER_PT_settings(Panel):
+    bl_label = "Settings"
+    bl_idname = "ANIMLAYER_PT_settings"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = 'Animation'
+    bl_parent_id = "ANIMLAYER_PT_main_panel"
+    bl_options = {'DEFAULT_CLOSED'}
+
+    def draw(self, context):
+        layout = self.layout
+        settings = context.scene.animation_layer_settings
+        layout.prop(settings, "coalesce_influence_keys")
+        layout.prop(settings, "affect_all_selected")
+        layout.prop(settings, "use_evaluation_cache")
+        if settings.use_evaluation_cache:
+            layout.prop(settings, "evaluation_cache_megabytes")
+            used = sum(entry["bytes"] for entry in LAYER_EVAL_CACHE.values()) / (1024 * 1024)
+            layout.label(text=f"{len(LAYER_EVAL_CACHE)} object(s) cached, {used:.1f} MB")
+
+class ANIMLAYER_PT_layer_mask(Panel):
+    bl_label = "Channel Mask"
+    bl_idname = "ANIMLAYER_PT_layer_mask"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = 'Animation'
+    bl_parent_id = "ANIMLAYER_PT_main_panel"
+    bl_options = {'DEFAULT_CLOSED'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.object is not None and len(context.object.animation_layers) > 0
+
+    def draw_header(self, context):
+        obj = context.object
+        self.layout.prop(obj.animation_layers[obj.active_animation_layer], "use_mask", text="")
+
+    def draw(self, context):
+        layout = self.layout
+        obj = context.object
+        layer = obj.animation_layers[obj.active_animation_layer]
+        all_selected = context.scene.animation_layer_settings.affect_all_selected
+        layout.active = layer.use_mask
+        layout.prop(layer, "mask_bone_collections")
+        layout.prop(layer, "mask_patterns")
+        paths = json.loads(layer.mask_paths) if layer.mask_paths else []
+        row = layout.row(align=True)
+        row.label(text=f"{len(paths)} explicit channel(s)")
+        for mode, icon in (('ADD', 'ADD'), ('REMOVE', 'REMOVE'), ('CLEAR', 'X')):
+            op = row.operator("animlayer.mask_selection", icon=icon, text="")
+            op.mode = mode
+            op.all_selected = all_selected
+        layout.prop(layer, "mask_invert")
+        if layer.masked_curves:
+            layout.label(text=f"{len(json.loads(layer.masked_curves))} F-curve(s) masked out")
+
+class ANIMLAYER_PT_snapshots(Panel):
+    bl_label = "Snapshots"
+    bl_idname = "ANIMLAYER_PT_snapshots"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = 'Animation'
+    bl_parent_id = "ANIMLAYER_PT_main_panel"
+    bl_options = {'DEFAULT_CLOSED'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.object is not None and len(context.object.animation_layers) > 0
+
+    def draw(self, context):
+        layout = self.layout
+        obj = context.object
+        all_selected = context.scene.animation_layer_settings.affect_all_selected
+        layout.operator("animlayer.save_snapshot", icon='ADD', text="Save Snapshot").all_selected = all_selected
+        col = layout.column(align=True)
+        if not obj.animation_layer_snapshots:
+            col.label(text="No snapshots")
+        for snapshot in obj.animation_layer_snapshots:
+            row = col.row(align=True)
+            op = row.operator("animlayer.apply_snapshot", text=snapshot.name)
+            op.name = snapshot.name
+            op.all_selected = all_selected
+            op = row.operator("animlayer.remove_snapshot", icon='X', text="")
+            op.name = snapshot.name
+            op.all_selected = all_selected
+
+class ANIMLAYER_PT_history(Panel):
+    bl_label = "History"
+    bl_idname = "ANIMLAYER_PT_history"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = 'Animation'
+    bl_parent_id = "ANIMLAYER_PT_main_panel"
+    bl_options = {'DEFAULT_CLOSED'}
+
+    def draw(self, context):
+        layout = self.layout
+        obj = context.object
+        settings = context.scene.animation_layer_settings
+        col = layout.column(align=True)
+        col.prop(settings, "history_max_versions")
+        col.prop(settings, "history_max_megabytes")
+
+        if obj.animation_layers:
+            layer = obj.animation_layers[obj.active_animation_layer]
+            col = layout.column(align=True)
+            if not layer.versions:
+                col.label(text="No previous versions")
+            # Newest first
+            for index in reversed(range(len(layer.versions))):
+                version = layer.versions[index]
+                row = col.row(align=True)
+                stamp = time.strftime("%H:%M", time.localtime(version.created))
+                size = f"{version.size / 1024:.0f} KB"
+                row.label(text=f"{stamp} {version.label}{' (partial)' if version.partial else ''}, {size}")
+                row.operator("animlayer.restore_version", icon='LOOP_BACK', text="").index = index
+
+        layout.operator("animlayer.purge_actions", icon='TRASH')
+
+class ANIMLAYER_PT_scene_layers(Panel):
+    bl_label = "Scene Layers"
+    bl_idname = "ANIMLAYER_PT_scene_layers"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = 'Animation'
+    bl_options = {'DEFAULT_CLOSED'}
+
+    @profiled('draw')
+    def draw(self, context):
+        layout = self.layout
+        scene = context.scene
+        settings = scene.animation_layer_settings
+
+        row = layout.row(align=True)
+        row.prop(settings, "index_filter_name", text="", icon='VIEWZOOM')
+        row.prop(settings, "index_filter_state", text="")
+        row = layout.row(align=True)
+        row.prop(settings, "index_sort", text="")
+        row.prop(settings, "index_sort_reverse", text="",
+                 icon='SORT_DESC' if settings.index_sort_reverse else 'SORT_ASC')
+
+        view = scene_layer_view(scene, settings)
+        pages = max(1, -(-len(view) // settings.index_page_size))
+        page = min(settings.index_page, pages)
+        start = (page - 1) * settings.index_page_size
+
+        col = layout.column(align=True)
+        if not view:
+            col.label(text="No layers match")
+        for entry in view[start:start + settings.index_page_size]:
+            obj = scene.objects.get(entry["object"])
+            layers = obj.animation_layers if obj else ()
+            if entry["index"] >= len(layers) or layers[entry["index"]].name != entry["name"]:
+                continue  # Changed since the index was built, the next draw rebuilds it
+            layer = layers[entry["index"]]
+            row = col.row(align=True)
+            row.prop(layer, "selected", text="")
+            row.label(text=obj.name, icon='OBJECT_DATA')
+            row.prop(layer, "name", text="", emboss=False)
+            row.prop(layer, "visible", text="", icon='HIDE_OFF' if layer.visible else 'HIDE_ON', emboss=False)
+            row.prop(layer, "influence", text="", emboss=False, slider=True)
+            row.prop(layer, "solo", text="", icon='SOLO_ON' if layer.solo else 'SOLO_OFF', emboss=False)
+            row.label(text="", icon='GREASEPENCIL' if entry["editing"] else
+                      'KEYTYPE_KEYFRAME_VEC' if entry["keyed"] else 'BLANK1')
+
+        row = layout.row(align=True)
+        row.label(text=f"{len(view)} layer(s), page {page} of {pages}")
+        row.prop(settings, "index_page", text="")
+        row.prop(settings, "index_page_size", text="")
+
+        col = layout.column(align=True)
+        row = col.row(align=True)
+        for action, icon, text in (('SHOW', 'HIDE_OFF', "Show"), ('HIDE', 'HIDE_ON', "Hide"),
+                                   ('ISOLATE', 'SOLO_ON', "Isolate")):
+            row.operator("animlayer.bulk_layers", icon=icon, text=text).action = action
+        row = col.row(align=True)
+        for action, icon, text in (('SELECT', 'CHECKBOX_HLT', "Select"), ('DESELECT', 'CHECKBOX_DEHLT', "Deselect")):
+            row.operator("animlayer.bulk_layers", icon=icon, text=text).action = action
+        op = row.operator("animlayer.bulk_layers", icon='KEY_HLT', text="Influence")
+        op.action = 'INFLUENCE'
+
+class ANIMLAYER_OT_reset_profile(Operator):
+    bl_idname = "animlayer.reset_profile"
+    bl_label = "Reset Profile"
+    bl_description = "Clear the recorded timings and counters"
+
+    def execute(self, context):
+        reset_profile()
+        return {'FINISHED'}
+
+class ANIMLAYER_OT_export_profile(Operator, ExportHelper):
+    bl_idname = "animlayer.export_profile"
+    bl_label = "Export Chrome Trace"
+    bl_description = "Save the recorded profile as Chrome trace JSON (open it in chrome://tracing or Perfetto)"
+
+    filename_ext = ".json"
+    filter_glob: StringProperty(default="*.json", options={'HIDDEN'})
+
+    def execute(self, context):
+        with open(self.filepath, "w") as trace_file:
+            json.dump(chrome_trace(), trace_file)
+        self.report({'INFO'}, f"Saved {len(PROFILER['events'])} events to {self.filepath}")
+        return {'FINISHED'}
+
+class ANIMLAYER_PT_profiler(Panel):
+    bl_label = "Profiler"
+    bl_idname = "ANIMLAYER_PT_profiler"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = 'Animation'
+    bl_parent_id = "ANIMLAYER_PT_main_panel"
+    bl_options = {'DEFAULT_CLOSED'}
+
+    def draw_header(self, context):
+        self.layout.prop(context.window_manager, "animation_layer_profiling", text="")
+
+    def draw(self, context):
+        layout = self.layout
+        layout.active = PROFILER["enabled"]
+        row = layout.row(align=True)
+        row.operator("animlayer.reset_profile", icon='TRASH', text="Reset")
+        row.operator("animlayer.export_profile", icon='EXPORT', text="Export Trace")
+
+        stats = sorted(PROFILER["stats"].items(), key=lambda item: item[1][1], reverse=True)
+        if not stats:
+            layout.label(text="No timings recorded")
+            return
+
+        # Slowest spans by total time
+        col = layout.column(align=True)
+        header = col.row()
+        header.label(text="Span")
+        header.label(text="Calls")
+        header.label(text="Total ms")
+        header.label(text="Max ms")
+        for name, (calls, total, longest) in stats[:15]:
+            row = col.row()
+            row.label(text=name)
+            row.label(text=str(calls))
+            row.label(text=f"{total * 1000:.2f}")
+            row.label(text=f"{longest * 1000:.2f}")
+
+        col = layout.column(align=True)
+        for name, value in sorted(PROFILER["counters"].items()):
+            col.label(text=f"{name.replace('_', ' ').capitalize()}: {value}")
 
 def register():
+    bpy.utils.register_class(AnimationLayerSettings)
+    bpy.utils.register_class(LayerVersion)
+    bpy.utils.register_class(LayerSnapshot)
     bpy.utils.register_class(AnimationLayer)
     bpy.utils.register_class(ANIMLAYER_UL_layers)
     bpy.utils.register_class(ANIMLAYER_OT_add_layer)
@@ -568,14 +4789,123 @@ def register():
     bpy.utils.register_class(ANIMLAYER_OT_exit_edit)
     bpy.utils.register_class(ANIMLAYER_PT_main_panel)
     bpy.utils.register_class(ANIMLAYER_OT_animate_influence)
+    bpy.utils.register_class(ANIMLAYER_PT_settings)
+    bpy.utils.register_class(ANIMLAYER_OT_show_only_selected)
+    bpy.utils.register_class(ANIMLAYER_OT_solo_layer)
+    bpy.utils.register_class(ANIMLAYER_OT_optimize_layers)
+    bpy.utils.register_class(ANIMLAYER_OT_import_take)
+    bpy.utils.register_class(ANIMLAYER_OT_export_layers)
+    bpy.utils.register_class(ANIMLAYER_OT_import_layers)
+    bpy.utils.register_class(ANIMLAYER_OT_bulk_layers)
+    bpy.utils.register_class(ANIMLAYER_OT_bake_visual)
+    bpy.utils.register_class(ANIMLAYER_OT_key_active_layer)
+    bpy.utils.register_class(ANIMLAYER_OT_mask_selection)
+    bpy.utils.register_class(ANIMLAYER_OT_save_snapshot)
+    bpy.utils.register_class(ANIMLAYER_OT_apply_snapshot)
+    bpy.utils.register_class(ANIMLAYER_OT_remove_snapshot)
+    bpy.utils.register_class(ANIMLAYER_OT_extract_additive)
+    bpy.utils.register_class(ANIMLAYER_OT_restore_version)
+    bpy.utils.register_class(ANIMLAYER_OT_purge_actions)
+    bpy.utils.register_class(ANIMLAYER_PT_layer_mask)
+    bpy.utils.register_class(ANIMLAYER_PT_snapshots)
+    bpy.utils.register_class(ANIMLAYER_PT_history)
+    bpy.utils.register_class(ANIMLAYER_PT_scene_layers)
+    bpy.utils.register_class(ANIMLAYER_OT_reset_profile)
+    bpy.utils.register_class(ANIMLAYER_OT_export_profile)
+    bpy.utils.register_class(ANIMLAYER_PT_profiler)
     
     bpy.types.Object.animation_layers = CollectionProperty(type=AnimationLayer)
     bpy.types.Object.active_animation_layer = IntProperty()
+    bpy.types.Object.animation_layer_snapshots = CollectionProperty(type=LayerSnapshot)
+    bpy.types.Scene.animation_layer_settings = PointerProperty(type=AnimationLayerSettings)
+    # Kept on the window manager so profiling is never saved into a file
+    bpy.types.WindowManager.animation_layer_profiling = BoolProperty(
+        name="Profiling",
+        description="Record timings and counters of the layer operators",
+        default=False,
+        update=lambda self, context: set_profiling(self.animation_layer_profiling)
+    )
+
+    bpy.app.handlers.depsgraph_update_post.append(mark_dirty_actions)
+    bpy.app.handlers.load_post.append(clear_merge_snapshots)
+    bpy.app.handlers.undo_post.append(clear_merge_snapshots)
+    bpy.app.handlers.redo_post.append(clear_merge_snapshots)
+    bpy.app.handlers.depsgraph_update_post.append(update_layer_track_cache)
+    bpy.app.handlers.load_post.append(clear_layer_track_cache)
+    bpy.app.handlers.undo_post.append(clear_layer_track_cache)
+    bpy.app.handlers.redo_post.append(clear_layer_track_cache)
+    bpy.app.handlers.save_pre.append(flush_influence_keys_on_save)
+    bpy.app.handlers.load_pre.append(discard_influence_keys)
+    bpy.app.handlers.depsgraph_update_post.append(stage_live_keys)
+    bpy.app.handlers.load_pre.append(discard_live_keys)
+    bpy.app.handlers.depsgraph_update_post.append(count_depsgraph_updates)
+    bpy.app.handlers.frame_change_pre.append(apply_evaluation_cache)
+    bpy.app.handlers.depsgraph_update_post.append(track_cache_edits)
+    bpy.app.handlers.save_pre.append(restore_cached_tracks)
+    bpy.app.handlers.load_pre.append(clear_evaluation_cache)
+    bpy.app.handlers.undo_post.append(clear_evaluation_cache)
+    bpy.app.handlers.redo_post.append(clear_evaluation_cache)
 
 def unregister():
+    bpy.app.handlers.depsgraph_update_post.remove(mark_dirty_actions)
+    bpy.app.handlers.load_post.remove(clear_merge_snapshots)
+    bpy.app.handlers.undo_post.remove(clear_merge_snapshots)
+    bpy.app.handlers.redo_post.remove(clear_merge_snapshots)
+    bpy.app.handlers.depsgraph_update_post.remove(update_layer_track_cache)
+    bpy.app.handlers.load_post.remove(clear_layer_track_cache)
+    bpy.app.handlers.undo_post.remove(clear_layer_track_cache)
+    bpy.app.handlers.redo_post.remove(clear_layer_track_cache)
+    bpy.app.handlers.save_pre.remove(flush_influence_keys_on_save)
+    bpy.app.handlers.load_pre.remove(discard_influence_keys)
+    bpy.app.handlers.depsgraph_update_post.remove(stage_live_keys)
+    bpy.app.handlers.load_pre.remove(discard_live_keys)
+    bpy.app.handlers.depsgraph_update_post.remove(count_depsgraph_updates)
+    bpy.app.handlers.frame_change_pre.remove(apply_evaluation_cache)
+    bpy.app.handlers.depsgraph_update_post.remove(track_cache_edits)
+    bpy.app.handlers.save_pre.remove(restore_cached_tracks)
+    bpy.app.handlers.load_pre.remove(clear_evaluation_cache)
+    bpy.app.handlers.undo_post.remove(clear_evaluation_cache)
+    bpy.app.handlers.redo_post.remove(clear_evaluation_cache)
+    release_evaluation_cache()
+    set_profiling(False)
+    clear_layer_track_cache()
+    if bpy.app.timers.is_registered(commit_influence_keys):
+        bpy.app.timers.unregister(commit_influence_keys)
+    if bpy.app.timers.is_registered(commit_live_keys):
+        bpy.app.timers.unregister(commit_live_keys)
+    PENDING_LIVE_KEYS.clear()
+    flush_influence_keys(push_undo=False)
+
     del bpy.types.Object.animation_layers
     del bpy.types.Object.active_animation_layer
+    del bpy.types.Object.animation_layer_snapshots
+    del bpy.types.Scene.animation_layer_settings
+    del bpy.types.WindowManager.animation_layer_profiling
     
+    bpy.utils.unregister_class(ANIMLAYER_PT_profiler)
+    bpy.utils.unregister_class(ANIMLAYER_OT_export_profile)
+    bpy.utils.unregister_class(ANIMLAYER_OT_reset_profile)
+    bpy.utils.unregister_class(ANIMLAYER_PT_scene_layers)
+    bpy.utils.unregister_class(ANIMLAYER_PT_history)
+    bpy.utils.unregister_class(ANIMLAYER_PT_snapshots)
+    bpy.utils.unregister_class(ANIMLAYER_PT_layer_mask)
+    bpy.utils.unregister_class(ANIMLAYER_OT_purge_actions)
+    bpy.utils.unregister_class(ANIMLAYER_OT_restore_version)
+    bpy.utils.unregister_class(ANIMLAYER_OT_extract_additive)
+    bpy.utils.unregister_class(ANIMLAYER_OT_remove_snapshot)
+    bpy.utils.unregister_class(ANIMLAYER_OT_apply_snapshot)
+    bpy.utils.unregister_class(ANIMLAYER_OT_save_snapshot)
+    bpy.utils.unregister_class(ANIMLAYER_OT_mask_selection)
+    bpy.utils.unregister_class(ANIMLAYER_OT_key_active_layer)
+    bpy.utils.unregister_class(ANIMLAYER_OT_bake_visual)
+    bpy.utils.unregister_class(ANIMLAYER_OT_bulk_layers)
+    bpy.utils.unregister_class(ANIMLAYER_OT_import_layers)
+    bpy.utils.unregister_class(ANIMLAYER_OT_export_layers)
+    bpy.utils.unregister_class(ANIMLAYER_OT_import_take)
+    bpy.utils.unregister_class(ANIMLAYER_OT_optimize_layers)
+    bpy.utils.unregister_class(ANIMLAYER_OT_solo_layer)
+    bpy.utils.unregister_class(ANIMLAYER_OT_show_only_selected)
+    bpy.utils.unregister_class(ANIMLAYER_PT_settings)
     bpy.utils.unregister_class(ANIMLAYER_PT_main_panel)
     bpy.utils.unregister_class(ANIMLAYER_OT_move_layer)
     bpy.utils.unregister_class(ANIMLAYER_OT_merge_layers)
@@ -585,8 +4915,11 @@ def unregister():
     bpy.utils.unregister_class(ANIMLAYER_OT_add_layer)
     bpy.utils.unregister_class(ANIMLAYER_UL_layers)
     bpy.utils.unregister_class(AnimationLayer)
+    bpy.utils.unregister_class(LayerSnapshot)
+    bpy.utils.unregister_class(LayerVersion)
     bpy.utils.unregister_class(ANIMLAYER_OT_animate_influence)
     bpy.utils.unregister_class(ANIMLAYER_OT_exit_edit)
+    bpy.utils.unregister_class(AnimationLayerSettings)
 
 if __name__ == "__main__":
     register()
\ No newline at end of file
@@ -0,0 +1,230 @@
+# Flatten the animation layers of many .blend files from the command line.
+#
+#   blender --background --factory-startup --python animation_layers_batch.py -- shots/ --jobs 8
+#
+# The process started this way only schedules work: every file is opened by its
+# own worker Blender process, merged and saved. Finished files are appended to a
+# journal so an interrupted run picks up where it stopped.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+RESULT_PREFIX = "ANIMLAYER_RESULT "
+JOURNAL_NAME = ".animation_layers_batch.jsonl"
+
+def script_args():
+    return sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="blender --background --python animation_layers_batch.py --",
+        description="Merge the animation layers of every object in a set of .blend files")
+    parser.add_argument("paths", nargs="*", help=".blend files or directories to search recursively")
+    parser.add_argument("--file-list", help="Text file with one .blend path per line")
+    parser.add_argument("--output-dir", help="Save results here instead of overwriting the source files")
+    parser.add_argument("--method", choices=("DIRECT", "VISUAL"), default='DIRECT', help="Merge method")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds before a worker is killed")
+    parser.add_argument("--blender", help="Blender executable for the workers (defaults to the running one)")
+    parser.add_argument("--journal", help=f"Resume journal (defaults to {JOURNAL_NAME} in the output directory "
+                                          "or the current directory)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the journal and process every file again")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--save-to", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def collect_files(args):
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".blend"))
+        else:
+            files.append(path)
+    if args.file_list:
+        with open(args.file_list) as handle:
+            files.extend(line.strip() for line in handle if line.strip() and not line.startswith("#"))
+
+    # Keep the first occurrence of every file
+    seen = set()
+    unique = []
+    for path in files:
+        path = os.path.abspath(path)
+        if path not in seen:
+            seen.add(path)
+            unique.append(path)
+    return unique
+
+def output_path(args, path):
+    if not args.output_dir:
+        return path
+    return os.path.join(os.path.abspath(args.output_dir), os.path.basename(path))
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def load_journal(path):
+    # Latest entry per source file
+    done = {}
+    if os.path.exists(path):
+        with open(path) as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Partially written line from a crash
+                done[entry["file"]] = entry
+    return done
+
+def is_finished(entry, path, target):
+    # A file counts as done if it merged cleanly and the saved result is still the one we wrote
+    if not entry or entry.get("status") != "ok" or not os.path.exists(target):
+        return False
+    return list(file_signature(target)) == entry.get("signature")
+
+def run_worker(blender, script, path, target, method, timeout):
+    command = [blender, "--background", "--factory-startup", path,
+               "--python-exit-code", "1", "--python", script,
+               "--", "--worker", path, "--save-to", target, "--method", method]
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 text=True, errors="replace", timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"status": "timeout", "seconds": time.perf_counter() - start}
+
+    result = {"status": "failed", "returncode": process.returncode}
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            result.update(json.loads(line[len(RESULT_PREFIX):]))
+    if result["status"] != "ok":
+        result["log"] = process.stdout[-2000:]
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def run_batch(args):
+    files = collect_files(args)
+    if not files:
+        print("No .blend files found")
+        return 1
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    journal_path = args.journal or os.path.join(os.path.abspath(args.output_dir or os.getcwd()), JOURNAL_NAME)
+    done = {} if args.restart else load_journal(journal_path)
+    pending = [path for path in files if not is_finished(done.get(path), path, output_path(args, path))]
+    skipped = len(files) - len(pending)
+    if skipped:
+        print(f"Resuming: {skipped} of {len(files)} file(s) already merged")
+
+    blender = args.blender
+    if not blender:
+        try:
+            import bpy
+            blender = bpy.app.binary_path
+        except ImportError:
+            blender = "blender"
+    script = os.path.abspath(__file__)
+
+    jobs = max(1, min(args.jobs, len(pending) or 1))
+    print(f"Merging {len(pending)} file(s) with {jobs} worker(s)")
+    failures = 0
+    start = time.perf_counter()
+    with open(journal_path, "a") as journal, ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(run_worker, blender, script, path, output_path(args, path), args.method, args.timeout): path
+                   for path in pending}
+        for count, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            target = output_path(args, path)
+            result = future.result()
+            entry = {"file": path, "output": target, "time": time.time(), **result}
+            if result["status"] == "ok":
+                entry["signature"] = list(file_signature(target))
+            else:
+                failures += 1
+
+            journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+            elapsed = time.perf_counter() - start
+            remaining = elapsed / count * (len(pending) - count)
+            detail = (f"{result.get('objects', 0)} object(s), merge {result.get('merge_seconds', 0.0):.2f}s"
+                      if result["status"] == "ok" else result.get("error", result["status"]))
+            print(f"[{count}/{len(pending)}] {os.path.basename(path)}: {result['status']} "
+                  f"in {result['seconds']:.2f}s ({detail}), about {remaining:.0f}s left", flush=True)
+            if result["status"] != "ok" and result.get("log"):
+                print(result["log"], flush=True)
+
+    print(f"Done in {time.perf_counter() - start:.1f}s: {len(pending) - failures} merged, "
+          f"{failures} failed, {skipped} skipped. Journal: {journal_path}")
+    return 1 if failures else 0
+
+def load_addon():
+    import bpy
+    if not hasattr(bpy.types.Object, "animation_layers"):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import animation_layers
+        animation_layers.register()
+
+def flatten_scene(method):
+    import bpy
+    load_addon()
+    objects = [obj for obj in bpy.data.objects if obj.animation_layers]
+    view_layer = bpy.context.view_layer
+    selectable = [obj for obj in objects if obj.name in view_layer.objects]
+    if not selectable:
+        return 0
+
+    for obj in view_layer.objects:
+        obj.select_set(obj in selectable)
+    view_layer.objects.active = selectable[0]
+
+    with bpy.context.temp_override(object=selectable[0], active_object=selectable[0], selected_objects=selectable):
+        # Close any layer left in edit mode so its changes are part of the merge
+        bpy.ops.animlayer.exit_edit(all_selected=True)
+        for obj in selectable:
+            for layer in obj.animation_layers:
+                layer.selected = True
+        bpy.ops.animlayer.merge_layers(method=method, all_selected=True)
+    return len(selectable)
+
+def run_worker_process(args):
+    import bpy
+    result = {"file": args.worker}
+    try:
+        start = time.perf_counter()
+        result["objects"] = flatten_scene(args.method)
+        result["merge_seconds"] = time.perf_counter() - start
+
+        # Save next to the target and swap it in, so a crash never leaves a half-written file
+        target = args.save_to or bpy.data.filepath
+        temp = f"{target}.partial"
+        start = time.perf_counter()
+        bpy.ops.wm.save_as_mainfile(filepath=temp, copy=True)
+        os.replace(temp, target)
+        result["save_seconds"] = time.perf_counter() - start
+        result["status"] = "ok"
+    except Exception as error:
+        result["status"] = "failed"
+        result["error"] = f"{type(error).__name__}: {error}"
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+    if result["status"] != "ok":
+        sys.exit(1)
+
+def main():
+    args = parse_args(script_args())
+    if args.worker:
+        run_worker_process(args)
+    else:
+        sys.exit(run_batch(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+# Time the layer operators on synthetic rigs.
+#
+#   blender --background --factory-startup --python animation_layers_benchmark.py -- --output after.json
+#   blender --background --factory-startup --python animation_layers_benchmark.py -- --compare before.json
+#   python animation_layers_benchmark.py --compare before.json after.json
+#
+# Every case of the parameter grid gets a fresh armature with one keyed action per
+# layer. The add-on is loaded from this directory, so a checkout can be compared
+# against the results of another one.
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+GRIDS = {
+    "quick": {"bones": [10, 100], "layers": [1, 5], "frames": [100, 1000], "density": [0.1]},
+    "full": {"bones": [10, 100, 500], "layers": [1, 10, 50], "frames": [100, 1000, 10000],
+             "density": [0.02, 0.1, 0.5]},
+}
+CHANNELS = (("location", 3), ("rotation_quaternion", 4))
+
+def script_args():
+    return sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
+
+def int_list(text):
+    return [int(value) for value in text.split(",")]
+
+def float_list(text):
+    return [float(value) for value in text.split(",")]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="blender --background --python animation_layers_benchmark.py --",
+        description="Benchmark the animation layer operators on synthetic rigs")
+    parser.add_argument("--grid", choices=sorted(GRIDS), default="quick", help="Parameter grid preset")
+    parser.add_argument("--bones", type=int_list, help="Comma separated bone counts, overrides the grid")
+    parser.add_argument("--layers", type=int_list, help="Comma separated layer counts, overrides the grid")
+    parser.add_argument("--frames", type=int_list, help="Comma separated frame range lengths, overrides the grid")
+    parser.add_argument("--density", type=float_list, help="Comma separated keys per frame, overrides the grid")
+    parser.add_argument("--max-keys", type=float, default=2e7,
+                        help="Skip cases with more keyframes than this, 0 runs every case")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions of the non-destructive operators")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic key values")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", nargs="+", metavar="JSON",
+                        help="Baseline results, optionally followed by results to compare instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative slowdown reported as a regression (0.1 is 10%%)")
+    parser.add_argument("--min-delta", type=float, default=0.001,
+                        help="Ignore differences below this many seconds")
+    return parser.parse_args(argv)
+
+def grid_cases(args):
+    grid = dict(GRIDS[args.grid])
+    for name in grid:
+        if getattr(args, name):
+            grid[name] = getattr(args, name)
+    for bones, layers, frames, density in itertools.product(
+            grid["bones"], grid["layers"], grid["frames"], grid["density"]):
+        yield {"bones": bones, "layers": layers, "frames": frames, "density": density}
+
+def case_keys(case):
+    keys_per_curve = max(2, int(case["frames"] * case["density"]))
+    return case["bones"] * sum(size for _, size in CHANNELS) * case["layers"] * keys_per_curve
+
+def case_label(case):
+    return f"bones={case['bones']} layers={case['layers']} frames={case['frames']} density={case['density']}"
+
+def summarize(samples):
+    return {"samples": samples, "median": statistics.median(samples), "min": min(samples)}
+
+def load_addon():
+    import bpy
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import animation_layers
+    if not hasattr(bpy.types.Object, "animation_layers"):
+        animation_layers.register()
+    return animation_layers
+
+def reset_scene():
+    import bpy
+    bpy.data.batch_remove(list(bpy.data.objects) + list(bpy.data.armatures) + list(bpy.data.actions))
+
+def build_rig(context, bone_count):
+    import bpy
+    armature = bpy.data.armatures.new("BenchRig")
+    obj = bpy.data.objects.new("BenchRig", armature)
+    context.scene.collection.objects.link(obj)
+    context.view_layer.objects.active = obj
+    obj.select_set(True)
+
+    # A chain of bones, so parenting is part of the evaluation
+    with context.temp_override(object=obj, active_object=obj):
+        bpy.ops.object.mode_set(mode='EDIT')
+        parent = None
+        for i in range(bone_count):
+            bone = armature.edit_bones.new(f"Bone_{i:03d}")
+            bone.head = (0.0, 0.0, i * 0.1)
+            bone.tail = (0.0, 0.0, i * 0.1 + 0.1)
+            bone.parent = parent
+            parent = bone if i % 10 else None
+        bpy.ops.object.mode_set(mode='OBJECT')
+    for bone in obj.pose.bones:
+        bone.rotation_mode = 'QUATERNION'
+    return obj
+
+def fill_action(addon, action, bones, case, rng):
+    import numpy as np
+    frame_start = 1
+    key_count = max(2, int(case["frames"] * case["density"]))
+    frames = np.linspace(frame_start, frame_start + case["frames"] - 1, key_count)
+    for bone in bones:
+        path = addon.bone_data_path(bone.name)
+        for prop, size in CHANNELS:
+            base = addon.channel_defaults(prop, size)
+            for index in range(size):
+                fcurve = action.fcurves.new(f"{path}.{prop}", index=index, action_group=bone.name)
+                values = base[index] + rng.normal(0.0, 0.1, key_count)
+                addon.write_keyframes(fcurve, np.column_stack((frames, values)))
+
+class StubOperatorProperties:
+    pass
+
+class StubLayout:
+    # Accepts the calls draw_item makes so only the add-on's own work is timed
+    def __init__(self):
+        self.calls = 0
+
+    def row(self, **kwargs):
+        return self
+
+    def column(self, **kwargs):
+        return self
+
+    def prop(self, *args, **kwargs):
+        self.calls += 1
+
+    def label(self, **kwargs):
+        self.calls += 1
+
+    def operator(self, *args, **kwargs):
+        self.calls += 1
+        return StubOperatorProperties()
+
+def time_call(function, repeat=1):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def run_case(addon, case, args):
+    import bpy
+    import numpy as np
+    context = bpy.context
+    rng = np.random.default_rng(args.seed)
+    reset_scene()
+    scene = context.scene
+    scene.frame_start = 1
+    scene.frame_end = case["frames"]
+    scene.frame_set(1)
+
+    results = {}
+    obj = build_rig(context, case["bones"])
+    with context.temp_override(object=obj, active_object=obj, selected_objects=[obj]):
+        layers = obj.animation_layers
+
+        samples = []
+        for _ in range(case["layers"]):
+            samples += time_call(bpy.ops.animlayer.add_layer)
+            fill_action(addon, addon.get_layer_track(obj, layers[-1]).strips[0].action, obj.pose.bones, case, rng)
+        results["add_layer"] = samples
+
+        def toggle_solo():
+            layers[0].solo = True
+            layers[0].solo = False
+        results["solo_toggle"] = time_call(toggle_solo, args.repeat)
+
+        if len(layers) > 1:
+            def move_down_and_up():
+                obj.active_animation_layer = 0
+                bpy.ops.animlayer.move_layer(direction='DOWN')
+                bpy.ops.animlayer.move_layer(direction='UP')
+            results["move_layer"] = time_call(move_down_and_up, args.repeat)
+
+        stub = SimpleNamespace(layout_type='DEFAULT')
+        def draw_list():
+            layout = StubLayout()
+            for item in layers:
+                addon.ANIMLAYER_UL_layers.draw_item(stub, context, layout, obj, item, 0, obj, "active_animation_layer")
+        results["draw_item"] = time_call(draw_list, args.repeat)
+
+        # Key a tenth of the bones while editing, so the exit has changes to fold back.
+        # Keying itself is left out of the timing.
+        obj.active_animation_layer = 0
+        edited = obj.pose.bones[:max(1, case["bones"] // 10)]
+        def edit_and_exit():
+            start = time.perf_counter()
+            bpy.ops.animlayer.edit_layer()
+            elapsed = time.perf_counter() - start
+            fill_action(addon, obj.animation_data.action, edited, case, rng)
+            start = time.perf_counter()
+            bpy.ops.animlayer.exit_edit()
+            return elapsed + time.perf_counter() - start
+        results["edit_layer+exit_edit"] = [edit_and_exit() for _ in range(args.repeat)]
+
+        def assign():
+            action = bpy.data.actions.new("BenchAssign")
+            fill_action(addon, action, obj.pose.bones, case, rng)
+            obj.animation_data.action = action
+            start = time.perf_counter()
+            bpy.ops.animlayer.assign_to_layer()
+            return time.perf_counter() - start
+        results["assign_to_layer"] = [assign() for _ in range(args.repeat)]
+
+        for layer in layers:
+            layer.selected = True
+        results["merge_layers"] = time_call(lambda: bpy.ops.animlayer.merge_layers(method='DIRECT', keep_sources=True))
+        for layer in layers:
+            layer.selected = "merge_state" in layer
+        results["merge_layers_incremental"] = time_call(
+            lambda: bpy.ops.animlayer.merge_layers(method='DIRECT', keep_sources=True), args.repeat)
+        for layer in layers:
+            layer.selected = "merge_state" not in layer
+        results["merge_layers_visual"] = time_call(lambda: bpy.ops.animlayer.merge_layers(method='VISUAL'))
+    return {name: summarize(samples) for name, samples in results.items()}
+
+def metadata():
+    import bpy
+    import numpy as np
+    revision = None
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        pass
+    return {
+        "blender": bpy.app.version_string,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "revision": revision,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def run_benchmarks(args):
+    addon = load_addon()
+    report = {"meta": metadata(), "cases": [], "skipped": []}
+    for case in grid_cases(args):
+        if args.max_keys and case_keys(case) > args.max_keys:
+            print(f"skip  {case_label(case)} ({case_keys(case):.0f} keys)", flush=True)
+            report["skipped"].append(case)
+            continue
+        start = time.perf_counter()
+        operators = run_case(addon, case, args)
+        report["cases"].append({"case": case, "operators": operators})
+        print(f"done  {case_label(case)} in {time.perf_counter() - start:.1f}s", flush=True)
+        for name, timing in operators.items():
+            print(f"      {name:<26} median {timing['median'] * 1000:10.2f} ms   min {timing['min'] * 1000:10.2f} ms")
+    reset_scene()
+    if report["skipped"]:
+        print(f"Skipped {len(report['skipped'])} of {len(report['skipped']) + len(report['cases'])} cases "
+              f"above {args.max_keys:.0f} keys, raise --max-keys or pass 0 to run them")
+    return report
+
+def compare(baseline, current, threshold, min_delta):
+    base = {(case_label(entry["case"]), name): timing["median"]
+            for entry in baseline["cases"] for name, timing in entry["operators"].items()}
+    regressions = 0
+    print(f"{'case':<50} {'operator':<26} {'before ms':>10} {'after ms':>10} {'ratio':>7}")
+    for entry in current["cases"]:
+        label = case_label(entry["case"])
+        for name, timing in entry["operators"].items():
+            before = base.get((label, name))
+            if before is None:
+                continue
+            after = timing["median"]
+            ratio = after / before if before > 0.0 else float("inf")
+            flag = ""
+            if after - before > min_delta and ratio > 1.0 + threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            elif before - after > min_delta and ratio < 1.0 / (1.0 + threshold):
+                flag = "  faster"
+            print(f"{label:<50} {name:<26} {before * 1000:10.2f} {after * 1000:10.2f} {ratio:7.2f}{flag}")
+    print(f"{regressions} regression(s) above {threshold:.0%}")
+    return regressions
+
+def main():
+    args = parse_args(script_args())
+    if args.compare and len(args.compare) > 2:
+        sys.exit("--compare takes a baseline and at most one result file")
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            sys.exit(1 if compare(json.load(before), json.load(after), args.threshold, args.min_delta) else 0)
+
+    report = run_benchmarks(args)
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=1)
+    if args.compare:
+        with open(args.compare[0]) as before:
+            sys.exit(1 if compare(json.load(before), report, args.threshold, args.min_delta) else 0)
+
+if __name__ == "__main__":
+    main()
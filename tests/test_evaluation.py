@@ -0,0 +1,331 @@
+# NumPy layer evaluation checked without Blender. bpy is replaced by a stub that only
+# covers what the add-on touches at import time, so run these with a plain Python:
+#
+#   python -m unittest discover -s tests
+
+import math
+import os
+import sys
+import types
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+
+def install_bpy_stub():
+    if "bpy" in sys.modules:
+        return
+    def prop(*args, **kwargs):
+        return None
+    bpy = types.ModuleType("bpy")
+    bpy.props = types.ModuleType("bpy.props")
+    for name in ("StringProperty", "BoolProperty", "FloatProperty", "CollectionProperty", "IntProperty",
+                 "EnumProperty", "PointerProperty"):
+        setattr(bpy.props, name, prop)
+    bpy.types = types.ModuleType("bpy.types")
+    for name in ("PropertyGroup", "UIList", "Operator", "Panel", "Action", "Object"):
+        setattr(bpy.types, name, type(name, (), {}))
+    bpy.app = types.ModuleType("bpy.app")
+    bpy.app.handlers = types.ModuleType("bpy.app.handlers")
+    bpy.app.handlers.persistent = lambda function: function
+    bpy_extras = types.ModuleType("bpy_extras")
+    bpy_extras.io_utils = types.ModuleType("bpy_extras.io_utils")
+    bpy_extras.io_utils.ExportHelper = type("ExportHelper", (), {})
+    bpy_extras.io_utils.ImportHelper = type("ImportHelper", (), {})
+    sys.modules.update({"bpy": bpy, "bpy.props": bpy.props, "bpy.types": bpy.types, "bpy.app": bpy.app,
+                        "bpy.app.handlers": bpy.app.handlers, "bpy_extras": bpy_extras,
+                        "bpy_extras.io_utils": bpy_extras.io_utils})
+
+
+install_bpy_stub()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import animation_layers as al  # noqa: E402
+
+
+class KeyframePoints:
+    # Just the foreach_get/foreach_set side of bpy's keyframe_points
+    def __init__(self):
+        self.data = {"co": np.zeros((0, 2)), "handle_left": np.zeros((0, 2)), "handle_right": np.zeros((0, 2)),
+                     "interpolation": np.zeros(0), "handle_left_type": np.zeros(0), "handle_right_type": np.zeros(0)}
+
+    def __len__(self):
+        return len(self.data["co"])
+
+    def add(self, count):
+        for name, values in self.data.items():
+            self.data[name] = np.concatenate((values, np.zeros((count,) + values.shape[1:])))
+
+    def foreach_get(self, name, buffer):
+        buffer[:] = self.data[name].ravel()
+
+    def foreach_set(self, name, buffer):
+        self.data[name] = np.asarray(buffer, dtype=np.float64).reshape(self.data[name].shape)
+
+
+class FCurve:
+    def __init__(self, data_path="location", index=0, extrapolation='CONSTANT'):
+        self.data_path = data_path
+        self.array_index = index
+        self.keyframe_points = KeyframePoints()
+        self.modifiers = []
+        self.extrapolation = extrapolation
+
+    def update(self):
+        pass
+
+
+def fcurve(co, interpolation, handle_left=None, handle_right=None, extrapolation='CONSTANT'):
+    curve = FCurve(extrapolation=extrapolation)
+    co = np.asarray(co, dtype=np.float64)
+    al.write_keyframes(curve, co, np.full(len(co), interpolation), handle_left, handle_right)
+    return curve
+
+
+def strip(**settings):
+    values = dict(frame_start=1.0, frame_end=101.0, action_frame_start=1.0, action_frame_end=101.0, scale=1.0,
+                  repeat=1.0, use_reverse=False, extrapolation='HOLD', blend_in=0.0, blend_out=0.0,
+                  influence=1.0, use_animated_influence=False, fcurves=[])
+    values.update(settings)
+    return SimpleNamespace(**values)
+
+
+def random_quaternions(rng, count, max_angle=math.pi):
+    axis = rng.normal(size=(count, 3))
+    axis /= np.linalg.norm(axis, axis=1)[:, None]
+    half = rng.uniform(0.0, max_angle, count) * 0.5
+    return np.column_stack((np.cos(half), axis * np.sin(half)[:, None]))
+
+
+class BezierTest(unittest.TestCase):
+
+    def test_handles_on_the_chord_are_linear(self):
+        co = np.array([[0.0, 0.0], [3.0, 6.0]])
+        left = np.array([[-1.0, -2.0], [2.0, 4.0]])
+        right = np.array([[1.0, 2.0], [4.0, 8.0]])
+        frames = np.linspace(0.0, 3.0, 13)
+        values = al.evaluate_keyframes(co, left, right, np.full(2, al.KEY_BEZIER), frames)
+        np.testing.assert_allclose(values, frames * 2.0, atol=1e-6)
+
+    def test_hermite_handles_give_the_hermite_curve(self):
+        rng = np.random.default_rng(1)
+        x = np.cumsum(rng.uniform(1.0, 4.0, 8))
+        y = rng.normal(size=8)
+        slopes = al.hermite_slopes(x, y)
+        step_left = np.diff(x, prepend=x[0]) / 3.0
+        step_right = np.diff(x, append=x[-1]) / 3.0
+        left = np.column_stack((x - step_left, y - slopes * step_left))
+        right = np.column_stack((x + step_right, y + slopes * step_right))
+        frames = np.linspace(x[0], x[-1], 200)
+        values = al.evaluate_keyframes(np.column_stack((x, y)), left, right, np.full(8, al.KEY_BEZIER), frames)
+        np.testing.assert_allclose(values, al.hermite_values(x, y, slopes, frames), atol=1e-6)
+
+    def test_overlong_handles_stay_a_function_of_time(self):
+        co = np.array([[0.0, 0.0], [2.0, 1.0]])
+        left = np.array([[-1.0, 0.0], [-5.0, 1.0]])
+        right = np.array([[7.0, 0.0], [3.0, 1.0]])
+        frames = np.linspace(0.0, 2.0, 41)
+        values = al.evaluate_keyframes(co, left, right, np.full(2, al.KEY_BEZIER), frames)
+        self.assertTrue(np.all(np.isfinite(values)))
+        self.assertTrue(np.all(np.diff(values) >= -1e-9))
+
+    def test_extrapolation(self):
+        co = np.array([[0.0, 0.0], [10.0, 5.0]])
+        interpolation = np.full(2, al.KEY_LINEAR)
+        frames = np.array([-4.0, 14.0])
+        hold = al.evaluate_keyframes(co, co, co, interpolation, frames)
+        np.testing.assert_allclose(hold, [0.0, 5.0])
+        linear = al.evaluate_keyframes(co, co, co, interpolation, frames, 'LINEAR')
+        np.testing.assert_allclose(linear, [-2.0, 7.0])
+
+    def test_constant_interpolation_holds_until_the_next_key(self):
+        co = np.array([[0.0, 1.0], [5.0, 3.0]])
+        values = al.evaluate_keyframes(co, co, co, np.full(2, al.KEY_CONSTANT), np.array([0.0, 4.99, 5.0]))
+        np.testing.assert_allclose(values, [1.0, 1.0, 3.0])
+
+
+class StripTimeTest(unittest.TestCase):
+
+    def test_identity(self):
+        frames = np.arange(1.0, 102.0)
+        action_frames, active = al.strip_action_frames(strip(), frames)
+        np.testing.assert_allclose(action_frames, frames)
+        self.assertTrue(active.all())
+
+    def test_scale(self):
+        action_frames, _ = al.strip_action_frames(strip(frame_end=201.0, scale=2.0), np.array([1.0, 101.0, 201.0]))
+        np.testing.assert_allclose(action_frames, [1.0, 51.0, 101.0])
+
+    def test_repeat_wraps_and_holds_the_last_frame(self):
+        action_frames, _ = al.strip_action_frames(strip(frame_end=201.0, repeat=2.0),
+                                                  np.array([50.0, 101.0, 150.0, 201.0]))
+        np.testing.assert_allclose(action_frames, [50.0, 1.0, 50.0, 101.0])
+
+    def test_partial_repeat_wraps_at_the_end(self):
+        action_frames, _ = al.strip_action_frames(strip(frame_end=151.0, repeat=1.5), np.array([151.0]))
+        np.testing.assert_allclose(action_frames, [51.0])
+
+    def test_reverse(self):
+        action_frames, _ = al.strip_action_frames(strip(use_reverse=True), np.array([1.0, 31.0, 101.0]))
+        np.testing.assert_allclose(action_frames, [101.0, 71.0, 1.0])
+
+    def test_hold_extrapolation(self):
+        frames = np.array([-20.0, 1.0, 101.0, 150.0])
+        action_frames, active = al.strip_action_frames(strip(), frames)
+        np.testing.assert_allclose(action_frames, [1.0, 1.0, 101.0, 101.0])
+        self.assertTrue(active.all())
+        _, active = al.strip_action_frames(strip(extrapolation='HOLD_FORWARD'), frames)
+        np.testing.assert_array_equal(active, [False, True, True, True])
+        _, active = al.strip_action_frames(strip(extrapolation='NOTHING'), frames)
+        np.testing.assert_array_equal(active, [False, True, True, False])
+
+    def test_hold_stops_at_the_next_strip(self):
+        _, active = al.strip_action_frames(strip(), np.array([100.0, 120.0, 130.0]), next_start=130.0)
+        np.testing.assert_array_equal(active, [True, True, False])
+
+    def test_zero_length_action(self):
+        action_frames, _ = al.strip_action_frames(strip(action_frame_end=1.0), np.array([1.0, 50.0]))
+        self.assertTrue(np.all(np.isfinite(action_frames)))
+
+
+class StripInfluenceTest(unittest.TestCase):
+
+    def test_blend_in_and_out(self):
+        frames = np.array([-5.0, 1.0, 6.0, 11.0, 50.0, 91.0, 96.0, 101.0, 120.0])
+        influence = al.strip_influence(strip(blend_in=10.0, blend_out=10.0), frames)
+        np.testing.assert_allclose(influence, [0.0, 0.0, 0.5, 1.0, 1.0, 1.0, 0.5, 0.0, 0.0])
+
+    def test_animated_influence(self):
+        curve = fcurve([[1.0, 0.0], [11.0, 1.0]], al.KEY_LINEAR)
+        curve.data_path = 'influence'
+        curves = SimpleNamespace(find=lambda data_path: curve if data_path == 'influence' else None)
+        influence = al.strip_influence(strip(use_animated_influence=True, fcurves=curves), np.array([1.0, 6.0, 20.0]))
+        np.testing.assert_allclose(influence, [0.0, 0.5, 1.0])
+
+    def test_animated_influence_without_a_curve(self):
+        curves = SimpleNamespace(find=lambda data_path: None)
+        influence = al.strip_influence(strip(use_animated_influence=True, influence=0.25, fcurves=curves),
+                                       np.array([1.0, 50.0]))
+        np.testing.assert_allclose(influence, [0.25, 0.25])
+
+
+class BlendTest(unittest.TestCase):
+    BLEND_TYPES = ('REPLACE', 'COMBINE', 'ADD', 'SUBTRACT', 'MULTIPLY')
+
+    def channels(self, rng, mix_mode, count=64, max_angle=math.pi):
+        if mix_mode == 'QUATERNION':
+            return (random_quaternions(rng, count, max_angle), random_quaternions(rng, count, max_angle),
+                    np.array([1.0, 0.0, 0.0, 0.0]))
+        if mix_mode == 'MULTIPLY':
+            return rng.uniform(0.2, 3.0, (count, 3)), rng.uniform(0.2, 3.0, (count, 3)), np.ones(3)
+        return rng.normal(size=(count, 3)), rng.normal(size=(count, 3)), np.zeros(3)
+
+    def cases(self):
+        for blend_type in self.BLEND_TYPES:
+            modes = ('ADD', 'MULTIPLY', 'QUATERNION') if blend_type == 'COMBINE' else ('ADD',)
+            for mix_mode in modes:
+                yield blend_type, mix_mode
+
+    def assert_same_channel(self, actual, expected, mix_mode):
+        if mix_mode == 'QUATERNION':
+            # q and -q are the same rotation
+            actual = actual * np.sign(np.einsum('ij,ij->i', actual, expected))[:, None]
+        np.testing.assert_allclose(actual, expected, atol=1e-9)
+
+    def test_unblend_round_trip(self):
+        rng = np.random.default_rng(2)
+        for blend_type, mix_mode in self.cases():
+            with self.subTest(blend_type=blend_type, mix_mode=mix_mode):
+                lower, value, defaults = self.channels(rng, mix_mode)
+                influence = rng.uniform(0.05, 1.0, len(lower))
+                result = al.blend_values(lower, value, influence, blend_type, mix_mode, defaults)
+                solved = al.unblend_values(lower, result, influence, blend_type, mix_mode, defaults)
+                again = al.blend_values(lower, solved, influence, blend_type, mix_mode, defaults)
+                self.assert_same_channel(again, result, mix_mode)
+
+    def test_extract_combine_delta_round_trip(self):
+        rng = np.random.default_rng(3)
+        for mix_mode in ('ADD', 'MULTIPLY', 'QUATERNION'):
+            with self.subTest(mix_mode=mix_mode):
+                base, target, defaults = self.channels(rng, mix_mode)
+                delta = al.extract_combine_delta(base, target, mix_mode, defaults)
+                result = al.blend_values(base, delta, np.ones(len(base)), 'COMBINE', mix_mode, defaults)
+                self.assert_same_channel(result, target, mix_mode)
+
+    def test_fold_edit_delta_matches_keying_on_top(self):
+        # Scaling the folded rotation back up by 1 / influence has to stay within half a turn
+        rng = np.random.default_rng(4)
+        for mix_mode in ('ADD', 'MULTIPLY', 'QUATERNION'):
+            with self.subTest(mix_mode=mix_mode):
+                lower, base, defaults = self.channels(rng, mix_mode, max_angle=math.radians(60.0))
+                _, delta, _ = self.channels(rng, mix_mode, max_angle=math.radians(30.0))
+                influence = rng.uniform(0.5, 1.0, len(lower))
+                layered = al.blend_values(lower, base, influence, 'COMBINE', mix_mode, defaults)
+                expected = al.blend_values(layered, delta, np.ones(len(lower)), 'COMBINE', mix_mode, defaults)
+                folded = al.fold_edit_delta(base, delta, influence, mix_mode, defaults)
+                result = al.blend_values(lower, folded, influence, 'COMBINE', mix_mode, defaults)
+                self.assert_same_channel(result, expected, mix_mode)
+
+    def test_zero_influence_keeps_the_lower_value(self):
+        rng = np.random.default_rng(5)
+        for blend_type, mix_mode in self.cases():
+            with self.subTest(blend_type=blend_type, mix_mode=mix_mode):
+                lower, value, defaults = self.channels(rng, mix_mode)
+                result = al.blend_values(lower, value, np.zeros(len(lower)), blend_type, mix_mode, defaults)
+                self.assert_same_channel(result, lower, mix_mode)
+
+    def test_neutral_combine_value_changes_nothing(self):
+        rng = np.random.default_rng(6)
+        for mix_mode in ('ADD', 'MULTIPLY', 'QUATERNION'):
+            with self.subTest(mix_mode=mix_mode):
+                lower, _, defaults = self.channels(rng, mix_mode)
+                neutral = np.tile(defaults, (len(lower), 1))
+                result = al.blend_values(lower, neutral, rng.uniform(0.0, 1.0, len(lower)), 'COMBINE', mix_mode,
+                                         defaults)
+                self.assert_same_channel(result, lower, mix_mode)
+
+
+class OptimizerTest(unittest.TestCase):
+
+    def test_simplify_keeps_only_the_ends_of_a_line(self):
+        x = np.arange(50.0)
+        keep = al.simplify_samples(x, 0.5 * x + 2.0, 1e-6)
+        np.testing.assert_array_equal(np.nonzero(keep)[0], [0, 49])
+
+    def test_simplify_stays_within_tolerance(self):
+        x = np.arange(200.0)
+        y = np.sin(x * 0.1) + 0.3 * np.sin(x * 0.37)
+        for tolerance in (0.1, 0.01, 0.001):
+            keep = al.simplify_samples(x, y, tolerance)
+            self.assertLess(keep.sum(), len(x))
+            self.assertLessEqual(np.abs(np.interp(x, x[keep], y[keep]) - y).max(), tolerance)
+
+    def test_hermite_keys_stay_within_tolerance(self):
+        x = np.arange(300.0)
+        y = np.cos(x * 0.05) * np.exp(-x / 400.0)
+        fixed = np.zeros(len(x), dtype=bool)
+        keys = al.select_hermite_keys(x, y, 1e-4, fixed)
+        self.assertLess(keys.sum(), len(x) // 2)
+        kx, ky = x[keys], y[keys]
+        fit = al.hermite_values(kx, ky, al.hermite_slopes(kx, ky), x)
+        self.assertLessEqual(np.abs(fit - y).max(), 1e-4)
+
+    def test_equal_keys_with_shaped_handles_are_not_constant(self):
+        co = [[0.0, 0.0], [10.0, 0.0]]
+        left = np.array([[-3.0, 0.0], [7.0, 1.0]])
+        right = np.array([[3.0, 1.0], [13.0, 0.0]])
+        curve = fcurve(co, al.KEY_BEZIER, left, right)
+        self.assertFalse(al.constant_fcurve(curve, np.asarray(co), 1e-4))
+        flat = fcurve(co, al.KEY_LINEAR)
+        self.assertTrue(al.constant_fcurve(flat, np.asarray(co), 1e-4))
+
+    def test_linear_extrapolation_is_not_constant(self):
+        co = [[0.0, 1.0], [10.0, 1.0]]
+        left = np.array([[-3.0, 0.0], [7.0, 1.0]])
+        right = np.array([[3.0, 1.0], [13.0, 1.0]])
+        curve = fcurve(co, al.KEY_BEZIER, left, right, extrapolation='LINEAR')
+        self.assertFalse(al.constant_fcurve(curve, np.asarray(co), 1e-4))
+
+
+if __name__ == "__main__":
+    unittest.main()